@@ -2,65 +2,131 @@
     add_inactive_members.py
     ~~~~~~~~~~~~~~~~~~~~~~~
 
-    Update inactive team members.
+    Import former team members as inactive members.
 
+    Candidates are the authors stored in `issues`, `pull_requests`
+    and `events` with a matching `author_association` (by default
+    `MEMBER`/`OWNER`) or a login in the allowlist. Existing members
+    are left untouched.
 
+    python add_inactive_members.py [--association MEMBER] [--login octocat]
 
 """
+import argparse
 import os
+
 from dotenv import load_dotenv
-from chalicelib.models import Member, create_db_session
-
-load_dotenv()
-
-db_url = os.getenv("DB_URL")  # or remote var
-db = create_db_session(db_url)
-
-default_cols = [
-    "inactive_dt",
-    "avatar_url",
-    "events_url",
-    "followers_url",
-    "following_url",
-    "gists_url",
-    "gravatar_id",
-    "html_url",
-    "node_id",
-    "organizations_url",
-    "received_events_url",
-    "repos_url",
-    "site_admin",
-    "starred_url",
-    "subscriptions_url",
-    "url",
-]
-
-
-def update_members(users):
-    member_ids = [mem[1] for mem in users]
-    existing_recs = db.query(Member).filter(Member.id.in_(member_ids)).all()
-    existing_rec_ids = [rec.id for rec in existing_recs]
-    for (login, mem_id) in users:
-        if mem_id not in existing_rec_ids:
-            mem = {"id": mem_id, "login": login, "inactive": True, "type": "User"}
-            cols = {col: None for col in default_cols}
-            new_rec = Member(**{**mem, **cols})
-            db.add(new_rec)
-            db.commit()
-
-            print(f"Inactive member saved: {login}")
+from sqlalchemy.sql import text
+
+from chalicelib.models import create_db_session
+
+DEFAULT_ASSOCIATIONS = ["MEMBER", "OWNER"]
+
+# the first/last activity under a matching association is kept as
+# the membership interval; intervals are half-open (`left_at > ts`),
+# so `left_at` is just after the last activity
+IMPORT_INACTIVE_MEMBERS_STMT = text(
+    """
+WITH authors AS (
+	SELECT "user", author_association, created_at FROM public.issues
+	UNION ALL
+	SELECT "user", author_association, created_at FROM public.pull_requests
+	UNION ALL
+	SELECT "user", author_association, created_at FROM public.events
+),
+candidates AS (
+	SELECT
+		CAST("user" ->> 'id' AS integer) AS id,
+		(array_agg("user" ORDER BY created_at DESC))[1] AS u,
+		min(created_at) AS first_seen,
+		max(created_at) AS last_seen
+	FROM
+		authors
+	WHERE
+		"user" ->> 'type' = 'User'
+		AND (author_association = ANY(:associations)
+			OR "user" ->> 'login' = ANY(:allowlist))
+	GROUP BY
+		CAST("user" ->> 'id' AS integer)
+),
+inserted AS (
+	INSERT INTO public.members (
+		id, login, inactive, type, avatar_url, gravatar_id,
+		html_url, node_id, site_admin, url, inserted_dt)
+	SELECT
+		id,
+		u ->> 'login',
+		true,
+		'User',
+		u ->> 'avatar_url',
+		u ->> 'gravatar_id',
+		u ->> 'html_url',
+		u ->> 'node_id',
+		CAST(u ->> 'site_admin' AS boolean),
+		u ->> 'url',
+		now()
+	FROM
+		candidates
+	ON CONFLICT DO NOTHING
+	RETURNING id, login
+)
+INSERT INTO public.member_intervals (member_id, joined_at, left_at, login)
+SELECT
+	i.id, c.first_seen, c.last_seen + interval '1 second', i.login
+FROM
+	inserted i
+	JOIN candidates c ON c.id = i.id
+ON CONFLICT DO NOTHING
+RETURNING login;
+"""
+)
+
+
+def import_inactive_members(db, associations=DEFAULT_ASSOCIATIONS, allowlist=()):
+    """Insert inactive `Member` rows for stored authors in one statement.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        associations ([str], optional): `author_association` values that
+        mark a team member. Defaults to DEFAULT_ASSOCIATIONS.
+        allowlist ([str], optional): logins to import regardless of
+        association. Defaults to ().
+
+    Returns:
+        [str]: logins of the imported members
+    """
+    res = db.execute(
+        IMPORT_INACTIVE_MEMBERS_STMT,
+        {"associations": list(associations), "allowlist": list(allowlist)},
+    )
+    logins = [row.login for row in res]
+    db.commit()
     db.close()
 
+    for login in logins:
+        print(f"Inactive member saved: {login}")
+    print(f"{len(logins)} inactive members saved.")
+    return logins
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import former team members.")
+    parser.add_argument(
+        "--association",
+        action="append",
+        help="author_association marking a team member (repeatable), "
+        "defaults to MEMBER and OWNER",
+    )
+    parser.add_argument(
+        "--login", action="append", default=[], help="login to import (repeatable)"
+    )
+    args = parser.parse_args()
 
-    # SELECT distinct("user"), "user"->>'id' as _id, "user"->>'login' as login
-    # FROM public.issues where
-    # username in ('');
+    load_dotenv()
 
-    previous_mems = [
-        # login, id
-        ("",),
-    ]
+    db_url = os.getenv("DB_URL")  # or remote var
+    db = create_db_session(db_url)
 
-    update_members(previous_mems)
+    import_inactive_members(
+        db, associations=args.association or DEFAULT_ASSOCIATIONS, allowlist=args.login
+    )
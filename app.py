@@ -1,85 +1,350 @@
+import json
 import os
 from datetime import date, timedelta
+from functools import lru_cache
 
-from chalice import Chalice
+from chalice import BadRequestError, Chalice, Response, UnauthorizedError
+from sqlalchemy.orm import sessionmaker
 
+from chalicelib import metrics
 from chalicelib.github import (
     GitHubAPI,
-    reconcile_unmerged_closed_prs,
+    SearchCache,
+    reconcile_pr_merge_state,
     update_org_members_daily,
     update_org_issues_daily,
     update_org_issues_closed_daily,
 )
+from chalicelib.jobs import JobRunner, Step
+from chalicelib.membership import restamp_recent_authors
+from chalicelib.metrics_api import BadQuery, bump_data_version, serve
 from chalicelib.nrt import TimelineAPI, update_issue_activity
+from chalicelib.profiling import profiled
 from chalicelib.transfers import TransferAPI, reconcile_transferred_issues
-from chalicelib.utils import get_parameter
+from chalicelib.utils import get_parameters
 from chalicelib.models import create_db_session, PullRequest, Issue
+from chalicelib.queues import LocalQueue, PoolQueue, SQSQueue
+from chalicelib.rollups import ROLLUPS_LEASE, rebuild_rollups, refresh_rollups
+from chalicelib.webhooks import (
+    PR_RETRY_DELAY,
+    normalize_event,
+    requeue,
+    verify_signature,
+    write_batch,
+)
 
 app = Chalice(app_name="contributor-metrics")
 
-token = None
-db_url = None
+WEBHOOK_QUEUE = "contributor-metrics-webhooks"
+JOB_QUEUE = "contributor-metrics-jobs"
+
+# "sqs" or "local" to fan scheduled jobs out per
+# (step, repo), run in-process one by one otherwise
+JOBS_FANOUT = os.getenv("JOBS_FANOUT")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
 
-gh = None
-db = None
+# SSM parameters, fetched together on first use
+PARAMETERS = {
+    "token": "/contributor-metrics/prod/token",
+    "db_url": "/contributor-metrics/prod/db_url",
+    "webhook_secret": "/contributor-metrics/prod/webhook_secret",
+}
 
+# environment variables used instead under the Chalice CLI
+LOCAL_PARAMETERS = {
+    "token": "GH_TOKEN",
+    "db_url": "DB_URL",
+    "webhook_secret": "WEBHOOK_SECRET",
+}
 
-if "AWS_CHALICE_CLI_MODE" not in os.environ:
+
+def get_secret(name):
+    if "AWS_CHALICE_CLI_MODE" in os.environ:
+        return os.getenv(LOCAL_PARAMETERS[name])
     # We're running in Lambda...yay
-    token = get_parameter("/contributor-metrics/prod/token", True)
-    db_url = get_parameter("/contributor-metrics/prod/db_url", True)
+    # one request for all of them, reused for PARAMETER_TTL
+    return get_parameters(list(PARAMETERS.values()), True)[PARAMETERS[name]]
 
-    gh = GitHubAPI(token=token)
-    nrt_gh = TimelineAPI(token=token)
-    transfers_gh = TransferAPI(token=token)
-    db = create_db_session(db_url)
 
+# clients and the DB session are created on first use, once
+# per secret value, and reused by warm invocations
+@lru_cache(maxsize=None)
+def _db(db_url):
+    return create_db_session(db_url)
 
-@app.schedule("rate(30 minutes)")
-def every_30_min(event):
-    # 5 days back
-    # record any new PRs created within
-    # the last few days
-    # can narrow this interval in the future
-    update_org_issues_daily(db, gh, PullRequest, prs=True)
 
-    # one week back
-    # update existing PR status
-    # get recently closed PRs and update in the DB
-    update_org_issues_closed_daily(db, gh, PullRequest, prs=True)
+@lru_cache(maxsize=None)
+def _gh(token):
+    return GitHubAPI(token=token)
+
+
+@lru_cache(maxsize=None)
+def _nrt_gh(token):
+    return TimelineAPI(token=token)
+
+
+@lru_cache(maxsize=None)
+def _transfers_gh(token):
+    return TransferAPI(token=token)
+
+
+def get_db():
+    return _db(get_secret("db_url"))
+
+
+def get_gh():
+    return _gh(get_secret("token"))
+
+
+def get_nrt_gh():
+    return _nrt_gh(get_secret("token"))
+
+
+def get_transfers_gh():
+    return _transfers_gh(get_secret("token"))
+
+
+if os.getenv("WEBHOOK_QUEUE_ENABLED") == "true":
+    webhook_queue = SQSQueue(WEBHOOK_QUEUE)
+else:
+    # local stand-in, writes as soon as a batch fills
+    # or at the end of each delivery
+    webhook_queue = LocalQueue(lambda batch: write_batch(get_db(), batch))
+
+
+@app.route("/webhooks/github", methods=["POST"])
+def github_webhook():
+    request = app.current_request
+    signature = request.headers.get("x-hub-signature-256")
+
+    if not verify_signature(get_secret("webhook_secret"), request.raw_body, signature):
+        raise UnauthorizedError("invalid signature")
+
+    event_type = request.headers.get("x-github-event")
+    if event_type == "ping":
+        return {"ok": True}
+
+    for message in normalize_event(event_type, request.json_body):
+        webhook_queue.send(message)
+    webhook_queue.flush()
+
+    return Response(body="", status_code=202)
+
+
+def metrics_response(name, **path_params):
+    request = app.current_request
+    try:
+        status_code, body, headers = serve(
+            get_db,
+            name,
+            path_params,
+            request.query_params,
+            request.headers.get("if-none-match"),
+        )
+    except BadQuery as e:
+        raise BadRequestError(str(e))
+    return Response(body=body, headers=headers, status_code=status_code)
+
+
+# read-only, answered from the response cache until
+# ingestion bumps the data version
+@app.route("/metrics/repos/{repo}/daily")
+def repo_daily_metrics(repo):
+    return metrics_response("repo_daily", repo=repo)
+
 
-    # one year back
-    # updates the status of a closed PR to reflect
-    # the merged/not-merged state
-    reconcile_unmerged_closed_prs(db, gh)
+@app.route("/metrics/repos/{repo}/response-times")
+def response_time_metrics(repo):
+    return metrics_response("response_times", repo=repo)
 
-    # update any team members
-    # store any new team members
-    update_org_members_daily(db, gh)
 
-    # issues
-    update_org_issues_daily(db, gh, Issue, prs=False)
-    update_org_issues_closed_daily(db, gh, Issue, prs=False)
+@app.route("/metrics/contributors")
+def contributor_metrics():
+    return metrics_response("contributors")
 
-    # transfers
-    reconcile_transferred_issues(db, transfers_gh)
+
+@app.route("/metrics/issues")
+def issue_metrics():
+    return metrics_response("issues")
+
+
+@app.route("/metrics/transfers")
+def transfer_metrics():
+    return metrics_response("transfers")
+
+
+@app.on_sqs_message(queue=WEBHOOK_QUEUE, batch_size=10)
+def webhook_writer(event):
+    with metrics.invocation("webhook_writer"):
+        # messages of PRs not stored yet come back later
+        retries = SQSQueue(WEBHOOK_QUEUE, delay_seconds=PR_RETRY_DELAY)
+        write_batch(
+            get_db(),
+            [json.loads(record.body) for record in event],
+            defer=requeue(retries),
+        )
+        retries.flush()
+        bump_data_version(get_db())
+
+
+def every_30_min_steps():
+    # one `updated:>=` sweep per repo answers the
+    # created/closed searches of that repo
+    since_dt = date.today() - timedelta(weeks=1)
+    cache = SearchCache()
+    gh = get_gh()
+    transfers_gh = get_transfers_gh()
+
+    def repo_step(db_model, prs, update):
+        def step(db, repo):
+            cache.prime(gh, repo, since_dt)
+            update(db, gh, db_model, prs=prs, cache=cache, repos=[repo])
+
+        return step
+
+    return [
+        # 5 days back
+        # record any new PRs created within
+        # the last few days
+        # can narrow this interval in the future
+        Step("prs_created", repo_step(PullRequest, True, update_org_issues_daily)),
+        # one week back
+        # update existing PR status
+        # get recently closed PRs and update in the DB
+        Step(
+            "prs_closed",
+            repo_step(PullRequest, True, update_org_issues_closed_daily),
+        ),
+        # update any team members
+        # store any new team members
+        Step("members", lambda db: update_org_members_daily(db, gh), per_repo=False),
+        # issues
+        Step("issues_created", repo_step(Issue, False, update_org_issues_daily)),
+        Step("issues_closed", repo_step(Issue, False, update_org_issues_closed_daily)),
+        # transfers, lease shared with nrt_events
+        Step(
+            "transfers",
+            lambda db: reconcile_transferred_issues(db, transfers_gh),
+            per_repo=False,
+            lease="transfers",
+        ),
+    ]
+
+
+def nrt_events_steps():
+    since_dt = date.today() - timedelta(days=1)
+    cache = SearchCache()
+    nrt_gh = get_nrt_gh()
+    transfers_gh = get_transfers_gh()
+
+    def repo_step(db_model, prs):
+        def step(db, repo):
+            cache.prime(nrt_gh, repo, since_dt)
+            update_issue_activity(
+                db, nrt_gh, db_model, since_dt, prs=prs, cache=cache, repos=[repo]
+            )
+
+        return step
+
+    return [
+        Step("issue_activity", repo_step(Issue, False)),
+        Step("pr_activity", repo_step(PullRequest, True)),
+        # lease shared with every_30_min
+        Step(
+            "transfers",
+            lambda db: reconcile_transferred_issues(db, transfers_gh),
+            per_repo=False,
+            lease="transfers",
+        ),
+        # days touched since the previous refresh, rows
+        # written by items still running are picked up next time
+        Step("rollups", refresh_rollups, per_repo=False, lease=ROLLUPS_LEASE),
+    ]
+
+
+# job name -> builds the job's steps
+JOBS = {
+    "every_30_min": every_30_min_steps,
+    "nrt_events": nrt_events_steps,
+}
+
+
+def run_job(job, context):
+    with metrics.invocation(job):
+        _run_job(job, context)
+        if JOBS_FANOUT != "sqs":
+            bump_data_version(get_db())
+
+
+def _run_job(job, context):
+    db = get_db()
+    steps = JOBS[job]()
+    runner = JobRunner(db, job, steps, context=context)
+
+    if JOBS_FANOUT == "sqs":
+        # workers pick the items up from the queue (`job_worker`)
+        runner.dispatch(SQSQueue(JOB_QUEUE))
+    elif JOBS_FANOUT == "local":
+        # one session per worker thread, steps (and
+        # their search cache) shared by all items
+        Session = sessionmaker(bind=db.get_bind())
+
+        def work(message):
+            worker_db = Session()
+            try:
+                worker = JobRunner(worker_db, job, steps)
+                return worker.execute(message["step"], message["repo"])
+            finally:
+                worker_db.close()
+
+        runner.dispatch(PoolQueue(work, max_workers=JOB_WORKERS))
+        print(f"{job}: {runner.collect()}")
+    else:
+        runner.run()
+
+
+@app.schedule("rate(30 minutes)")
+@profiled("every_30_min")
+def every_30_min(event):
+    run_job("every_30_min", event.context)
 
 
 @app.schedule("rate(10 minutes)")
+@profiled("nrt_events")
 def nrt_events(event):
-    today = date.today()
-    since_dt = today - timedelta(days=1)
-    update_issue_activity(db, nrt_gh, Issue, since_dt, prs=False)
-    update_issue_activity(db, nrt_gh, PullRequest, since_dt, prs=True)
-    reconcile_transferred_issues(db, transfers_gh)
+    run_job("nrt_events", event.context)
+
+
+@app.on_sqs_message(queue=JOB_QUEUE, batch_size=1)
+@profiled("job_worker")
+def job_worker(event):
+    for record in event:
+        message = json.loads(record.body)
+        job = message["job"]
+        with metrics.invocation(job, worker=message["step"]):
+            runner = JobRunner(get_db(), job, JOBS[job](), context=event.context)
+            print(json.dumps(runner.execute(message["step"], message["repo"])))
+            # the last item of the job reports for all of them
+            if not runner.pending():
+                summary = runner.collect()
+                if summary["items"]:
+                    print(f"{job}: {summary}")
+            bump_data_version(get_db())
 
 
 # Run at 5:00am (UTC)/~midnight EST every day.
 @app.schedule("cron(0 5 * * ? *)")
+@profiled("daily")
 def daily(event):
-    # updates full historical "closed" state
-    # once a day
-    # ----
-    # updates the status of a closed PR to reflect
-    # the merged/not-merged state
-    reconcile_unmerged_closed_prs(db, gh, "2019-01-01")
+    # merge state is set at ingestion, this
+    # corrects PRs updated over the last week
+    # from stored data only (no API requests)
+    with metrics.invocation("daily"):
+        reconcile_pr_merge_state(get_db(), date.today() - timedelta(weeks=1))
+        # rows stamped by processes holding a membership
+        # index from before the last member sync
+        restamp_recent_authors(get_db(), date.today() - timedelta(days=1))
+        # deletions of the last week are not seen by the
+        # incremental refresh; skipped while a refresh runs
+        rebuild_rollups(get_db(), date.today() - timedelta(weeks=1))
+        bump_data_version(get_db())
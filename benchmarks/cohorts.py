@@ -0,0 +1,269 @@
+"""
+    cohorts.py
+    ~~~~~~~~~~
+
+    The vectorized metrics of `chalicelib.cohorts` against the same
+    metrics computed in SQL and in plain Python loops, on the synthetic
+    dataset (see `synthetic.py`).
+
+    - first response: `item_metrics`, the `issue_metrics` refresh
+      statement over every item (rolled back), and a dict/loop version
+    - retention: `retention_cohorts`, one SQL query, and a dict/set
+      version
+
+    The NumPy and Python results are compared; differences are printed.
+
+    pip install numpy
+    python -m benchmarks.cohorts --out baselines.jsonl
+
+"""
+import json
+from datetime import datetime
+
+from sqlalchemy.sql import text
+
+from chalicelib.cohorts import item_metrics, load_extract, retention_cohorts
+from chalicelib.issue_metrics import (
+    COMMENT_EVENTS,
+    REFRESH_ISSUE_METRICS_STMT,
+    RESPONSE_EVENTS,
+)
+
+try:
+    from db_paths import timed
+except ModuleNotFoundError:
+    from benchmarks.db_paths import timed
+
+
+RETENTION_STMT = text(
+    """
+WITH activity AS (
+	SELECT username, created_at FROM public.issues
+	UNION ALL
+	SELECT username, created_at FROM public.pull_requests
+	UNION ALL
+	SELECT username, created_at FROM public.events
+	WHERE event = ANY(CAST(:comment_events AS varchar[]))
+),
+community AS (
+	SELECT DISTINCT
+		a.username, CAST(date_trunc('month', a.created_at) AS date) AS month
+	FROM
+		activity a
+	WHERE
+		a.username IS NOT NULL
+		AND NOT EXISTS (
+			SELECT 1 FROM public.member_intervals mi
+			WHERE mi.login = a.username
+				AND mi.joined_at <= a.created_at
+				AND (mi.left_at IS NULL OR mi.left_at > a.created_at))
+),
+offsets AS (
+	SELECT
+		min(month) OVER (PARTITION BY username) AS cohort,
+		month
+	FROM
+		community
+)
+SELECT
+	cohort,
+	CAST(extract(year FROM age(month, cohort)) * 12
+		+ extract(month FROM age(month, cohort)) AS int) AS month_offset,
+	count(*)
+FROM
+	offsets
+GROUP BY
+	1, 2
+HAVING
+	extract(year FROM age(month, cohort)) * 12
+		+ extract(month FROM age(month, cohort)) < :months
+ORDER BY
+	1, 2;
+"""
+)
+
+
+def python_first_response(extract):
+    """First response per item with dicts and loops over the extract."""
+    items, events = extract.items, extract.events
+    authors = items["author"].tolist()
+    pos = {item_id: i for i, item_id in enumerate(items["id"].tolist())}
+
+    intervals = {}
+    for login, joined_at, left_at in zip(
+        extract.intervals["login"].tolist(),
+        extract.intervals["joined_at"].tolist(),
+        extract.intervals["left_at"].tolist(),
+    ):
+        intervals.setdefault(login, []).append((joined_at, left_at))
+
+    response_codes = {extract.labels.code(name) for name in RESPONSE_EVENTS}
+    first = [None] * len(authors)
+    for issue_id, event, user, ts in zip(
+        events["issue_id"].tolist(),
+        events["event"].tolist(),
+        events["user"].tolist(),
+        events["created_at"].tolist(),
+    ):
+        i = pos.get(issue_id)
+        if i is None or event not in response_codes or user == authors[i]:
+            continue
+        if not any(joined <= ts < left for joined, left in intervals.get(user, ())):
+            continue
+        if first[i] is None or ts < first[i]:
+            first[i] = ts
+    return first
+
+
+def python_retention(extract, months=12):
+    """Community retention cohorts with dicts and sets over the extract."""
+    items, events = extract.items, extract.events
+    intervals = {}
+    for login, joined_at, left_at in zip(
+        extract.intervals["login"].tolist(),
+        extract.intervals["joined_at"].tolist(),
+        extract.intervals["left_at"].tolist(),
+    ):
+        intervals.setdefault(login, []).append((joined_at, left_at))
+
+    comment_codes = {extract.labels.code(name) for name in COMMENT_EVENTS}
+    activity = list(zip(items["author"].tolist(), items["created_at"].tolist()))
+    activity += [
+        (user, ts)
+        for event, user, ts in zip(
+            events["event"].tolist(),
+            events["user"].tolist(),
+            events["created_at"].tolist(),
+        )
+        if event in comment_codes
+    ]
+
+    none_code = extract.users.code(None)
+    active = {}
+    for user, ts in activity:
+        if ts is None or user == none_code:
+            continue
+        if any(joined <= ts < left for joined, left in intervals.get(user, ())):
+            continue
+        active.setdefault(user, set()).add(ts.year * 12 + ts.month - 1)
+
+    cohorts = {}
+    for user_months in active.values():
+        cohort = min(user_months)
+        for month in user_months:
+            if month - cohort < months:
+                key = (cohort, month - cohort)
+                cohorts[key] = cohorts.get(key, 0) + 1
+    return cohorts
+
+
+def run(db, months=12):
+    """Run the benchmarks.
+
+    Returns:
+        dict: {benchmark: {seconds, rows, rows_per_second}}
+    """
+    results = {}
+    out = {}
+
+    # rows are only known once loaded
+    items = db.execute(text("SELECT count(*) FROM public.issues")).scalar()
+    items += db.execute(text("SELECT count(*) FROM public.pull_requests")).scalar()
+    results["load_extract"] = timed(
+        "load_extract", lambda: out.update(extract=load_extract(db)), items
+    )
+    extract = out["extract"]
+    n_items, n_events = len(extract), len(extract.events["issue_id"])
+
+    results["first_response_numpy"] = timed(
+        "first_response_numpy",
+        lambda: out.update(numpy=item_metrics(extract)),
+        n_events,
+    )
+    results["first_response_python"] = timed(
+        "first_response_python",
+        lambda: out.update(python=python_first_response(extract)),
+        n_events,
+    )
+
+    def sql_first_response():
+        ids = extract.items["id"].tolist()
+        db.execute(
+            REFRESH_ISSUE_METRICS_STMT,
+            {
+                "ids": ids,
+                "response_events": RESPONSE_EVENTS,
+                "comment_events": COMMENT_EVENTS,
+            },
+        )
+        db.rollback()
+
+    results["first_response_sql"] = timed(
+        "first_response_sql", sql_first_response, n_events
+    )
+
+    results["retention_numpy"] = timed(
+        "retention_numpy",
+        lambda: out.update(cohorts=retention_cohorts(extract, months)),
+        n_items + n_events,
+    )
+    results["retention_python"] = timed(
+        "retention_python",
+        lambda: out.update(py_cohorts=python_retention(extract, months)),
+        n_items + n_events,
+    )
+
+    def sql_retention():
+        db.execute(
+            RETENTION_STMT, {"comment_events": COMMENT_EVENTS, "months": months}
+        ).fetchall()
+        db.rollback()
+
+    results["retention_sql"] = timed("retention_sql", sql_retention, n_items + n_events)
+
+    # numpy and python agree
+    numpy_first = out["numpy"]["first_response_at"].tolist()
+    mismatches = sum(1 for a, b in zip(numpy_first, out["python"]) if a != b)
+    print(f"first response mismatches: {mismatches}")
+
+    cohort_months, counts = out["cohorts"]
+    numpy_cohorts = {
+        (month.item().year * 12 + month.item().month - 1, offset): int(count)
+        for month, row in zip(cohort_months, counts)
+        for offset, count in enumerate(row)
+        if count
+    }
+    print(f"retention matches: {numpy_cohorts == out['py_cohorts']}")
+
+    db.close()
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    from dotenv import load_dotenv
+
+    from chalicelib.models import create_db_session
+
+    parser = argparse.ArgumentParser(description="Benchmark the cohort metrics.")
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--out", help="append the results to this JSON-lines file")
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    # never point this at the production database
+    db = create_db_session(os.getenv("BENCH_DB_URL"))
+
+    results = run(db, args.months)
+
+    if args.out:
+        with open(args.out, "a") as f:
+            baseline = {
+                "run_at": datetime.utcnow().isoformat(),
+                "benchmark": "cohorts",
+                "results": results,
+            }
+            f.write(json.dumps(baseline) + "\n")
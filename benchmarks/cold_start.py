@@ -0,0 +1,117 @@
+"""
+    cold_start.py
+    ~~~~~~~~~~~~~
+
+    Import and init breakdown of the Lambda app, to keep cold starts
+    under a target.
+
+    Imports are timed in a fresh interpreter (`python -X importtime`),
+    init steps in this process in the order a scheduled function
+    runs them. Secrets come from the environment (GH_TOKEN, DB_URL,
+    WEBHOOK_SECRET, or `.env`), or from SSM with `--ssm`.
+
+    python benchmarks/cold_start.py [--ssm] [--top 15] [--target-ms 1500]
+
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_breakdown(module="app"):
+    """Cumulative import time per module in a fresh interpreter.
+
+    Returns:
+        [(str, float)]: (module, ms) in import order
+    """
+    env = dict(os.environ, AWS_CHALICE_CLI_MODE="true")
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times.append((name.rstrip(), int(cumulative) / 1000))
+    return times
+
+
+def timed(label, fn, report):
+    started = time.perf_counter()
+    result = fn()
+    report.append((label, (time.perf_counter() - started) * 1000))
+    return result
+
+
+def init_breakdown(ssm=False):
+    """Time each init step of the app in this process.
+
+    Returns:
+        [(str, float)]: (step, ms)
+    """
+    if ssm:
+        os.environ.pop("AWS_CHALICE_CLI_MODE", None)
+    else:
+        os.environ["AWS_CHALICE_CLI_MODE"] = "true"
+
+    sys.path.insert(0, ROOT)
+    report = []
+    app = timed("import app", lambda: __import__("app"), report)
+
+    from sqlalchemy.sql import text
+
+    from chalicelib.utils import get_client
+
+    timed("secrets", lambda: app.get_secret("token"), report)
+    db = timed("db session", app.get_db, report)
+    timed("db connect", lambda: db.execute(text("SELECT 1")), report)
+    timed("GitHubAPI", app.get_gh, report)
+    timed("TimelineAPI", app.get_nrt_gh, report)
+    timed("TransferAPI", app.get_transfers_gh, report)
+    if ssm:
+        timed("ses client", lambda: get_client("ses", region_name="us-east-1"), report)
+    # warm calls should be free
+    timed("secrets (warm)", lambda: app.get_secret("db_url"), report)
+    timed("db session (warm)", app.get_db, report)
+    return report
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Cold start breakdown.")
+    parser.add_argument("--ssm", action="store_true", help="fetch secrets from SSM")
+    parser.add_argument("--top", type=int, default=15, help="slowest imports shown")
+    parser.add_argument("--target-ms", type=float, help="fail above this total")
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    imports = import_breakdown()
+    import_ms = imports[-1][1] if imports else 0.0
+    print(f"imports (fresh interpreter): {import_ms:.1f} ms")
+    top = sorted(imports, key=lambda rec: rec[1], reverse=True)[: args.top]
+    for name, ms in top:
+        print(f"  {ms:9.1f} ms  {name}")
+
+    init = init_breakdown(ssm=args.ssm)
+    init_ms = sum(ms for step, ms in init if step != "import app")
+    print(f"init: {init_ms:.1f} ms")
+    for step, ms in init:
+        print(f"  {ms:9.1f} ms  {step}")
+
+    total_ms = import_ms + init_ms
+    print(f"total: {total_ms:.1f} ms")
+    if args.target_ms is not None and total_ms > args.target_ms:
+        print(f"over target ({args.target_ms:.0f} ms)")
+        sys.exit(1)
@@ -0,0 +1,218 @@
+"""
+    db_paths.py
+    ~~~~~~~~~~~
+
+    Throughput of the hot DB paths against a synthetic dataset
+    (see `synthetic.py`) on a local database.
+
+    - upsert: `upsert_records` and `bulk_upsert` of stored issues
+    - id_lookup: `id IN (...)` lookups of search pages, and
+      `(repo, number)` lookups as used for transfers and webhooks
+    - event_diff: `create_or_update_events` on regenerated timelines with
+      new events and changed reactions
+    - member_diff: `update_org_members_daily` against a member list
+      with churn, served without API requests
+    - transfer_detection: `FIND_TRANSFERRED_ISSUES_STMT`
+    - merge_state: `reconcile_pr_merge_state` over all PRs
+
+    Pass the same dataset arguments as to `synthetic.py`. The event and
+    member benchmarks write to the database.
+
+    python -m benchmarks.db_paths --issues 200000 --prs 100000 --out baselines.jsonl
+
+"""
+import json
+import random
+import time
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+from chalicelib.bulk import bulk_upsert
+from chalicelib.github import reconcile_pr_merge_state, update_org_members_daily
+from chalicelib.models import Issue, Member, to_record, upsert_records
+from chalicelib.nrt import create_or_update_events
+from chalicelib.transfers import FIND_TRANSFERRED_ISSUES_STMT
+
+try:
+    from synthetic import ORG, add_dataset_arguments, generator_from_args
+except ModuleNotFoundError:
+    from benchmarks.synthetic import ORG, add_dataset_arguments, generator_from_args
+
+
+class MembersAPI:
+    """Serves an org member list through `get_if_changed`, like
+    `GitHubAPI`, without requests. Every request is a change."""
+
+    def __init__(self, members):
+        self.members = members
+
+    def get_if_changed(self, url, etag=None, per_page=100, page=1, **params):
+        start = (page - 1) * per_page
+        return self.members[start : start + per_page], f'W/"{page}-{time.time()}"'
+
+
+def timed(name, fn, rows):
+    started = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - started
+    res = {
+        "seconds": round(seconds, 3),
+        "rows": rows,
+        "rows_per_second": round(rows / seconds) if seconds else None,
+    }
+    print(
+        f"{name:<20} {res['seconds']:>9.3f}s {rows:>10} rows {res['rows_per_second']}/s"
+    )
+    return res
+
+
+def bench_upsert(db, gen, specs, sample):
+    recs = [to_record(Issue, gen.item(spec)) for spec in sample]
+
+    def upsert():
+        upsert_records(db, Issue, recs)
+        db.commit()
+
+    def bulk():
+        bulk_upsert(db, Issue, recs)
+        db.commit()
+
+    return {
+        "upsert_records": timed("upsert_records", upsert, len(recs)),
+        "bulk_upsert": timed("bulk_upsert", bulk, len(recs)),
+    }
+
+
+def bench_id_lookup(db, specs, sample):
+    ids = [spec.id for spec in sample]
+    keys = [(spec.repo, spec.number) for spec in sample]
+
+    def by_id():
+        # one search page at a time, like the update jobs
+        for i in range(0, len(ids), 100):
+            db.query(Issue).filter(Issue.id.in_(ids[i : i + 100])).all()
+        db.rollback()
+
+    def by_repo_number():
+        for i in range(0, len(keys), 100):
+            db.query(Issue.id).filter(
+                tuple_(Issue.repo, Issue.number).in_(keys[i : i + 100])
+            ).all()
+        db.rollback()
+
+    return {
+        "id_lookup": timed("id_lookup", by_id, len(ids)),
+        "repo_number_lookup": timed("repo_number_lookup", by_repo_number, len(keys)),
+    }
+
+
+def bench_event_diff(db, gen, sample, new_rate=0.05, changed_rate=0.05):
+    rng = random.Random(gen.seed)
+    timelines = []
+    for spec in sample:
+        events = gen.timeline(spec)
+        for event in events:
+            if event.get("reactions") and rng.random() < changed_rate:
+                event["reactions"] = dict(event["reactions"], heart=1)
+        extra = spec._replace(n_events=int(spec.n_events * (1 + new_rate)) + 1)
+        events += gen.timeline(extra)[len(events) :]
+        timelines.append((spec, events))
+    rows = sum(len(events) for _, events in timelines)
+
+    def diff():
+        for spec, events in timelines:
+            create_or_update_events(db, events, spec.id, ORG, spec.repo)
+
+    return {"event_diff": timed("event_diff", diff, rows)}
+
+
+def bench_member_diff(db, gen, churn=0.05):
+    rng = random.Random(gen.seed)
+    current = [
+        gen.user(idx) for idx in range(gen.members) if rng.random() > churn  # leavers
+    ]
+    joiners = int(gen.members * churn)
+    current += [gen.user(gen.members + idx) for idx in range(joiners)]
+    stored = db.query(Member.id).count()
+
+    return {
+        "member_diff": timed(
+            "member_diff",
+            lambda: update_org_members_daily(db, MembersAPI(current)),
+            stored + len(current),
+        )
+    }
+
+
+def bench_transfer_detection(db):
+    issues = db.query(Issue.id).count()
+
+    def detect():
+        db.execute(FIND_TRANSFERRED_ISSUES_STMT).fetchall()
+        db.rollback()
+
+    return {"transfer_detection": timed("transfer_detection", detect, issues)}
+
+
+def bench_merge_state(db, specs):
+    prs = sum(1 for spec in specs if spec.kind == "pr")
+    return {
+        "merge_state": timed("merge_state", lambda: reconcile_pr_merge_state(db), prs)
+    }
+
+
+def run(db, gen, issues, prs, sample_size=2000):
+    """Run all benchmarks.
+
+    Returns:
+        dict: {benchmark: {seconds, rows, rows_per_second}}
+    """
+    specs = list(gen.specs(issues, prs))
+    rng = random.Random(gen.seed)
+    issue_specs = [spec for spec in specs if spec.kind == "issue"]
+    sample = rng.sample(issue_specs, min(sample_size, len(issue_specs)))
+
+    results = {}
+    results.update(bench_upsert(db, gen, specs, sample))
+    results.update(bench_id_lookup(db, specs, sample))
+    results.update(bench_event_diff(db, gen, sample[:200]))
+    results.update(bench_member_diff(db, gen))
+    results.update(bench_transfer_detection(db))
+    results.update(bench_merge_state(db, specs))
+    db.close()
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    from dotenv import load_dotenv
+
+    from chalicelib.models import create_db_session
+
+    parser = argparse.ArgumentParser(description="Benchmark the hot DB paths.")
+    add_dataset_arguments(parser)
+    parser.add_argument("--sample", type=int, default=2000, help="issues per benchmark")
+    parser.add_argument("--out", help="append the results to this JSON-lines file")
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    # never point this at the production database
+    db = create_db_session(os.getenv("BENCH_DB_URL"))
+
+    results = run(db, generator_from_args(args), args.issues, args.prs, args.sample)
+
+    if args.out:
+        with open(args.out, "a") as f:
+            baseline = {
+                "run_at": datetime.utcnow().isoformat(),
+                "dataset": {
+                    key: getattr(args, key)
+                    for key in ("issues", "prs", "events_per_issue", "skew", "seed")
+                },
+                "results": results,
+            }
+            f.write(json.dumps(baseline) + "\n")
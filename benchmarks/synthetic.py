@@ -0,0 +1,467 @@
+"""
+    synthetic.py
+    ~~~~~~~~~~~~
+
+    Synthetic, schema-faithful org data for load-testing the DB paths.
+
+    Issues and PRs are generated as search API items, events as Timeline
+    API events, members as org member items, so they go through the same
+    `format_issue`/`format_event`/`to_record` code as real data. Records
+    are streamed through the bulk loader, so tens of millions of events
+    do not need to fit in memory.
+
+    Activity is skewed (`--skew`, 0 is uniform, higher is more skewed):
+    a few repos and authors account for most issues and events, and
+    events per issue follow a Pareto distribution. A share of issues
+    (`--duplicate-rate`) are duplicated into another repo with the same
+    author and creation time, as transfers leave them; a share of those
+    (`--transfer-rate`) are already reconciled into `transfers`, the
+    rest are left for transfer detection.
+
+    Everything is derived from `--seed`, so a dataset can be rebuilt and
+    the events of any issue regenerated on their own.
+
+    python -m benchmarks.synthetic --issues 200000 --prs 100000 --events-per-issue 40
+
+    `--archive` writes the issues and PRs as recorded search items to a
+    JSON-lines file instead, to load through `chalicelib.archive`:
+
+    python -m benchmarks.synthetic --prs 5000 --archive /tmp/items.jsonl.gz
+    python -m chalicelib.archive /tmp/items.jsonl.gz
+
+"""
+import gzip
+import hashlib
+import json
+import math
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from chalicelib.bulk import bulk_upsert
+from chalicelib.constants import REPOS
+from chalicelib.github import format_issue
+from chalicelib.models import (
+    Event,
+    EventPoll,
+    Issue,
+    Member,
+    MemberInterval,
+    PullRequest,
+    Transfer,
+    to_record,
+)
+from chalicelib.nrt import format_event
+
+ORG = "aws-amplify"
+API = "https://api.github.com"
+
+ISSUE_ID_BASE = 1_000_000_000
+EVENT_ID_BASE = 10_000_000_000
+USER_ID_BASE = 100_000
+
+# events per issue, event ids are issue-based
+MAX_EVENTS = 9999
+
+# (event, weight) for issues; PRs add reviews and merges
+ISSUE_EVENTS = [
+    ("commented", 50),
+    ("labeled", 15),
+    ("unlabeled", 3),
+    ("assigned", 5),
+    ("mentioned", 5),
+    ("subscribed", 8),
+    ("closed", 5),
+    ("reopened", 1),
+    ("renamed", 1),
+]
+PR_EVENTS = ISSUE_EVENTS + [("reviewed", 20), ("review_requested", 5)]
+
+LABELS = ["bug", "feature-request", "pending-triage", "question", "documentation"]
+
+Spec = namedtuple(
+    "Spec",
+    ["id", "number", "repo", "kind", "created_at", "author", "n_events", "closed"],
+)
+
+
+def ts(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class Generator:
+    def __init__(
+        self,
+        seed=0,
+        repos=REPOS,
+        users=50000,
+        members=300,
+        skew=1.2,
+        events_per_issue=20,
+        start_dt=datetime(2017, 1, 1),
+        end_dt=None,
+    ):
+        self.seed = seed
+        self.repos = repos
+        self.users = users
+        self.members = members
+        self.skew = skew
+        self.events_per_issue = events_per_issue
+        self.start_dt = start_dt
+        self.end_dt = end_dt or datetime.utcnow()
+        self.rng = random.Random(seed)
+
+    def skewed(self, rng, n, mean=None):
+        """Skewed index in [0, n), low indices the most likely, or a
+        Pareto-distributed count with the given mean when `mean` is set.
+        A skew of 0 is uniform (or constant)."""
+        if mean is None:
+            return int(n * rng.random() ** (1 + self.skew))
+        if self.skew <= 0:
+            return min(round(mean), n)
+        alpha = 1 + 1 / self.skew
+        return min(int(rng.paretovariate(alpha) * mean * (alpha - 1) / alpha), n)
+
+    def user(self, idx):
+        user_id = USER_ID_BASE + idx
+        login = f"user{idx}" if idx >= self.members else f"member{idx}"
+        return {
+            "login": login,
+            "id": user_id,
+            "node_id": f"MDQ6VXNlcj{user_id}",
+            "avatar_url": f"https://avatars.githubusercontent.com/u/{user_id}?v=4",
+            "gravatar_id": "",
+            "url": f"{API}/users/{login}",
+            "html_url": f"https://github.com/{login}",
+            "followers_url": f"{API}/users/{login}/followers",
+            "following_url": f"{API}/users/{login}/following{{/other_user}}",
+            "gists_url": f"{API}/users/{login}/gists{{/gist_id}}",
+            "starred_url": f"{API}/users/{login}/starred{{/owner}}{{/repo}}",
+            "subscriptions_url": f"{API}/users/{login}/subscriptions",
+            "organizations_url": f"{API}/users/{login}/orgs",
+            "repos_url": f"{API}/users/{login}/repos",
+            "events_url": f"{API}/users/{login}/events{{/privacy}}",
+            "received_events_url": f"{API}/users/{login}/received_events",
+            "type": "User",
+            "site_admin": False,
+        }
+
+    def association(self, author):
+        return "MEMBER" if author < self.members else "NONE"
+
+    def specs(self, issues, prs):
+        """Issues and PRs to generate, in creation order."""
+        span = (self.end_dt - self.start_dt).total_seconds()
+        numbers = {repo: 0 for repo in self.repos}
+        kinds = ["issue"] * issues + ["pr"] * prs
+        self.rng.shuffle(kinds)
+        created = sorted(self.rng.random() * span for _ in kinds)
+
+        for idx, (kind, offset) in enumerate(zip(kinds, created)):
+            # repos are skewed too, the first ones are the busiest
+            repo = self.repos[self.skewed(self.rng, len(self.repos))]
+            numbers[repo] += 1
+            yield Spec(
+                id=ISSUE_ID_BASE + idx,
+                number=numbers[repo],
+                repo=repo,
+                kind=kind,
+                created_at=self.start_dt + timedelta(seconds=int(offset)),
+                author=self.skewed(self.rng, self.users),
+                n_events=self.skewed(self.rng, MAX_EVENTS, self.events_per_issue),
+                closed=self.rng.random() < 0.8,
+            )
+
+    def spec_rng(self, spec):
+        return random.Random(f"{self.seed}-{spec.id}")
+
+    def item(self, spec):
+        """Search API item of an issue or PR."""
+        rng = self.spec_rng(spec)
+        base = f"{API}/repos/{ORG}/{spec.repo}/issues/{spec.number}"
+        updated_at = spec.created_at + timedelta(hours=rng.randint(1, 24 * 90))
+        closed_at = updated_at if spec.closed else None
+        item = {
+            "id": spec.id,
+            "node_id": f"I_kwDO{spec.id}",
+            "number": spec.number,
+            "title": f"Synthetic {spec.kind} {spec.number} in {spec.repo}",
+            "body": "x" * rng.randint(50, 2000),
+            "user": self.user(spec.author),
+            "author_association": self.association(spec.author),
+            "labels": [
+                {"id": i, "name": name, "color": "ededed", "default": False}
+                for i, name in enumerate(rng.sample(LABELS, rng.randint(0, 2)))
+            ],
+            "state": "closed" if spec.closed else "open",
+            "state_reason": "completed" if spec.closed else None,
+            "locked": False,
+            "active_lock_reason": None,
+            "assignee": None,
+            "assignees": [],
+            "milestone": None,
+            "comments": rng.randint(0, 30),
+            "created_at": ts(spec.created_at),
+            "updated_at": ts(updated_at),
+            "closed_at": ts(closed_at) if closed_at else None,
+            "reactions": {"total_count": 0, "+1": rng.randint(0, 5)},
+            "url": base,
+            "html_url": f"https://github.com/{ORG}/{spec.repo}/issues/{spec.number}",
+            "repository_url": f"{API}/repos/{ORG}/{spec.repo}",
+            "labels_url": f"{base}/labels{{/name}}",
+            "comments_url": f"{base}/comments",
+            "events_url": f"{base}/events",
+            "timeline_url": f"{base}/timeline",
+            "performed_via_github_app": None,
+            "score": 1.0,
+        }
+        if spec.kind == "pr":
+            merged = spec.closed and rng.random() < 0.7
+            item["draft"] = False
+            item["pull_request"] = {
+                "url": f"{API}/repos/{ORG}/{spec.repo}/pulls/{spec.number}",
+                "merged_at": item["closed_at"] if merged else None,
+            }
+        return format_issue(item)
+
+    def event_id(self, spec, n):
+        return EVENT_ID_BASE + spec.id % 10_000_000 * (MAX_EVENTS + 1) + n
+
+    def timeline(self, spec):
+        """Timeline API events of an issue or PR."""
+        rng = self.spec_rng(spec)
+        kinds, weights = zip(*(PR_EVENTS if spec.kind == "pr" else ISSUE_EVENTS))
+        at = spec.created_at
+        events = []
+        for n in range(spec.n_events):
+            at += timedelta(minutes=rng.randint(1, 60 * 24 * 3))
+            actor = self.user(self.skewed(rng, self.users))
+            event = {
+                "id": self.event_id(spec, n),
+                "node_id": f"E_{spec.id}_{n}",
+                "event": rng.choices(kinds, weights)[0],
+                "actor": actor,
+                "created_at": ts(at),
+            }
+            if event["event"] == "commented":
+                event["body"] = "y" * rng.randint(10, 800)
+                event["updated_at"] = ts(at)
+                event["author_association"] = self.association(
+                    actor["id"] - USER_ID_BASE
+                )
+                event["reactions"] = {"total_count": 0, "+1": rng.randint(0, 3)}
+            elif event["event"] in ("labeled", "unlabeled"):
+                event["label"] = {"name": rng.choice(LABELS), "color": "ededed"}
+            elif event["event"] == "reviewed":
+                event["user"] = event.pop("actor")
+                event["submitted_at"] = event.pop("created_at")
+                event["state"] = rng.choice(["approved", "commented"])
+            events.append(event)
+        if spec.kind == "pr" and spec.closed and rng.random() < 0.7:
+            events.append(
+                {
+                    "id": self.event_id(spec, MAX_EVENTS),
+                    "node_id": f"E_{spec.id}_merged",
+                    "event": "merged",
+                    "actor": self.user(rng.randrange(self.members)),
+                    "created_at": ts(at + timedelta(minutes=5)),
+                }
+            )
+        return events
+
+    def event_records(self, spec):
+        return [
+            format_event(event, spec.id, ORG, spec.repo)
+            for event in self.timeline(spec)
+        ]
+
+    def poll_records(self, spec):
+        pages = max(1, math.ceil((spec.n_events + 1) / 100))
+        updated_at = self.item(spec)["updated_at"]
+        return [
+            {
+                "id": spec.id,
+                "page_no": page_no,
+                "issue_updated_at": updated_at,
+                "etag": 'W/"'
+                + hashlib.md5(f"{spec.id}-{page_no}".encode()).hexdigest()
+                + '"',
+            }
+            for page_no in range(1, pages + 1)
+        ]
+
+    def twin(self, spec, idx):
+        """The issue a transfer leaves behind: same author and creation
+        time in another repo, newer id."""
+        repo = self.repos[(self.repos.index(spec.repo) + 1) % len(self.repos)]
+        return spec._replace(
+            id=ISSUE_ID_BASE * 2 + idx, number=100_000 + idx, repo=repo, n_events=0
+        )
+
+    def transfer_record(self, spec, twin):
+        old, new = self.item(spec), self.item(twin)
+        rec = to_record(Transfer, old)
+        rec.update(
+            issue_id=old["id"],
+            new_issue_id=new["id"],
+            new_repo=new["repo"],
+            new_url=new["url"],
+            new_html_url=new["html_url"],
+            new_number=new["number"],
+        )
+        return rec
+
+    def member_records(self, inactive_rate=0.2):
+        for idx in range(self.members):
+            rec = to_record(Member, self.user(idx))
+            rec["inactive"] = self.rng.random() < inactive_rate
+            rec["inactive_dt"] = self.end_dt if rec["inactive"] else None
+            yield rec
+
+    def interval_records(self, members):
+        for rec in members:
+            joined_at = self.start_dt + timedelta(days=self.rng.randint(0, 365 * 3))
+            yield {
+                "member_id": rec["id"],
+                "joined_at": joined_at,
+                "left_at": rec["inactive_dt"],
+                "login": rec["login"],
+            }
+
+
+def generate(
+    db,
+    gen,
+    issues=10000,
+    prs=5000,
+    duplicate_rate=0.01,
+    transfer_rate=0.5,
+):
+    """Generate and load a dataset.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        gen (Generator): generator
+        issues (int, optional): Defaults to 10000.
+        prs (int, optional): Defaults to 5000.
+        duplicate_rate (float, optional): share of issues with a transfer
+        twin. Defaults to 0.01.
+        transfer_rate (float, optional): share of twins already recorded
+        as transfers. Defaults to 0.5.
+
+    Returns:
+        dict: rows loaded per table
+    """
+    specs = list(gen.specs(issues, prs))
+    rng = random.Random(f"{gen.seed}-twins")
+
+    twins, transferred = [], set()
+    for spec in specs:
+        if spec.kind == "issue" and rng.random() < duplicate_rate:
+            twin = gen.twin(spec, len(twins))
+            twins.append((spec, twin))
+            if rng.random() < transfer_rate:
+                transferred.add(spec.id)
+
+    issue_specs = [
+        spec for spec in specs if spec.kind == "issue" and spec.id not in transferred
+    ] + [twin for _, twin in twins]
+    pr_specs = [spec for spec in specs if spec.kind == "pr"]
+    all_specs = issue_specs + pr_specs
+
+    counts = {}
+
+    def load(db_model, recs):
+        counts[db_model.__tablename__] = bulk_upsert(db, db_model, recs)
+        db.commit()
+        print(f"{db_model.__tablename__}: {counts[db_model.__tablename__]}")
+
+    load(Issue, (to_record(Issue, gen.item(spec)) for spec in issue_specs))
+    load(PullRequest, (to_record(PullRequest, gen.item(spec)) for spec in pr_specs))
+    load(Event, (rec for spec in all_specs for rec in gen.event_records(spec)))
+    load(EventPoll, (rec for spec in all_specs for rec in gen.poll_records(spec)))
+    load(
+        Transfer,
+        (
+            gen.transfer_record(spec, twin)
+            for spec, twin in twins
+            if spec.id in transferred
+        ),
+    )
+    members = list(gen.member_records())
+    load(Member, members)
+    load(MemberInterval, gen.interval_records(members))
+
+    db.close()
+    return counts
+
+
+def write_archive(gen, path, issues=10000, prs=5000):
+    """Write the issues and PRs as recorded search items, one JSON object
+    per line (gzipped for `.gz` paths).
+
+    Returns:
+        int: number of items written
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    written = 0
+    with opener(path, "wt") as f:
+        for spec in gen.specs(issues, prs):
+            f.write(json.dumps(gen.item(spec)) + "\n")
+            written += 1
+    print(f"{written} items written to {path}")
+    return written
+
+
+def add_dataset_arguments(parser):
+    parser.add_argument("--issues", type=int, default=10000)
+    parser.add_argument("--prs", type=int, default=5000)
+    parser.add_argument("--events-per-issue", type=float, default=20)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--members", type=int, default=300)
+    parser.add_argument("--skew", type=float, default=1.2)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def generator_from_args(args):
+    return Generator(
+        seed=args.seed,
+        users=args.users,
+        members=args.members,
+        skew=args.skew,
+        events_per_issue=args.events_per_issue,
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    from dotenv import load_dotenv
+
+    from chalicelib.models import create_all, create_db_session
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic dataset.")
+    add_dataset_arguments(parser)
+    parser.add_argument("--duplicate-rate", type=float, default=0.01)
+    parser.add_argument("--transfer-rate", type=float, default=0.5)
+    parser.add_argument("--create", action="store_true", help="create tables first")
+    parser.add_argument(
+        "--archive", help="write search items to this JSON-lines file instead"
+    )
+    args = parser.parse_args()
+
+    if args.archive:
+        write_archive(generator_from_args(args), args.archive, args.issues, args.prs)
+        raise SystemExit
+
+    load_dotenv()
+
+    # never point this at the production database
+    db_url = os.getenv("BENCH_DB_URL")
+    if args.create:
+        create_all(db_url)
+    db = create_db_session(db_url)
+
+    gen = generator_from_args(args)
+    generate(db, gen, args.issues, args.prs, args.duplicate_rate, args.transfer_rate)
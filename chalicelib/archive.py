@@ -0,0 +1,200 @@
+"""
+    archive.py
+    ~~~~~~~~~~
+
+    Offline ingest of JSON-lines archives (plain or gzip), without
+    any API requests. Each line is one of:
+
+    - a GH Archive event (`IssuesEvent`, `IssueCommentEvent`,
+      `PullRequestEvent`, `PullRequestReviewEvent`)
+    - a recorded search API item (issue or PR)
+    - a recorded Timeline API event with `issue_id`, `org` and `repo` added
+
+    Lines are read incrementally, filtered to `REPOS`, normalized the
+    same way as webhooks and API responses, and written in batches
+    through the bulk loader.
+
+    python -m chalicelib.archive 2023-01-01-*.json.gz recorded.jsonl
+
+"""
+import gzip
+import json
+
+try:
+    from chalicelib.bulk import bulk_upsert
+    from chalicelib.constants import REPOS, TRACKED_ISSUE_EVENTS
+    from chalicelib.github import ORG, format_issue
+    from chalicelib.models import (
+        Event,
+        Issue,
+        PullRequest,
+        create_db_session,
+        to_record,
+    )
+    from chalicelib.nrt import format_event
+    from chalicelib.webhooks import normalize_event, write_batch
+except ModuleNotFoundError:
+    from bulk import bulk_upsert
+    from constants import REPOS, TRACKED_ISSUE_EVENTS
+    from github import ORG, format_issue
+    from models import Event, Issue, PullRequest, create_db_session, to_record
+    from nrt import format_event
+    from webhooks import normalize_event, write_batch
+
+
+# GH Archive event type -> webhook event name
+ARCHIVE_EVENT_TYPES = {
+    "IssuesEvent": "issues",
+    "IssueCommentEvent": "issue_comment",
+    "PullRequestEvent": "pull_request",
+    "PullRequestReviewEvent": "pull_request_review",
+}
+
+BATCH_SIZE = 5000
+
+
+def read_archive(path, counts=None):
+    """Yield one JSON object per line of a (gzipped) JSON-lines file.
+    Blank lines are skipped; malformed lines and lines that are not
+    objects are skipped and counted.
+
+    Args:
+        path (str): file path, gzip if it ends with `.gz`
+        counts (dict, optional): `skipped` is incremented per skipped
+        line. Defaults to None.
+
+    Yields:
+        dict: parsed line
+    """
+    counts = {} if counts is None else counts
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                obj, reason = None, "invalid json"
+            else:
+                reason = "not an object"
+            if not isinstance(obj, dict):
+                counts["skipped"] = counts.get("skipped", 0) + 1
+                print(f"{path}:{line_no} skipped, {reason}.")
+                continue
+            yield obj
+
+
+def normalize_archive_event(obj):
+    """Messages for a GH Archive event, via the webhook normalizers.
+    GH Archive payloads carry the repo at the top level instead of a
+    `repository` object.
+
+    Returns:
+        [dict]: messages for `write_batch`
+    """
+    event_type = ARCHIVE_EVENT_TYPES.get(obj["type"])
+    if not event_type:
+        return []
+
+    org, _, repo = obj["repo"]["name"].partition("/")
+    if org != ORG:
+        return []
+
+    payload = dict(obj["payload"])
+    payload["repository"] = {
+        "name": repo,
+        "owner": {"login": org},
+        "url": f"https://api.github.com/repos/{org}/{repo}",
+    }
+    return normalize_event(event_type, payload)
+
+
+def normalize_line(obj):
+    """Normalize one archive line into messages for `write_batch`.
+
+    Args:
+        obj (dict): parsed line
+
+    Returns:
+        [dict]: messages, empty for untracked repos and unknown lines
+    """
+    if "type" in obj and "payload" in obj:
+        return normalize_archive_event(obj)
+
+    if "repository_url" in obj and "number" in obj:
+        rec = format_issue(obj)
+        if rec["org"] != ORG or rec["repo"] not in REPOS:
+            return []
+        if "pull_request" in rec:
+            return [{"model": "pull_requests", "record": to_record(PullRequest, rec)}]
+        return [{"model": "issues", "record": to_record(Issue, rec)}]
+
+    if "event" in obj and "issue_id" in obj:
+        if obj["repo"] not in REPOS or obj["event"] not in TRACKED_ISSUE_EVENTS:
+            return []
+        if not obj.get("id"):
+            return []
+        if "actor" in obj or "submitted_at" in obj:
+            rec = format_event(obj, obj["issue_id"], obj["org"], obj["repo"])
+        else:
+            rec = to_record(Event, obj)
+        return [{"model": "events", "record": rec}]
+
+    return []
+
+
+def ingest_archive(db, paths, batch_size=BATCH_SIZE):
+    """Stream archives into the DB, `batch_size` messages at a time.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        paths ([str]): archive file paths
+        batch_size (int, optional): Defaults to BATCH_SIZE.
+
+    Returns:
+        dict: number of records written per table
+    """
+    counts = {"lines": 0, "skipped": 0}
+    messages = []
+
+    def flush():
+        written = write_batch(db, messages, loader=bulk_upsert)
+        for name, count in written.items():
+            counts[name] = counts.get(name, 0) + count
+        messages.clear()
+
+    for path in paths:
+        print(f"ingesting {path}...")
+        for obj in read_archive(path, counts):
+            counts["lines"] += 1
+            messages.extend(normalize_line(obj))
+            if len(messages) >= batch_size:
+                flush()
+
+    if messages:
+        flush()
+
+    db.close()
+    print(f"archive ingest finished. {counts}")
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description="Ingest JSON-lines archives.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    db_url = os.getenv("DB_URL")
+    db = create_db_session(db_url)
+
+    ingest_archive(db, args.paths, batch_size=args.batch_size)
@@ -1,104 +1,414 @@
 """
     backfill.py
-    ~~~~~~
+    ~~~~~~~~~~~
 
+    Resumable backfill of historical issues and PRs.
+
+    Work is planned as units of (kind, repo, date slice) and recorded in
+    `backfill_units`. Units run in parallel under the rate governor of the
+    shared API client, upsert their results and are marked done, so an
+    interrupted run picks up where it stopped. Slices that match more
+    results than the search API returns are split in half.
+
+    Timeline events are backfilled per stored issue, oldest first, with
+    progress recorded in `event_backfills`.
+
+    python -m chalicelib.backfill --repo amplify-js --start 2017-01-01
+    python -m chalicelib.backfill --repo amplify-js --events
+    python -m chalicelib.backfill --repo amplify-js --dry-run
 
 """
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from chalicelib.bulk import bulk_upsert
 from chalicelib.constants import REPOS
-from chalicelib.github import GitHubAPI, get_issues, create_db_session
-from chalicelib.models import Issue, PullRequest
+from chalicelib.github import (
+    SEARCH_RESULT_LIMIT,
+    GitHubAPI,
+    RateGovernor,
+    search_issues,
+)
+from chalicelib.issue_metrics import refresh_issue_metrics
+from chalicelib.membership import stamp_records
+from chalicelib.models import (
+    BackfillUnit,
+    EventBackfill,
+    EventPoll,
+    Issue,
+    PullRequest,
+    create_db_session,
+    to_record,
+    upsert_records,
+)
+from chalicelib.nrt import TimelineAPI, create_or_update_events, get_timeline_events
 
 
 ORG = "aws-amplify"
 
+# core requests left untouched by the event backfill
+# for the scheduled jobs sharing the token
+EVENT_BACKFILL_RESERVE = 1000
+
+KINDS = {
+    "issue": Issue,
+    "pr": PullRequest,
+}
+
+# unit statuses that still need work
+OPEN_STATUSES = ["pending", "running", "failed"]
+
 
-PERIODS = [
-    ("2017-01-01", "2017-03-31"),  # q1
-    ("2017-04-01", "2017-06-30"),  # q2
-    ("2017-07-01", "2017-09-30"),  # q3
-    ("2017-10-01", "2017-12-31"),  # q4
-    #
-    ("2018-01-01", "2018-03-31"),
-    ("2018-04-01", "2018-06-30"),
-    ("2018-07-01", "2018-09-30"),
-    ("2018-10-01", "2018-12-31"),
-    #
-    ("2019-01-01", "2019-03-31"),  # q1
-    ("2019-04-01", "2019-06-30"),  # q2
-    ("2019-07-01", "2019-09-30"),  # q3
-    ("2019-10-01", "2019-12-31"),  # q4
-    #
-    ("2020-01-01", "2020-03-31"),
-    ("2020-04-01", "2020-06-30"),
-    ("2020-07-01", "2020-09-30"),
-    ("2020-10-01", "2020-12-31"),
-    #
-    ("2021-01-01", "2021-03-31"),
-    ("2021-04-01", "2021-06-30"),
-    ("2021-07-01", "2021-09-30"),
-    ("2021-10-01", "2021-12-31"),
-]
-
-
-def backfill_pr_queries():
-    """Generate historical GitHub queries for PRs
+def plan_slices(start_dt, end_dt, months=3):
+    """Split a date range into slices of `months` calendar months.
+
+    Args:
+        start_dt (date): first day
+        end_dt (date): last day
+        months (int, optional): Defaults to 3 (quarters).
 
     Returns:
-        list: list of queries
+        [(date, date)]: inclusive (start, end) slices
     """
-    queries = []
-    for repo in REPOS:
-        for period in PERIODS:
-            queries += [f"repo:{ORG}/{repo} is:pr created:{period[0]}..{period[1]}"]
-    return queries
+    slices = []
+    while start_dt <= end_dt:
+        month = start_dt.month - 1 + months
+        next_dt = date(start_dt.year + month // 12, month % 12 + 1, 1)
+        slices.append((start_dt, min(next_dt - timedelta(days=1), end_dt)))
+        start_dt = next_dt
+    return slices
+
+
+def unit_key(kind, repo, start_dt, end_dt):
+    return f"{kind}:{repo}:{start_dt}..{end_dt}"
+
 
+def plan_backfill(db, repos=REPOS, kinds=KINDS, start_dt=None, end_dt=None, months=3):
+    """Record backfill units. Units that already exist (done or not)
+    are left untouched, so planning again is safe.
 
-def backfill_issue_queries():
-    """Generate historical GitHub queries for issues
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        repos ([str], optional): Defaults to REPOS.
+        kinds ([str], optional): "issue" and/or "pr". Defaults to both.
+        start_dt (date, optional): Defaults to 2017-01-01.
+        end_dt (date, optional): Defaults to today.
+        months (int, optional): slice size. Defaults to 3.
 
     Returns:
-        list: list of queries
+        int: number of units planned
     """
-    queries = []
-    for repo in REPOS:
-        for period in PERIODS:
-            queries += [f"repo:{ORG}/{repo} is:issue created:{period[0]}..{period[1]}"]
-    return queries
+    start_dt = start_dt or date(2017, 1, 1)
+    end_dt = end_dt or date.today()
 
+    units = [
+        {
+            "key": unit_key(kind, repo, first, last),
+            "kind": kind,
+            "repo": repo,
+            "start_dt": first,
+            "end_dt": last,
+            "status": "pending",
+            "attempts": 0,
+        }
+        for repo in repos
+        for kind in kinds
+        for first, last in plan_slices(start_dt, end_dt, months)
+    ]
+    # insert only, keep progress of existing units
+    upsert_records(db, BackfillUnit, units, update_cols=[])
+    db.commit()
+    print(f"{len(units)} backfill units planned.")
+    return len(units)
 
-def backfill_org_prs(db, gh):
-    queries = backfill_pr_queries()
-    for q in queries:
-        prs = get_issues(gh, query=q)
-        recs = [PullRequest(**rec) for rec in prs]
-        db.add_all(recs)
+
+def run_unit(Session, gh, key):
+    """Fetch and upsert one unit, recording the outcome on the unit.
+
+    Args:
+        Session (sessionmaker): session factory, one session per unit
+        gh (GitHubAPI): instance of API helper with token, shared
+        key (str): unit key
+
+    Returns:
+        str: resulting unit status
+    """
+    db = Session()
+    try:
+        unit = db.query(BackfillUnit).get(key)
+        unit.status = "running"
+        unit.attempts = (unit.attempts or 0) + 1
         db.commit()
-    db.close()
 
+        db_model = KINDS[unit.kind]
+        q = (
+            f"repo:{ORG}/{unit.repo} is:{unit.kind} "
+            f"created:{unit.start_dt}..{unit.end_dt}"
+        )
+        issues, tc = search_issues(gh, q, max_total=SEARCH_RESULT_LIMIT)
 
-def backfill_org_issues(db, gh):
-    queries = backfill_issue_queries()
-    for q in queries:
-        issues = get_issues(gh, query=q)
-        recs = [Issue(**rec) for rec in issues]
-        db.add_all(recs)
+        if len(issues) < tc:
+            if unit.start_dt == unit.end_dt:
+                raise Exception(f"{tc} results in a single day, cannot split.")
+            # too many results for one search, split in half
+            mid_dt = unit.start_dt + (unit.end_dt - unit.start_dt) / 2
+            halves = [
+                (unit.start_dt, mid_dt),
+                (mid_dt + timedelta(days=1), unit.end_dt),
+            ]
+            upsert_records(
+                db,
+                BackfillUnit,
+                [
+                    {
+                        "key": unit_key(unit.kind, unit.repo, first, last),
+                        "kind": unit.kind,
+                        "repo": unit.repo,
+                        "start_dt": first,
+                        "end_dt": last,
+                        "status": "pending",
+                        "attempts": 0,
+                    }
+                    for first, last in halves
+                ],
+                update_cols=[],
+            )
+            unit.status = "split"
+            db.commit()
+            return unit.status
+
+        bulk_upsert(
+            db,
+            db_model,
+            stamp_records(db, [to_record(db_model, rec) for rec in issues]),
+            newer_only=True,
+        )
+        refresh_issue_metrics(db, [rec["id"] for rec in issues])
+        unit.status = "done"
+        unit.row_count = len(issues)
+        unit.error = None
+        db.commit()
+        print(f"backfill unit done {key}: {len(issues)}")
+        return unit.status
+
+    except Exception as e:
+        db.rollback()
+        db.query(BackfillUnit).filter(BackfillUnit.key == key).update(
+            dict(status="failed", error=str(e)[:1000])
+        )
+        db.commit()
+        print(f"backfill unit failed {key}: {e}")
+        return "failed"
+    finally:
+        db.close()
+
+
+def run_backfill(db, gh, repos=REPOS, kinds=KINDS, max_workers=4, max_attempts=3):
+    """Run open units in parallel until none are left. Units that are
+    split are followed by their halves in the next round.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        gh (GitHubAPI): instance of API helper with token
+        repos ([str], optional): Defaults to REPOS.
+        kinds ([str], optional): Defaults to both kinds.
+        max_workers (int, optional): Defaults to 4.
+        max_attempts (int, optional): failed units are retried up to
+        this many attempts. Defaults to 3.
+
+    Returns:
+        dict: {status: number of units} for the units run
+    """
+    Session = sessionmaker(bind=db.get_bind())
+    counts = {}
+
+    while True:
+        keys = [
+            rec.key
+            for rec in db.query(BackfillUnit.key)
+            .filter(
+                BackfillUnit.status.in_(OPEN_STATUSES),
+                BackfillUnit.repo.in_(list(repos)),
+                BackfillUnit.kind.in_(list(kinds)),
+                BackfillUnit.attempts < max_attempts,
+            )
+            .order_by(BackfillUnit.start_dt)
+        ]
         db.commit()
+        if not keys:
+            break
+
+        print(f"running {len(keys)} backfill units...")
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for status in pool.map(lambda key: run_unit(Session, gh, key), keys):
+                counts[status] = counts.get(status, 0) + 1
+
     db.close()
+    print(f"backfill finished. {counts}")
+    return counts
+
+
+def backfill_issue_events(db, gh, issue, kind):
+    """Fetch and store the full timeline of one issue, filling its
+    `EventPoll` ETags, and record the outcome.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        gh (TimelineAPI): instance of TimelineAPI helper with token
+        issue (row): issue row with `id`, `org`, `repo`, `timeline_url`
+        and `updated_at`
+        kind (str): "issue" or "pr"
+
+    Returns:
+        str: resulting status
+    """
+    progress = {"issue_id": issue.id, "kind": kind, "repo": issue.repo}
+    try:
+        cache_recs = db.query(EventPoll).filter(EventPoll.id == issue.id)
+        existing_cache_ids = {f"{rec.id}-{rec.page_no}": rec for rec in cache_recs}
+
+        events = get_timeline_events(
+            db, gh, issue.id, existing_cache_ids, issue.timeline_url, issue.updated_at
+        )
+        create_or_update_events(db, events, issue.id, issue.org, issue.repo)
+        progress.update(status="done", event_count=len(events), error=None)
+    except Exception as e:
+        db.rollback()
+        # drop page ETags stored before the failure, otherwise the
+        # retry would get 304s for pages whose events were not stored
+        db.query(EventPoll).filter(EventPoll.id == issue.id).delete()
+        progress.update(status="failed", error=str(e)[:1000])
+        print(f"event backfill failed {issue.id}: {e}")
+
+    upsert_records(
+        db,
+        EventBackfill,
+        [progress],
+        update_cols=["status", "event_count", "error"],
+    )
+    db.query(EventBackfill).filter(EventBackfill.issue_id == issue.id).update(
+        dict(attempts=EventBackfill.attempts + 1)
+    )
+    db.commit()
+    return progress["status"]
+
+
+def run_event_backfill(
+    db, gh, repos=REPOS, kinds=KINDS, batch_size=100, max_attempts=3
+):
+    """Backfill timeline events for stored issues and PRs, oldest first,
+    in batches. Issues already done (or out of attempts) are skipped, so
+    the backfill resumes where it stopped.
+
+    Each batch checks the core budget first; the rate governor of `gh`
+    pauses until the reset when the budget is down to its reserve.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        gh (TimelineAPI): instance of TimelineAPI helper with token
+        repos ([str], optional): Defaults to REPOS.
+        kinds ([str], optional): Defaults to both kinds.
+        batch_size (int, optional): issues per batch. Defaults to 100.
+        max_attempts (int, optional): Defaults to 3.
+
+    Returns:
+        dict: {status: number of issues}
+    """
+    counts = {}
+    skip = select(EventBackfill.issue_id).where(
+        (EventBackfill.status == "done") | (EventBackfill.attempts >= max_attempts)
+    )
+
+    for kind in kinds:
+        db_model = KINDS[kind]
+        while True:
+            batch = (
+                db.query(
+                    db_model.id,
+                    db_model.org,
+                    db_model.repo,
+                    db_model.timeline_url,
+                    db_model.updated_at,
+                )
+                .filter(db_model.repo.in_(list(repos)), ~db_model.id.in_(skip))
+                .order_by(db_model.created_at)
+                .limit(batch_size)
+                .all()
+            )
+            if not batch:
+                break
+
+            gh.check_rate("core")
+            remaining = gh.governor.remaining("core")
+            print(f"event backfill: {len(batch)} {kind}s, {remaining} core remaining")
+
+            for issue in batch:
+                status = backfill_issue_events(db, gh, issue, kind)
+                counts[status] = counts.get(status, 0) + 1
+
+    db.close()
+    print(f"event backfill finished. {counts}")
+    return counts
+
+
+def backfill_org_prs(db, gh):
+    plan_backfill(db, kinds=["pr"])
+    run_backfill(db, gh, kinds=["pr"])
+
+
+def backfill_org_issues(db, gh):
+    plan_backfill(db, kinds=["issue"])
+    run_backfill(db, gh, kinds=["issue"])
 
 
 if __name__ == "__main__":
+    import argparse
     import os
     from dotenv import load_dotenv
 
+    parser = argparse.ArgumentParser(description="Backfill issues and PRs.")
+    parser.add_argument("--repo", action="append", help="defaults to all REPOS")
+    parser.add_argument("--kind", action="append", choices=list(KINDS))
+    parser.add_argument("--start", type=date.fromisoformat, default=date(2017, 1, 1))
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today())
+    parser.add_argument("--months", type=int, default=3, help="slice size")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--events", action="store_true", help="backfill timeline events instead"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="estimate the API cost only"
+    )
+    args = parser.parse_args()
+
     load_dotenv()
 
     token = os.getenv("GH_TOKEN")
     db_url = os.getenv("DB_URL")
 
     # ---
-    gh = GitHubAPI(token=token)
     db = create_db_session(db_url)
     # ---
 
-    # backfill_org_prs(db, gh)
-    # backfill_org_issues(db, gh)
\ No newline at end of file
+    repos = args.repo or REPOS
+    kinds = args.kind or list(KINDS)
+
+    if args.dry_run:
+        from chalicelib.planner import dry_run
+
+        args.repos, args.kinds = repos, kinds
+        dry_run(
+            db, GitHubAPI(token=token), "events" if args.events else "backfill", args
+        )
+    elif args.events:
+        gh = TimelineAPI(
+            token=token, governor=RateGovernor(reserve=EVENT_BACKFILL_RESERVE)
+        )
+        run_event_backfill(db, gh, repos, kinds)
+    else:
+        gh = GitHubAPI(token=token)
+        plan_backfill(db, repos, kinds, args.start, args.end, args.months)
+        run_backfill(db, gh, repos, kinds, max_workers=args.workers)
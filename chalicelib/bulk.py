@@ -0,0 +1,224 @@
+"""
+    bulk.py
+    ~~~~~~~
+
+    Bulk loading for large ingests (backfills, archives, catch-up runs).
+
+    On postgres with psycopg2, records are streamed with `COPY` into a
+    temporary staging table in chunks and merged into the target table
+    with one `INSERT ... SELECT ... ON CONFLICT` statement per key set.
+    Other drivers fall back to chunked multi-row upserts.
+
+"""
+import io
+import json
+from datetime import date, datetime
+from itertools import chain, islice
+
+from sqlalchemy import Boolean, Integer
+from sqlalchemy.dialects.postgresql import ARRAY, JSON, JSONB
+
+try:
+    from chalicelib import metrics
+    from chalicelib.models import INGESTED_COL, upsert_records
+except ModuleNotFoundError:
+    import metrics
+    from models import INGESTED_COL, upsert_records
+
+
+CHUNK_SIZE = 10000
+
+# staging column numbering the key sets of a load
+KEYSET_COL = "_keyset"
+
+
+def _chunks(recs, size):
+    recs = iter(recs)
+    while True:
+        chunk = list(islice(recs, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _escape(value):
+    """Escape a value for the `COPY` text format."""
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _array_literal(values):
+    """Postgres array literal of JSON values, e.g. `{"{\\"a\\": 1}"}`."""
+    items = []
+    for value in values:
+        value = json.dumps(value).replace("\\", "\\\\").replace('"', '\\"')
+        items.append(f'"{value}"')
+    return "{" + ",".join(items) + "}"
+
+
+def encode_value(col_type, value):
+    """Encode a record value as a `COPY` text field.
+
+    Args:
+        col_type (sqlalchemy type): column type
+        value: record value
+
+    Returns:
+        str: encoded field
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(col_type, ARRAY):
+        return _escape(_array_literal(value))
+    if isinstance(col_type, (JSON, JSONB)):
+        return _escape(json.dumps(value))
+    if isinstance(col_type, Boolean):
+        return "t" if value else "f"
+    # search items carry e.g. `score` as a float
+    if isinstance(col_type, Integer):
+        return str(int(value))
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return _escape(str(value))
+
+
+def _copy_chunk(cursor, staging, cols, col_types, chunk, keyset):
+    buf = io.StringIO()
+    for rec in chunk:
+        buf.write("\t".join(encode_value(col_types[col], rec[col]) for col in cols))
+        buf.write(f"\t{keyset}\n")
+    buf.seek(0)
+    col_list = ", ".join(f'"{col}"' for col in cols)
+    cursor.copy_expert(f'COPY {staging} ({col_list}, "{KEYSET_COL}") FROM STDIN', buf)
+
+
+def _merge_sql(name, staging, pk_cols, col_types, cols, update_cols, newer_only):
+    """`INSERT ... SELECT ... ON CONFLICT` of one key set of the staging
+    table (`%(keyset)s`)."""
+    col_list = ", ".join(f'"{col}"' for col in cols)
+    pk_list = ", ".join(f'"{col}"' for col in pk_cols)
+    order = (
+        f'{pk_list}, "updated_at" DESC NULLS LAST' if "updated_at" in cols else pk_list
+    )
+
+    if update_cols is None:
+        update_cols = [col for col in cols if col not in pk_cols]
+    update_cols = [col for col in update_cols if col in cols]
+
+    if update_cols:
+        sets = ", ".join(f'"{col}" = EXCLUDED."{col}"' for col in update_cols)
+        if INGESTED_COL in col_types:
+            sets += f', "{INGESTED_COL}" = now()'
+        conflict = f"DO UPDATE SET {sets}"
+        if newer_only and "updated_at" in cols:
+            conflict += f' WHERE {name}."updated_at" < EXCLUDED."updated_at"'
+    else:
+        conflict = "DO NOTHING"
+
+    return (
+        f"INSERT INTO {name} ({col_list}) "
+        f"SELECT DISTINCT ON ({pk_list}) {col_list} FROM {staging} "
+        f'WHERE "{KEYSET_COL}" = %(keyset)s ORDER BY {order} '
+        f"ON CONFLICT ({pk_list}) {conflict}"
+    )
+
+
+def copy_upsert(db, db_model, recs, update_cols=None, newer_only=False):
+    """Stream records through `COPY` into a staging table and merge them
+    into the target table. Records are merged per key set, so partial
+    records only update the columns they carry. Within a key set, the
+    record with the latest `updated_at` wins for duplicate keys.
+
+    Does not commit; the staging table is dropped on commit.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session (psycopg2)
+        db_model (sqlalchemy model): DB table model
+        recs (iterable[dict]): records keyed by column name
+        update_cols ([str], optional): Columns to update on conflict, an
+        empty list leaves existing rows untouched. Defaults to every
+        non-key column of the records.
+        newer_only (bool, optional): Only update rows whose stored
+        `updated_at` is older than the incoming one. Defaults to False.
+
+    Returns:
+        int: number of rows inserted or updated
+    """
+    table = db_model.__table__
+    name = table.name
+    staging = f"staging_{name}"
+    pk_cols = [col.name for col in table.primary_key.columns]
+    col_types = {col.name: col.type for col in table.columns}
+
+    chunks = _chunks(recs, CHUNK_SIZE)
+    first = next(chunks, None)
+    if first is None:
+        return 0
+
+    keysets = {}
+    loaded = 0
+    merged = 0
+    with db.connection().connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {staging} "
+            f"(LIKE {name} INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        cursor.execute(
+            f'ALTER TABLE {staging} ADD COLUMN IF NOT EXISTS "{KEYSET_COL}" integer'
+        )
+        cursor.execute(f"TRUNCATE {staging}")
+
+        for chunk in chain([first], chunks):
+            groups = {}
+            for rec in chunk:
+                cols = tuple(col for col in rec if col in col_types)
+                groups.setdefault(frozenset(cols), (cols, []))[1].append(rec)
+            for key, (cols, group) in groups.items():
+                keyset = keysets.setdefault(key, (len(keysets), cols))[0]
+                _copy_chunk(cursor, staging, keysets[key][1], col_types, group, keyset)
+            loaded += len(chunk)
+
+        for keyset, cols in keysets.values():
+            cursor.execute(
+                _merge_sql(
+                    name, staging, pk_cols, col_types, cols, update_cols, newer_only
+                ),
+                {"keyset": keyset},
+            )
+            merged += cursor.rowcount
+
+    print(f"{loaded} recs copied, {merged} {name} rows merged.")
+    metrics.record_rows(name, upserted=merged, skipped=max(loaded - merged, 0))
+    return merged
+
+
+def bulk_upsert(db, db_model, recs, update_cols=None, newer_only=False):
+    """Upsert a large number of records. Uses `COPY` where the driver
+    supports it (see `copy_upsert`) and chunked `upsert_records`
+    otherwise.
+
+    Does not commit; the caller owns the transaction.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        db_model (sqlalchemy model): DB table model
+        recs (iterable[dict]): records keyed by column name
+        update_cols ([str], optional): see `upsert_records`
+        newer_only (bool, optional): see `upsert_records`
+
+    Returns:
+        int: number of records written
+    """
+    dialect = db.get_bind().dialect
+
+    if dialect.name == "postgresql" and dialect.driver == "psycopg2":
+        return copy_upsert(db, db_model, recs, update_cols, newer_only)
+
+    count = 0
+    for chunk in _chunks(recs, CHUNK_SIZE):
+        count += upsert_records(db, db_model, chunk, update_cols, newer_only)
+    return count
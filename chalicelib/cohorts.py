@@ -0,0 +1,491 @@
+"""
+    cohorts.py
+    ~~~~~~~~~~
+
+    Batch metrics over columnar extracts, for ad-hoc analysis.
+
+    `load_extract` streams issues, PRs, response events and membership
+    intervals out of the DB once into NumPy arrays (strings become
+    integer codes). Metrics are then computed with array operations
+    instead of per-row Python loops or per-query joins:
+
+    - `item_metrics`: first maintainer response, close and merge times
+      and team/community comment counts per issue and PR, the same
+      definitions as `issue_metrics`
+    - `retention_cohorts`: contributors by the month of their first
+      activity, and how many of them are active N months later
+
+    Results can be written back to `issue_metrics` or exported as CSV.
+    NumPy is only needed here and is not deployed with the Lambdas:
+
+    pip install numpy
+    python -m chalicelib.cohorts --repo amplify-js --out-dir /tmp/cohorts
+
+"""
+import csv
+import os
+
+from sqlalchemy.sql import text
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from chalicelib.bulk import bulk_upsert
+    from chalicelib.issue_metrics import COMMENT_EVENTS, RESPONSE_EVENTS
+    from chalicelib.models import IssueMetric
+except ModuleNotFoundError:
+    from bulk import bulk_upsert
+    from issue_metrics import COMMENT_EVENTS, RESPONSE_EVENTS
+    from models import IssueMetric
+
+# rows fetched per round trip while streaming an extract
+FETCH_SIZE = 10000
+
+# `repos` is null for all repos
+EXTRACT_ITEMS_STMT = text(
+    """
+SELECT
+	id, 'issue' AS kind, org, repo, number, username, created_at, closed_at,
+	CAST(NULL AS timestamp) AS merged_at
+FROM
+	public.issues
+WHERE
+	CAST(:repos AS varchar[]) IS NULL OR repo = ANY(CAST(:repos AS varchar[]))
+UNION ALL
+SELECT
+	id, 'pr', org, repo, number, username, created_at, closed_at,
+	CASE WHEN merged THEN coalesce(
+		CAST(pull_request ->> 'merged_at' AS timestamptz) AT TIME ZONE 'UTC',
+		closed_at) END
+FROM
+	public.pull_requests
+WHERE
+	CAST(:repos AS varchar[]) IS NULL OR repo = ANY(CAST(:repos AS varchar[]));
+"""
+)
+
+EXTRACT_EVENTS_STMT = text(
+    """
+SELECT
+	issue_id, event, username, created_at
+FROM
+	public.events
+WHERE
+	event = ANY(CAST(:events AS varchar[]))
+	AND (CAST(:repos AS varchar[]) IS NULL OR repo = ANY(CAST(:repos AS varchar[])));
+"""
+)
+
+EXTRACT_INTERVALS_STMT = text(
+    """
+SELECT
+	login, joined_at, left_at
+FROM
+	public.member_intervals;
+"""
+)
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("chalicelib.cohorts needs numpy: pip install numpy")
+
+
+class Vocab:
+    """Dense integer codes of strings, shared by the columns of an
+    extract so that codes compare across tables."""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode(self, values):
+        return np.fromiter(
+            (self.code(value) for value in values), dtype=np.int32, count=len(values)
+        )
+
+    def decode(self, codes):
+        return [self.values[code] if code >= 0 else None for code in codes]
+
+
+class Extract:
+    """Columnar extract of the tables the metrics are computed from.
+
+    Attributes:
+        items (dict): id, kind, org, repo, number, author, created_at,
+        closed_at, merged_at
+        events (dict): issue_id, event, user, created_at
+        intervals (dict): login, joined_at, left_at (open intervals end
+        at the maximum timestamp)
+        users, repos, labels (Vocab): codes of logins, org/repo names
+        and kinds/event types
+    """
+
+    def __init__(self):
+        self.users = Vocab()
+        self.repos = Vocab()
+        self.labels = Vocab()
+        self.items = {}
+        self.events = {}
+        self.intervals = {}
+
+    def __len__(self):
+        return len(self.items.get("id", ()))
+
+
+def _fetch_columns(db, stmt, params=None):
+    """Stream a query into one list per column."""
+    result = (
+        db.connection().execution_options(stream_results=True).execute(stmt, params)
+    )
+    columns = {key: [] for key in result.keys()}
+    lists = list(columns.values())
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for col, values in zip(lists, zip(*rows)):
+            col.extend(values)
+    return columns
+
+
+def _timestamps(values):
+    # None becomes NaT
+    return np.array(values, dtype="datetime64[s]")
+
+
+def load_extract(db, repos=None):
+    """Load issues, PRs, response/comment events and membership
+    intervals into an `Extract`.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        repos ([str], optional): Defaults to None (all repos).
+
+    Returns:
+        Extract: columnar extract
+    """
+    require_numpy()
+    extract = Extract()
+    repos = list(repos) if repos else None
+    events = sorted(set(RESPONSE_EVENTS) | set(COMMENT_EVENTS))
+
+    cols = _fetch_columns(db, EXTRACT_ITEMS_STMT, {"repos": repos})
+    extract.items = {
+        "id": np.array(cols["id"], dtype=np.int64),
+        "kind": extract.labels.encode(cols["kind"]),
+        "org": extract.repos.encode(cols["org"]),
+        "repo": extract.repos.encode(cols["repo"]),
+        "number": np.array(cols["number"], dtype=np.int64),
+        "author": extract.users.encode(cols["username"]),
+        "created_at": _timestamps(cols["created_at"]),
+        "closed_at": _timestamps(cols["closed_at"]),
+        "merged_at": _timestamps(cols["merged_at"]),
+    }
+
+    cols = _fetch_columns(db, EXTRACT_EVENTS_STMT, {"events": events, "repos": repos})
+    extract.events = {
+        "issue_id": np.array(cols["issue_id"], dtype=np.int64),
+        "event": extract.labels.encode(cols["event"]),
+        "user": extract.users.encode(cols["username"]),
+        "created_at": _timestamps(cols["created_at"]),
+    }
+
+    cols = _fetch_columns(db, EXTRACT_INTERVALS_STMT)
+    left_at = _timestamps(cols["left_at"])
+    extract.intervals = {
+        "login": extract.users.encode(cols["login"]),
+        "joined_at": _timestamps(cols["joined_at"]),
+        "left_at": np.where(
+            np.isnat(left_at), np.datetime64("9999-12-31T00:00:00", "s"), left_at
+        ),
+    }
+    db.rollback()
+    print(
+        f"extract loaded: {len(extract)} items, "
+        f"{len(extract.events['issue_id'])} events, "
+        f"{len(extract.intervals['login'])} intervals."
+    )
+    return extract
+
+
+def _key(codes, ts):
+    # (login, time) as one sortable int64; seconds fit in 32 bits
+    return (codes.astype(np.int64) << 32) + ts.astype(np.int64)
+
+
+def is_member(extract, users, ts):
+    """Whether each user was an org member at the matching timestamp.
+
+    Args:
+        extract (Extract): extract with intervals
+        users (ndarray): user codes
+        ts (ndarray): datetime64[s]
+
+    Returns:
+        ndarray: bool
+    """
+    iv = extract.intervals
+    if not len(iv["login"]) or not len(users):
+        return np.zeros(len(users), dtype=bool)
+
+    order = np.lexsort((iv["joined_at"], iv["login"]))
+    login, joined_at, left_at = (
+        iv["login"][order],
+        iv["joined_at"][order],
+        iv["left_at"][order],
+    )
+    # latest interval of the same login that started at or before ts
+    idx = np.searchsorted(_key(login, joined_at), _key(users, ts), side="right") - 1
+    found = idx >= 0
+    idx = np.maximum(idx, 0)
+    return found & (login[idx] == users) & (left_at[idx] > ts)
+
+
+def _seconds(end, start):
+    delta = (end - start).astype("timedelta64[s]")
+    return np.where(np.isnat(delta), np.nan, delta.astype(np.int64).astype(float))
+
+
+def _item_index(extract, issue_ids):
+    """Position in `extract.items` of each issue id, -1 when not loaded."""
+    ids = extract.items["id"]
+    if not len(ids):
+        return np.full(len(issue_ids), -1)
+    order = np.argsort(ids)
+    pos = np.minimum(np.searchsorted(ids[order], issue_ids), len(ids) - 1)
+    return np.where(ids[order][pos] == issue_ids, order[pos], -1)
+
+
+def item_metrics(extract):
+    """Per-item response metrics, see `issue_metrics` for the definitions.
+
+    Returns:
+        dict: arrays aligned with `extract.items`: first_response_at,
+        first_responder (user code, -1 when none), first_response_seconds,
+        close_seconds, merge_seconds (nan when not applicable),
+        team_comments, community_comments
+    """
+    require_numpy()
+    items, events = extract.items, extract.events
+    n = len(extract)
+
+    item_idx = _item_index(extract, events["issue_id"])
+    loaded = item_idx >= 0
+    idx = item_idx[loaded]
+    event, user, ts = (
+        events["event"][loaded],
+        events["user"][loaded],
+        events["created_at"][loaded],
+    )
+    team = is_member(extract, user, ts)
+
+    response_codes = [extract.labels.code(name) for name in RESPONSE_EVENTS]
+    comment_codes = [extract.labels.code(name) for name in COMMENT_EVENTS]
+
+    # earliest response per item: sort by (item, time), first of each item
+    response = np.isin(event, response_codes) & team & (user != items["author"][idx])
+    r_idx, r_ts, r_user = idx[response], ts[response], user[response]
+    order = np.lexsort((r_ts, r_idx))
+    r_idx, r_ts, r_user = r_idx[order], r_ts[order], r_user[order]
+    first_idx, first = np.unique(r_idx, return_index=True)
+
+    first_response_at = np.full(n, np.datetime64("NaT"), dtype="datetime64[s]")
+    first_response_at[first_idx] = r_ts[first]
+    first_responder = np.full(n, -1, dtype=np.int32)
+    first_responder[first_idx] = r_user[first]
+
+    comment = np.isin(event, comment_codes)
+    return {
+        "first_response_at": first_response_at,
+        "first_responder": first_responder,
+        "first_response_seconds": _seconds(first_response_at, items["created_at"]),
+        "close_seconds": _seconds(items["closed_at"], items["created_at"]),
+        "merge_seconds": _seconds(items["merged_at"], items["created_at"]),
+        "team_comments": np.bincount(idx[comment & team], minlength=n),
+        "community_comments": np.bincount(idx[comment & ~team], minlength=n),
+    }
+
+
+def retention_cohorts(extract, months=12, community_only=True):
+    """Contributors grouped by the month of their first activity
+    (opening an issue or PR, commenting, reviewing), and the number of
+    them active in each following month.
+
+    Args:
+        extract (Extract): columnar extract
+        months (int, optional): months followed per cohort. Defaults to 12.
+        community_only (bool, optional): only count activity of
+        non-members (at the time). Defaults to True.
+
+    Returns:
+        tuple: (cohort months as datetime64[M], counts ndarray of shape
+        (cohorts, months)); counts[c, 0] is the size of cohort c
+    """
+    require_numpy()
+    items, events = extract.items, extract.events
+    comment_codes = [extract.labels.code(name) for name in COMMENT_EVENTS]
+    comment = np.isin(events["event"], comment_codes)
+
+    users = np.concatenate([items["author"], events["user"][comment]])
+    ts = np.concatenate([items["created_at"], events["created_at"][comment]])
+    keep = ~np.isnat(ts) & (users != extract.users.code(None))
+    if community_only:
+        keep &= ~is_member(extract, users, ts)
+    users, ts = users[keep], ts[keep]
+    if not len(users):
+        return np.array([], dtype="datetime64[M]"), np.zeros((0, months), dtype=int)
+
+    month = ts.astype("datetime64[M]")
+    base = month.min()
+    m = (month - base).astype(np.int64)
+    span = int(m.max()) + 1
+
+    # active (user, month) pairs, sorted by user then month
+    pairs = np.unique(users.astype(np.int64) * span + m)
+    p_user, p_month = pairs // span, pairs % span
+    _, start, count = np.unique(p_user, return_index=True, return_counts=True)
+    cohort = np.repeat(p_month[start], count)
+    offset = p_month - cohort
+
+    followed = offset < months
+    counts = np.bincount(
+        cohort[followed] * months + offset[followed], minlength=span * months
+    ).reshape(span, months)
+    return base + np.arange(span), counts
+
+
+def write_issue_metrics(db, extract, metrics=None):
+    """Upsert `item_metrics` into `issue_metrics`, e.g. to rebuild the
+    table from one extract instead of per-batch queries. Commits.
+
+    Returns:
+        int: number of rows written
+    """
+    metrics = metrics or item_metrics(extract)
+    items = extract.items
+    kinds = extract.labels.decode(items["kind"])
+    orgs = extract.repos.decode(items["org"])
+    repos = extract.repos.decode(items["repo"])
+    authors = extract.users.decode(items["author"])
+    responders = extract.users.decode(metrics["first_responder"])
+
+    def value(array, i):
+        item = array[i].item()
+        return None if item != item else item  # nan/NaT
+
+    def seconds(array, i):
+        item = value(array, i)
+        return None if item is None else int(item)
+
+    recs = (
+        {
+            "issue_id": int(items["id"][i]),
+            "kind": kinds[i],
+            "org": orgs[i],
+            "repo": repos[i],
+            "number": int(items["number"][i]),
+            "username": authors[i],
+            "created_at": value(items["created_at"], i),
+            "first_response_at": value(metrics["first_response_at"], i),
+            "first_responder": responders[i],
+            "first_response_seconds": seconds(metrics["first_response_seconds"], i),
+            "closed_at": value(items["closed_at"], i),
+            "close_seconds": seconds(metrics["close_seconds"], i),
+            "merged_at": value(items["merged_at"], i),
+            "merge_seconds": seconds(metrics["merge_seconds"], i),
+            "team_comments": int(metrics["team_comments"][i]),
+            "community_comments": int(metrics["community_comments"][i]),
+        }
+        for i in range(len(extract))
+    )
+    written = bulk_upsert(db, IssueMetric, recs)
+    db.commit()
+    return written
+
+
+def export_item_metrics(path, extract, metrics=None):
+    """Write `item_metrics` as CSV, one row per item."""
+    metrics = metrics or item_metrics(extract)
+    items = extract.items
+    columns = {
+        "issue_id": items["id"],
+        "kind": extract.labels.decode(items["kind"]),
+        "repo": extract.repos.decode(items["repo"]),
+        "number": items["number"],
+        "username": extract.users.decode(items["author"]),
+        "created_at": np.datetime_as_string(items["created_at"]),
+        "first_response_at": np.datetime_as_string(metrics["first_response_at"]),
+        "first_responder": extract.users.decode(metrics["first_responder"]),
+        "first_response_seconds": metrics["first_response_seconds"],
+        "close_seconds": metrics["close_seconds"],
+        "merge_seconds": metrics["merge_seconds"],
+        "team_comments": metrics["team_comments"],
+        "community_comments": metrics["community_comments"],
+    }
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        writer.writerows(zip(*columns.values()))
+
+
+def export_cohorts(path, cohort_months, counts):
+    """Write `retention_cohorts` as CSV, one row per cohort."""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["cohort"] + [f"m{k}" for k in range(counts.shape[1])])
+        for month, row in zip(np.datetime_as_string(cohort_months), counts):
+            writer.writerow([month] + row.tolist())
+
+
+if __name__ == "__main__":
+    import argparse
+    from dotenv import load_dotenv
+
+    from chalicelib.models import create_db_session
+
+    parser = argparse.ArgumentParser(description="Compute cohort metrics.")
+    parser.add_argument("--repo", action="append", help="defaults to all repos")
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument(
+        "--all-contributors",
+        action="store_true",
+        help="include members in the retention cohorts",
+    )
+    parser.add_argument("--out-dir", help="export CSV files to this directory")
+    parser.add_argument("--write", action="store_true", help="upsert the item metrics")
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    db = create_db_session(os.getenv("DB_URL"))
+    extract = load_extract(db, args.repo)
+    metrics = item_metrics(extract)
+    cohort_months, counts = retention_cohorts(
+        extract, args.months, community_only=not args.all_contributors
+    )
+
+    if args.write:
+        print(f"{write_issue_metrics(db, extract, metrics)} issue metrics written.")
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+        export_item_metrics(
+            os.path.join(args.out_dir, "item_metrics.csv"), extract, metrics
+        )
+        export_cohorts(
+            os.path.join(args.out_dir, "retention_cohorts.csv"), cohort_months, counts
+        )
+        print(f"exported to {args.out_dir}.")
+    else:
+        for month, row in zip(np.datetime_as_string(cohort_months), counts):
+            print(month, row.tolist())
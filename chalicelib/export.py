@@ -0,0 +1,379 @@
+"""
+    export.py
+    ~~~~~~~~~
+
+    Incremental export of `issues`, `pull_requests`, `events` and
+    `transfers` to Parquet, for analysis outside of the production DB.
+
+    Files are partitioned Hive-style by repo and month of `created_at`:
+
+        <dest>/events/repo=amplify-js/month=2024-05/part-20240601T050000-00000.parquet
+
+    Each run exports the rows ingested (`ingested_dt`) since the
+    watermark of the previous run, kept in `<dest>/_export_state.json`
+    next to the files so the export can read from a replica. Rows
+    updated since they were first exported are written again; a
+    partition with `COMPACT_MIN_FILES` files or more is compacted into
+    one file, keeping the latest version of each row. Between
+    compactions, readers keep the row with the latest `ingested_dt` per
+    primary key. Transfers have no `ingested_dt`; they are small and
+    written in full each run, as is every table with `--full`, which
+    also drops rows deleted from the DB (transferred issues).
+
+    `dest` is a local directory or an object store URI that pyarrow
+    understands, e.g. `s3://bucket/prefix` or, for a local MinIO,
+    `s3://bucket/prefix?endpoint_override=localhost:9000&scheme=http`.
+    pyarrow is only needed here and is not deployed with the Lambdas:
+
+    pip install pyarrow
+    python -m chalicelib.export --dest /data/contributor-metrics
+    python -m chalicelib.export --dest s3://bucket/contributor-metrics --full
+
+"""
+import json
+import os
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Boolean, Date, DateTime, Integer, Numeric, select
+from sqlalchemy.dialects.postgresql import ARRAY, JSON
+from sqlalchemy.sql import text
+
+try:
+    import pyarrow as pa
+    import pyarrow.fs as pafs
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    from chalicelib.models import INGESTED_COL, Event, Issue, PullRequest, Transfer
+    from chalicelib.rollups import WATERMARK_LAG
+except ModuleNotFoundError:
+    from models import INGESTED_COL, Event, Issue, PullRequest, Transfer
+    from rollups import WATERMARK_LAG
+
+EXPORT_MODELS = [Issue, PullRequest, Event, Transfer]
+
+STATE_FILE = "_export_state.json"
+
+# rows fetched per round trip while streaming a table
+FETCH_SIZE = 10000
+
+# rows per file, larger partitions are split
+ROWS_PER_FILE = 500000
+
+# files in a partition before it is compacted
+COMPACT_MIN_FILES = 8
+
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("the export needs pyarrow: pip install pyarrow")
+
+
+def _arrow_type(col_type):
+    # JSONB is a JSON
+    if isinstance(col_type, (ARRAY, JSON)):
+        return pa.string()
+    if isinstance(col_type, BigInteger):
+        return pa.int64()
+    if isinstance(col_type, Integer):
+        return pa.int32()
+    if isinstance(col_type, Boolean):
+        return pa.bool_()
+    # Float is a Numeric
+    if isinstance(col_type, Numeric):
+        return pa.float64()
+    if isinstance(col_type, DateTime):
+        return pa.timestamp("us")
+    if isinstance(col_type, Date):
+        return pa.date32()
+    return pa.string()
+
+
+def _converter(col_type):
+    """Python value -> value of the column's Arrow type."""
+    if isinstance(col_type, (ARRAY, JSON)):
+        return lambda value: None if value is None else json.dumps(value, default=str)
+    if _arrow_type(col_type) == pa.string():
+        return lambda value: None if value is None else str(value)
+    # Numeric values are Decimals
+    if isinstance(col_type, Numeric):
+        return lambda value: None if value is None else float(value)
+    return lambda value: value
+
+
+def table_schema(db_model):
+    """Arrow schema of a model's table, JSON and arrays as JSON strings."""
+    return pa.schema(
+        [(col.name, _arrow_type(col.type)) for col in db_model.__table__.columns]
+    )
+
+
+def open_dest(dest):
+    """
+    Returns:
+        (pyarrow.fs.FileSystem, str): filesystem, root path
+    """
+    if "://" not in dest:
+        dest = os.path.abspath(dest)
+    return pafs.FileSystem.from_uri(dest)
+
+
+def read_state(filesystem, root):
+    path = f"{root}/{STATE_FILE}"
+    if filesystem.get_file_info(path).type == pafs.FileType.NotFound:
+        return {}
+    with filesystem.open_input_stream(path) as f:
+        return json.loads(f.read())
+
+
+def write_state(filesystem, root, state):
+    with filesystem.open_output_stream(f"{root}/{STATE_FILE}") as f:
+        f.write(json.dumps(state, indent=2).encode())
+
+
+def _list_files(filesystem, path):
+    selector = pafs.FileSelector(path, allow_not_found=True, recursive=True)
+    return sorted(
+        info.path
+        for info in filesystem.get_file_info(selector)
+        if info.type == pafs.FileType.File and info.path.endswith(".parquet")
+    )
+
+
+class PartitionWriter:
+    """Buffers rows of one partition at a time and writes them out as
+    Parquet files. Rows must arrive grouped by partition."""
+
+    def __init__(self, filesystem, root, db_model, run_id):
+        self.filesystem = filesystem
+        self.table_dir = f"{root}/{db_model.__tablename__}"
+        self.schema = table_schema(db_model)
+        columns = db_model.__table__.columns
+        self.converters = [(col.name, _converter(col.type)) for col in columns]
+        self.run_id = run_id
+        self.partition = None
+        self.rows = []
+        self.written = {}
+        self._seq = 0
+
+    def add(self, row):
+        created_at = row["created_at"]
+        month = created_at.strftime("%Y-%m") if created_at else "none"
+        partition = f"repo={row['repo']}/month={month}"
+        if partition != self.partition or len(self.rows) >= ROWS_PER_FILE:
+            self.flush()
+            self.partition = partition
+        self.rows.append(row)
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = {
+            name: [convert(row[name]) for row in self.rows]
+            for name, convert in self.converters
+        }
+        part_dir = f"{self.table_dir}/{self.partition}"
+        self.filesystem.create_dir(part_dir, recursive=True)
+        path = f"{part_dir}/part-{self.run_id}-{self._seq:05d}.parquet"
+        pq.write_table(
+            pa.table(columns, schema=self.schema), path, filesystem=self.filesystem
+        )
+        self.written[part_dir] = self.written.get(part_dir, 0) + len(self.rows)
+        self._seq += 1
+        self.rows = []
+
+
+def _latest_rows(table, pk_cols):
+    """Keep the last row of each primary key, by `ingested_dt` then
+    file order."""
+    keys = zip(*(table.column(col).to_pylist() for col in pk_cols))
+    if INGESTED_COL in table.column_names:
+        ingested = table.column(INGESTED_COL).to_pylist()
+    else:
+        ingested = [None] * table.num_rows
+
+    latest = {}
+    for i, key in enumerate(keys):
+        j = latest.get(key)
+        if j is None or (ingested[i] or datetime.min) >= (ingested[j] or datetime.min):
+            latest[key] = i
+    return table.take(sorted(latest.values()))
+
+
+def compact_partition(filesystem, part_dir, db_model, run_id):
+    """Rewrite the files of a partition as one, without superseded rows.
+    The new file is written before the old ones are deleted.
+
+    Returns:
+        int: number of files replaced
+    """
+    paths = _list_files(filesystem, part_dir)
+    if len(paths) < 2:
+        return 0
+    tables = [
+        pq.read_table(path, filesystem=filesystem, partitioning=None) for path in paths
+    ]
+    table = pa.concat_tables(tables, promote_options="default")
+    pk_cols = [col.name for col in db_model.__table__.primary_key.columns]
+    table = _latest_rows(table, pk_cols)
+
+    # files written before a column was added lack it
+    schema = table_schema(db_model)
+    columns = [
+        table.column(field.name).cast(field.type)
+        if field.name in table.column_names
+        else pa.nulls(table.num_rows, field.type)
+        for field in schema
+    ]
+    table = pa.Table.from_arrays(columns, schema=schema)
+    pq.write_table(
+        table,
+        f"{part_dir}/part-{run_id}-compacted.parquet",
+        filesystem=filesystem,
+    )
+    for path in paths:
+        filesystem.delete_file(path)
+    return len(paths)
+
+
+def export_table(
+    db, filesystem, root, db_model, run_id, since=None, full=False, compact=False
+):
+    """Export the rows of a table ingested since `since` (all rows when
+    `full` or the table has no `ingested_dt`), then compact partitions.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        filesystem (pyarrow.fs.FileSystem): destination filesystem
+        root (str): destination root path
+        db_model (sqlalchemy model): DB table model
+        run_id (str): name prefix of the files written
+        since (datetime, optional): Defaults to None (all rows).
+        full (bool, optional): Replace the exported files. Defaults to False.
+        compact (bool, optional): Compact every partition with more than
+        one file. Defaults to False (the partitions written to, once they
+        reach `COMPACT_MIN_FILES`).
+
+    Returns:
+        dict: {"rows": int, "partitions": int, "compacted": int}
+    """
+    table = db_model.__table__
+    incremental = INGESTED_COL in table.columns and not full
+    stmt = select(table).order_by(table.c.repo, table.c.created_at)
+    if incremental and since:
+        stmt = stmt.where(table.c[INGESTED_COL] >= since)
+
+    writer = PartitionWriter(filesystem, root, db_model, run_id)
+    result = db.connection().execution_options(stream_results=True).execute(stmt)
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            writer.add(row._mapping)
+    writer.flush()
+
+    compacted = 0
+    if not incremental:
+        # files of previous runs
+        for path in _list_files(filesystem, writer.table_dir):
+            if not os.path.basename(path).startswith(f"part-{run_id}-"):
+                filesystem.delete_file(path)
+    else:
+        min_files = 2 if compact else COMPACT_MIN_FILES
+        part_dirs = writer.written.keys()
+        if compact:
+            part_dirs = {
+                os.path.dirname(path)
+                for path in _list_files(filesystem, writer.table_dir)
+            }
+        for part_dir in part_dirs:
+            if len(_list_files(filesystem, part_dir)) >= min_files:
+                compacted += compact_partition(filesystem, part_dir, db_model, run_id)
+
+    return {
+        "rows": sum(writer.written.values()),
+        "partitions": len(writer.written),
+        "compacted": compacted,
+    }
+
+
+def run_export(db, dest, tables=None, full=False, compact=False):
+    """Export each table and move its watermark in the state file.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session, can be a replica
+        dest (str): local directory or object store URI
+        tables ([str], optional): Defaults to None (`EXPORT_MODELS`).
+        full (bool, optional): Export every row. Defaults to False.
+        compact (bool, optional): Compact every partition. Defaults to False.
+
+    Returns:
+        dict: {table: {"rows": int, "partitions": int, "compacted": int}}
+    """
+    require_pyarrow()
+    filesystem, root = open_dest(dest)
+    filesystem.create_dir(root, recursive=True)
+    state = read_state(filesystem, root)
+
+    results = {}
+    for db_model in EXPORT_MODELS:
+        name = db_model.__tablename__
+        if tables and name not in tables:
+            continue
+
+        since = None
+        if state.get(name) and not full:
+            since = datetime.fromisoformat(state[name]) - WATERMARK_LAG
+
+        # transaction start, the `ingested_dt` of anything written after
+        # it is later
+        watermark = db.execute(text("SELECT CAST(now() AS timestamp)")).scalar()
+        run_id = watermark.strftime("%Y%m%dT%H%M%S")
+        results[name] = export_table(
+            db, filesystem, root, db_model, run_id, since, full, compact
+        )
+        db.rollback()
+
+        state[name] = watermark.isoformat()
+        write_state(filesystem, root, state)
+        print(f"{name} exported since {since}: {results[name]}")
+
+    db.close()
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dotenv import load_dotenv
+
+    from chalicelib.models import create_db_session
+
+    parser = argparse.ArgumentParser(description="Export tables to Parquet.")
+    parser.add_argument(
+        "--dest", required=True, help="local directory or object store URI"
+    )
+    parser.add_argument(
+        "--table",
+        action="append",
+        choices=[db_model.__tablename__ for db_model in EXPORT_MODELS],
+        help="repeatable, defaults to every table",
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="export every row, replacing the files"
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="compact every partition with more than one file",
+    )
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    # a read replica keeps the export off the primary
+    db = create_db_session(os.getenv("EXPORT_DB_URL") or os.getenv("DB_URL"))
+    run_export(db, args.dest, args.table, args.full, args.compact)
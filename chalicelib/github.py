@@ -7,18 +7,47 @@
 
 """
 
+import threading
 import time
 from datetime import date, datetime, timedelta
 
-import requests
+from sqlalchemy.sql import text
 
 try:
+    from chalicelib import metrics
     from chalicelib.constants import REPOS
-    from chalicelib.models import Issue, Member, PullRequest
+    from chalicelib.issue_metrics import refresh_issue_metrics
+    from chalicelib.membership import (
+        invalidate_membership_index,
+        restamp_authors,
+        stamp_records,
+    )
+    from chalicelib.models import (
+        Issue,
+        Member,
+        MemberInterval,
+        PullRequest,
+        SyncState,
+        to_record,
+        upsert_records,
+    )
+    from chalicelib.profiling import profile_block
     from chalicelib.utils import send_plain_email
 except ModuleNotFoundError:
+    import metrics
     from constants import REPOS
-    from models import Issue, Member, PullRequest
+    from issue_metrics import refresh_issue_metrics
+    from membership import invalidate_membership_index, restamp_authors, stamp_records
+    from models import (
+        Issue,
+        Member,
+        MemberInterval,
+        PullRequest,
+        SyncState,
+        to_record,
+        upsert_records,
+    )
+    from profiling import profile_block
     from utils import send_plain_email
 
 # from sqlalchemy.exc import IntegrityError, ProgrammingError
@@ -26,6 +55,9 @@ except ModuleNotFoundError:
 ORG = "aws-amplify"
 gh_api_version = "2022-11-28"
 
+# the search API returns at most 1000 results per query
+SEARCH_RESULT_LIMIT = 1000
+
 
 class GitHubAPIException(Exception):
     """Invalid API Server Responses"""
@@ -38,13 +70,78 @@ class GitHubAPIException(Exception):
         return f"Server Response ({self.code}): {self.resp}"
 
 
+class RateGovernor:
+    """Thread-safe rate limit budget shared by every request made with a
+    token. Tracks `remaining`/`reset` per bucket (`core`, `search`, ...)
+    from response headers and blocks callers once a bucket is down to
+    `reserve` until it resets.
+    """
+
+    def __init__(self, reserve=0):
+        self.reserve = reserve
+        self.limits = {}
+        self.lock = threading.Lock()
+
+    def set(self, bucket, remaining, reset):
+        with self.lock:
+            self.limits[bucket] = [int(remaining), int(reset)]
+
+    def update(self, headers):
+        """Record the budget reported by a response.
+
+        Args:
+            headers (dict): response headers
+        """
+        remaining = headers.get("x-ratelimit-remaining")
+        if remaining is None:
+            return
+        self.set(
+            headers.get("x-ratelimit-resource", "core"),
+            remaining,
+            headers.get("x-ratelimit-reset", 0),
+        )
+
+    def remaining(self, bucket):
+        with self.lock:
+            limit = self.limits.get(bucket)
+            if not limit or limit[1] <= time.time():
+                return None
+            return limit[0]
+
+    def acquire(self, bucket="core"):
+        """Take one request from a bucket, waiting for the reset if the
+        budget is spent.
+
+        Args:
+            bucket (str, optional): rate limit resource. Defaults to "core".
+        """
+        while True:
+            with self.lock:
+                limit = self.limits.get(bucket)
+                now = time.time()
+                if not limit or limit[1] <= now:
+                    return
+                if limit[0] > self.reserve:
+                    limit[0] -= 1
+                    return
+                pause = (limit[1] - now) + 3
+            print(f"...waiting for {pause} seconds.")
+            time.sleep(pause)
+            print("...resuming.")
+
+
 class GitHubAPI:
     def __init__(
-        self, gh_api="https://api.github.com", gh_api_version="2022-11-28", token=None
+        self,
+        gh_api="https://api.github.com",
+        gh_api_version="2022-11-28",
+        token=None,
+        governor=None,
     ):
         self.gh_api = gh_api
         self.gh_api_version = gh_api_version
         self._token = token
+        self.governor = governor or RateGovernor()
 
     @property
     def token(self):
@@ -79,22 +176,63 @@ class GitHubAPI:
         if media_type:
             headers["Accept"] = "application/" + media_type
 
+        bucket = "search" if url.startswith("/search") else "core"
+        # /rate_limit does not count against the budget
+        if url != "/rate_limit":
+            self.governor.acquire(bucket)
+
         req_url = self.gh_api + url
-        req = requests.get(req_url, headers=headers, params=params)
+        req = metrics.request("get", req_url, bucket, headers=headers, params=params)
 
         if req.status_code not in range(200, 301):
             print(req_url, req.json())
             send_plain_email(f"{req_url}: {req.status_code} : {req.json()}")
             raise GitHubAPIException(req.status_code, req.json())
 
-        if req.headers["x-ratelimit-remaining"] == 0:
-            pause = (req.headers["x-ratelimit-reset"] - time.time()) + 3
-            print(f"...waiting for {pause} seconds.")
-            time.sleep(pause)
-            print("...resuming.")
+        self.governor.update(req.headers)
 
         return req.json()
 
+    def get_if_changed(self, url, etag=None, media_type="vnd.github.v3+json", **params):
+        """Conditional GET. A `304 Not Modified` does not count
+        against the rate limit.
+
+        Args:
+            url (str): GitHub REST API endpoint
+            etag (str, optional): ETag of the previous response. Defaults to None.
+            media_type (str, optional): Defaults to "vnd.github.v3+json".
+
+        Raises:
+            GitHubAPIException: [description]
+
+        Returns:
+            tuple: (REST API response object or None if not modified, etag)
+        """
+        headers = {
+            "Accept": "application/" + media_type,
+            "Authorization": "token " + self.token,
+            "X-GitHub-Api-Version": self.gh_api_version,
+        }
+        if etag:
+            headers["If-None-Match"] = etag
+
+        self.governor.acquire("core")
+
+        req_url = self.gh_api + url
+        req = metrics.request("get", req_url, headers=headers, params=params)
+
+        if req.status_code == 304:
+            return None, etag
+
+        if req.status_code not in range(200, 301):
+            print(req_url, req.json())
+            send_plain_email(f"{req_url}: {req.status_code} : {req.json()}")
+            raise GitHubAPIException(req.status_code, req.json())
+
+        self.governor.update(req.headers)
+
+        return req.json(), req.headers.get("ETag", None)
+
     def check_rate(self, resource):
         """Helper that checks the rate limit from the API for a given resource and pauses
            if amount is depleted for instance token.
@@ -108,6 +246,7 @@ class GitHubAPI:
         rate = req["resources"][resource]
         remaining = rate["remaining"]
         reset = rate["reset"]
+        self.governor.set(resource, remaining, reset)
 
         if not remaining:
             pause = (reset - time.time()) + 3
@@ -117,15 +256,17 @@ class GitHubAPI:
             return
 
 
-def get_issues(gh, query):
+def search_issues(gh, query, max_total=None):
     """Search and format issues from GitHub API.
 
     Args:
         gh (GitHubAPI): instance of API helper with token
         query (str): search query to pass to the REST search enpoint
+        max_total (int, optional): Stop after the first page if the query
+        matches more than `max_total` items. Defaults to None (no limit).
 
     Returns:
-        list: list of items matching the input query
+        tuple: (list of items matching the input query, total count)
     """
     params = {
         "q": query,
@@ -141,6 +282,9 @@ def get_issues(gh, query):
     issues = res["items"]
 
     print(f"{query} total count is : {tc}")
+    if max_total is not None and tc > max_total:
+        return [], tc
+
     gh.check_rate("search")
 
     while count < tc:
@@ -157,14 +301,203 @@ def get_issues(gh, query):
             break
 
     for rec in issues:
-        repo = rec["repository_url"].split("/")
-        rec["username"] = rec.get("username", rec["user"]["login"])
-        rec["repo"] = rec.get("repo", repo[-1])
-        rec["org"] = rec.get("org", repo[-2])
+        format_issue(rec)
 
+    return issues, tc
+
+
+def format_issue(rec):
+    """Add the `username`, `repo` and `org` (and, for PRs, `merged`)
+    fields stored with a search item.
+
+    Args:
+        rec (dict): search item, updated in place
+
+    Returns:
+        dict: the search item
+    """
+    repo = rec["repository_url"].split("/")
+    rec["username"] = rec.get("username", rec["user"]["login"])
+    rec["repo"] = rec.get("repo", repo[-1])
+    rec["org"] = rec.get("org", repo[-2])
+    set_merge_state(rec)
+    return rec
+
+
+def get_issues(gh, query, cache=None):
+    """Search and format issues from GitHub API.
+
+    Args:
+        gh (GitHubAPI): instance of API helper with token
+        query (str): search query to pass to the REST search enpoint
+        cache (SearchCache, optional): answer the query from previously
+        fetched results where possible. Defaults to None.
+
+    Returns:
+        list: list of items matching the input query
+    """
+    if cache:
+        issues = cache.lookup(query)
+        if issues is not None:
+            print(f"{query} answered from cache : {len(issues)}")
+            return issues
+
+    issues, _ = search_issues(gh, query)
+
+    if cache:
+        cache.store(query, issues)
     return issues
 
 
+def parse_query(query):
+    """Split a search query into qualifiers.
+
+    Only the qualifiers used by the scheduled jobs are understood:
+    `repo:`, `is:` and `created:`/`closed:`/`updated:` with a `>=` date.
+
+    Args:
+        query (str): search query
+
+    Returns:
+        dict: {"repo": str, "is": set, "created": str, ...} or None if
+        the query uses anything else (free text, ranges, other qualifiers)
+    """
+    parsed = {"is": set()}
+    for token in query.split():
+        key, _, value = token.partition(":")
+        if key == "repo" and value:
+            parsed["repo"] = value
+        elif key == "is" and value:
+            parsed["is"].add(value)
+        elif key in ("created", "closed", "updated") and value.startswith(">="):
+            parsed[key] = value[2:]
+        else:
+            return None
+    return parsed
+
+
+def match_query(parsed, rec):
+    """Check a search item against parsed qualifiers.
+
+    Args:
+        parsed (dict): output of `parse_query`
+        rec (dict): search item
+
+    Returns:
+        bool: True if the item would be returned by the query
+    """
+    is_pr = "pull_request" in rec
+    merged = is_pr and (rec["pull_request"] or {}).get("merged_at") is not None
+    checks = {
+        "pr": is_pr,
+        "issue": not is_pr,
+        "open": rec["state"] == "open",
+        "closed": rec["state"] == "closed",
+        "merged": merged,
+        "unmerged": is_pr and not merged,
+    }
+    for qualifier in parsed["is"]:
+        if not checks[qualifier]:
+            return False
+    for key in ("created", "closed", "updated"):
+        if key in parsed:
+            value = rec.get(f"{key}_at")
+            if not value or value[:10] < parsed[key]:
+                return False
+    return True
+
+
+class SearchCache:
+    """Search results shared by the jobs of one invocation.
+
+    Results are stored by normalized query. In addition, a broad
+    `repo:<repo> updated:>=<date>` sweep per repo (see `prime`) answers
+    any narrower `created:>=`, `closed:>=` or `updated:>=` query for that
+    repo with an equal or later date, filtered locally. Items are copied
+    on the way out since callers mutate them.
+    """
+
+    SUPPORTED_IS = {"pr", "issue", "open", "closed", "merged", "unmerged"}
+
+    def __init__(self, ttl=None):
+        """
+        Args:
+            ttl (int, optional): seconds before an entry expires.
+            Defaults to None (kept for the lifetime of the cache).
+        """
+        self.ttl = ttl
+        self.results = {}
+        self.sweeps = {}
+
+    def _fresh(self, fetched_at):
+        return self.ttl is None or time.time() - fetched_at < self.ttl
+
+    @staticmethod
+    def normalize(query):
+        return " ".join(sorted(query.split()))
+
+    def prime(self, gh, repo, since_dt, org=ORG):
+        """Run one `updated:>=since_dt` sweep for a repo. Sweeps matching
+        more results than the search API returns (1000) are not cached.
+
+        Args:
+            gh (GitHubAPI): instance of API helper with token
+            repo (str): GitHub repo
+            since_dt (date|str): sweep window start
+        """
+        since_dt = str(since_dt)
+        full_name = f"{org}/{repo}"
+        cached = self.sweeps.get(full_name)
+        if cached and cached[0] <= since_dt and self._fresh(cached[1]):
+            return
+
+        q = f"repo:{full_name} updated:>={since_dt}"
+        issues, tc = search_issues(gh, q, max_total=SEARCH_RESULT_LIMIT)
+        if len(issues) < tc:
+            print(f"{q} not cached, {tc} results.")
+            return
+        self.sweeps[full_name] = (since_dt, time.time(), issues)
+
+    def lookup(self, query):
+        """Answer a query from the cache.
+
+        Args:
+            query (str): search query
+
+        Returns:
+            list: matching items or None on a miss
+        """
+        cached = self.results.get(self.normalize(query))
+        if cached and self._fresh(cached[0]):
+            return [dict(rec) for rec in cached[1]]
+
+        parsed = parse_query(query)
+        if not parsed or "repo" not in parsed:
+            return None
+        if not parsed["is"] <= self.SUPPORTED_IS:
+            return None
+
+        sweep = self.sweeps.get(parsed["repo"])
+        if not sweep or not self._fresh(sweep[1]):
+            return None
+
+        # created/closed/updated on or after a date all imply
+        # updated on or after that date
+        bounds = [
+            parsed[key] for key in ("created", "closed", "updated") if key in parsed
+        ]
+        if not bounds or max(bounds) < sweep[0]:
+            return None
+
+        return [dict(rec) for rec in sweep[2] if match_query(parsed, rec)]
+
+    def store(self, query, issues):
+        self.results[self.normalize(query)] = (
+            time.time(),
+            [dict(rec) for rec in issues],
+        )
+
+
 def get_org_members(gh):
     """Get GitHub organization members.
 
@@ -202,7 +535,61 @@ def get_org_members(gh):
     return org_members
 
 
-def update_org_issues_daily(db, gh, db_model, prs=True):
+def get_org_members_if_changed(gh, etags=None):
+    """Get GitHub organization members unless the list is unchanged.
+
+    Each page is requested with the ETag stored for it. If every page
+    answers `304 Not Modified` nothing has changed; otherwise the pages
+    that did not change are fetched again so the full list is returned.
+
+    Args:
+        gh (GitHubAPI): instance of API helper with token
+        etags ([str], optional): page ETags from the previous sync.
+        Defaults to None.
+
+    Returns:
+        tuple: (member list or None if unchanged, page ETags)
+    """
+    url = f"/orgs/{ORG}/members"
+    per_page = 100
+    etags = etags or []
+
+    pages = []
+    new_etags = []
+    changed = not etags
+    page_no = 0
+
+    while True:
+        page_no += 1
+        etag = etags[page_no - 1] if page_no <= len(etags) else None
+        mem, etag = gh.get_if_changed(url, etag, per_page=per_page, page=page_no)
+        pages.append(mem)
+        new_etags.append(etag)
+
+        if mem is None:
+            # unchanged page, more pages follow if more were stored
+            if page_no >= len(etags):
+                break
+        else:
+            changed = True
+            if len(mem) < per_page:
+                break
+
+    if not changed and len(pages) == len(etags):
+        return None, etags
+
+    members = []
+    for page_no, mem in enumerate(pages, start=1):
+        if mem is None:
+            mem, new_etags[page_no - 1] = gh.get_if_changed(
+                url, per_page=per_page, page=page_no
+            )
+        members += mem
+
+    return members, new_etags
+
+
+def update_org_issues_daily(db, gh, db_model, prs=True, cache=None, repos=REPOS):
     """Retrieve items created on or before today-5 days
        and store new records in db
 
@@ -212,12 +599,14 @@ def update_org_issues_daily(db, gh, db_model, prs=True):
         db_model (sqlalchemy model): DB table model that corresponds with datatype
         prs (bool, optional): Flag to indicate whether to search
         PRs or issues. Defaults to True (i.e. search PRs).
+        cache (SearchCache, optional): shared search results. Defaults to None.
+        repos ([str], optional): Defaults to REPOS.
     """
     # TODO: abstract this
     today = date.today()
     since_dt = today - timedelta(days=5)
 
-    for repo in REPOS:
+    for repo in repos:
         q = f"repo:aws-amplify/{repo} created:>={since_dt}"
 
         if prs:
@@ -225,8 +614,9 @@ def update_org_issues_daily(db, gh, db_model, prs=True):
         else:
             q += " is:issue "
 
-        issues = get_issues(gh, query=q)
+        issues = get_issues(gh, query=q, cache=cache)
         issue_ids = [issue["id"] for issue in issues]
+        stamp_records(db, issues)
 
         # find existing
         existing_recs = db.query(db_model).filter(db_model.id.in_(issue_ids)).all()
@@ -234,17 +624,23 @@ def update_org_issues_daily(db, gh, db_model, prs=True):
 
         # add new recs
         # TODO: handler for TypeError to catch GH API schema changes
+        new_ids = []
         for issue in issues:
             issue_id = issue["id"]
             if issue_id not in existing_rec_ids:
                 new_rec = db_model(**issue)
                 db.add(new_rec)
-                db.commit()
+                new_ids.append(issue_id)
                 print(f"new rec added. {issue['id']}")
+        # one refresh and commit per repo
+        refresh_issue_metrics(db, new_ids)
+        db.commit()
         db.close()
 
 
-def update_org_issues_closed_daily(db, gh, db_model, prs=True, week_interval=1):
+def update_org_issues_closed_daily(
+    db, gh, db_model, prs=True, week_interval=1, cache=None, repos=REPOS
+):
     """Retrieve items closed on or before today-1 week
        updates existing DB record or inserts a new record.
 
@@ -255,11 +651,13 @@ def update_org_issues_closed_daily(db, gh, db_model, prs=True, week_interval=1):
         prs (bool, optional): Flag to indicate whether to search
         PRs or issues. Defaults to True (i.e. search PRs).
         week_interval (int, optional): Number of historical weeks to search. Defaults to 1.
+        cache (SearchCache, optional): shared search results. Defaults to None.
+        repos ([str], optional): Defaults to REPOS.
     """
     today = date.today()
     since_dt = today - timedelta(weeks=week_interval)
 
-    for repo in REPOS:
+    for repo in repos:
         print(f"updating {repo}...")
         q = f"repo:aws-amplify/{repo} closed:>={since_dt}"
         if prs:
@@ -267,129 +665,249 @@ def update_org_issues_closed_daily(db, gh, db_model, prs=True, week_interval=1):
         else:
             q += " is:issue "
 
-        issues = get_issues(gh, query=q)
+        issues = get_issues(gh, query=q, cache=cache)
         issue_ids = [issue["id"] for issue in issues]
 
         # find existing
         existing_recs = db.query(db_model).filter(db_model.id.in_(issue_ids)).all()
         existing_rec_ids = {rec.id: rec for rec in existing_recs}
 
-        for issue in issues:
-            create_or_update_issue(db, db_model, issue, existing_rec_ids)
+        written_ids = [
+            issue["id"]
+            for issue in issues
+            if create_or_update_issue(db, db_model, issue, existing_rec_ids)
+        ]
+        refresh_issue_metrics(db, written_ids)
+        db.commit()
     db.close()
 
 
 def create_or_update_issue(db, db_model, issue, existing_rec_ids):
-    """Create or update issue DB record.
+    """Create or update issue DB record. Does not commit; callers refresh
+    the metrics of the written items and commit once per batch.
 
     Args:
         db (sqlalchemy DB session): sqlalchemy DB session
         db_model (sqlalchemy model): DB table model that corresponds with issue type
         issue (dict): GitHub issue
         existing_rec_ids ([int]): List of GitHub issue ids to compare issue against
+
+    Returns:
+        bool: True if the record was created or updated
     """
     issue_id = issue["id"]
     issue_updated_at = issue["updated_at"]
+    stamp_records(db, [issue])
     if issue_id in existing_rec_ids.keys():
         # check last updated date diffs between db and remote
         if issue_updated_at != existing_rec_ids[issue_id].updated_at.isoformat() + "Z":
             # update
             del issue["id"]
             db.query(db_model).filter(db_model.id == issue_id).update(dict(**issue))
-            db.commit()
             print(f"updated issue rec. {issue_id}")
-    else:
-        new_rec = db_model(**issue)
-        db.add(new_rec)
-        db.commit()
-        print(f"new issue rec added. {issue_id}")
+            return True
+        return False
+    new_rec = db_model(**issue)
+    db.add(new_rec)
+    print(f"new issue rec added. {issue_id}")
+    return True
+
+
+# join date of members whose real one is unknown: an open lower bound,
+# the earliest timestamp psycopg2 and NumPy read (not '-infinity')
+UNKNOWN_JOINED_AT = datetime(1, 1, 1)
+
+# seed membership history from `members` for members
+# without any interval (i.e. stored before intervals were kept)
+SEED_MEMBER_INTERVALS_STMT = text(
+    """
+INSERT INTO public.member_intervals (member_id, joined_at, left_at, login)
+SELECT
+	m.id,
+	CAST(:unknown_joined_at AS timestamp),
+	CASE WHEN m.inactive THEN coalesce(m.inactive_dt, m.inserted_dt, now()) END,
+	m.login
+FROM
+	public.members m
+WHERE
+	NOT EXISTS (
+		SELECT 1 FROM public.member_intervals mi
+		WHERE mi.member_id = m.id);
+"""
+)
+
+MEMBERS_SYNC_KEY = "org_members"
 
 
 def update_org_members_daily(db, gh):
     """Update GitHub organization members in the database. Insert new
        records for new members and set existing members to inactive if no longer
-       in the organization.
+       in the organization. Members that rejoin are set back to active.
+
+       Join/leave dates are kept in `member_intervals`. The sync is skipped
+       when the member list ETags are unchanged, and all writes are made
+       in one transaction.
 
     Args:
         db (sqlalchemy DB session): sqlalchemy DB session
         gh (GitHubAPI): instance of API helper with token
 
+    Returns:
+        dict: number of members added, rejoined and set inactive
     """
-    mems = get_org_members(gh)
-    mems_ids = [mem["id"] for mem in mems]
-
-    # find existing
-    existing_recs = db.query(Member).all()
-    existing_rec_ids = [rec.id for rec in existing_recs]
-
-    # new
-    for mem in mems:
-        mem_id = mem["id"]
-        if mem_id not in existing_rec_ids:
-            new_rec = Member(**mem)
-            db.add(new_rec)
-            db.commit()
-
-            # add to existing for inactive
-            # record check below
-            existing_rec_ids.append(mem_id)
-            print(f"new member added. {mem_id}")
-
-    # inactive
-    for rec_id in existing_rec_ids:
-        if rec_id not in mems_ids:
-            rec = (
-                db.query(Member)
-                .filter(Member.id == rec_id, Member.inactive == False)
-                .first()
-            )
+    state = db.query(SyncState).get(MEMBERS_SYNC_KEY)
+    etags = state.etag.split("|") if state and state.etag else None
+
+    mems, etags = get_org_members_if_changed(gh, etags)
+    if mems is None:
+        db.close()
+        print("members unchanged.")
+        return {"added": 0, "rejoined": 0, "inactive": 0}
 
-            if rec:
-                rec.inactive = True
-                rec.inactive_dt = datetime.now()
-                db.commit()
-                print(f"member set as inactive. {rec_id}")
-            else:
-                # inactive member already updated
-                pass
+    mems_by_id = {mem["id"]: mem for mem in mems}
 
+    # find existing, {id: inactive}
+    existing = dict(db.query(Member.id, Member.inactive).all())
+
+    new_ids = mems_by_id.keys() - existing.keys()
+    rejoined_ids = {mem_id for mem_id in mems_by_id if existing.get(mem_id)}
+    inactive_ids = {
+        mem_id
+        for mem_id, inactive in existing.items()
+        if not inactive and mem_id not in mems_by_id
+    }
+    now = datetime.now()
+
+    db.execute(SEED_MEMBER_INTERVALS_STMT, {"unknown_joined_at": UNKNOWN_JOINED_AT})
+
+    if new_ids:
+        upsert_records(
+            db, Member, [to_record(Member, mems_by_id[mem_id]) for mem_id in new_ids]
+        )
+    if rejoined_ids:
+        db.query(Member).filter(Member.id.in_(rejoined_ids)).update(
+            dict(inactive=False, inactive_dt=None), synchronize_session=False
+        )
+    if inactive_ids:
+        db.query(Member).filter(Member.id.in_(inactive_ids)).update(
+            dict(inactive=True, inactive_dt=now), synchronize_session=False
+        )
+        db.query(MemberInterval).filter(
+            MemberInterval.member_id.in_(inactive_ids),
+            MemberInterval.left_at == None,
+        ).update(dict(left_at=now), synchronize_session=False)
+
+    # on the first sync, members have been members for an unknown time
+    joined_at = now if existing else UNKNOWN_JOINED_AT
+    joined_ids = new_ids | rejoined_ids
+    if joined_ids:
+        upsert_records(
+            db,
+            MemberInterval,
+            [
+                {
+                    "member_id": mem_id,
+                    "joined_at": joined_at,
+                    "login": mems_by_id[mem_id]["login"],
+                }
+                for mem_id in joined_ids
+            ],
+        )
+
+    # attribution of the rows of members who joined or left
+    changed_ids = joined_ids | inactive_ids
+    if changed_ids:
+        logins = [
+            login
+            for (login,) in db.query(Member.login).filter(Member.id.in_(changed_ids))
+        ]
+        restamp_authors(db, logins=logins)
+
+    # pages served without an ETag are stored empty and always fetched
+    upsert_records(
+        db,
+        SyncState,
+        [
+            {
+                "key": MEMBERS_SYNC_KEY,
+                "etag": "|".join(etag or "" for etag in etags),
+                "updated_at": now,
+            }
+        ],
+    )
+    db.commit()
     db.close()
-    print("members updated.")
+    invalidate_membership_index()
+
+    counts = {
+        "added": len(new_ids),
+        "rejoined": len(rejoined_ids),
+        "inactive": len(inactive_ids),
+    }
+    print(f"members updated. {counts}")
+    return counts
+
+
+# `merged_at` is only trusted when the stored search payload carries
+# the key; a `merged` timeline event marks the PR as merged either way
+RECONCILE_PR_MERGE_STATE_STMT = text(
+    """
+UPDATE
+	public.pull_requests pr
+SET
+	merged = (pr.pull_request ->> 'merged_at') IS NOT NULL
+		OR EXISTS (
+			SELECT 1 FROM public.events e
+			WHERE e.issue_id = pr.id AND e.event = 'merged')
+WHERE
+	(CAST(:since_dt AS date) IS NULL OR pr.updated_at >= CAST(:since_dt AS date))
+	AND (pr.pull_request ? 'merged_at'
+		OR EXISTS (
+			SELECT 1 FROM public.events e
+			WHERE e.issue_id = pr.id AND e.event = 'merged'))
+	AND pr.merged IS DISTINCT FROM (
+		(pr.pull_request ->> 'merged_at') IS NOT NULL
+		OR EXISTS (
+			SELECT 1 FROM public.events e
+			WHERE e.issue_id = pr.id AND e.event = 'merged'));
+"""
+)
+
+
+def set_merge_state(rec):
+    """Set `merged` on a PR search item from `pull_request.merged_at`.
+    Issue items are left as-is.
+
+    Args:
+        rec (dict): search item
+    """
+    if "pull_request" in rec and "merged" not in rec:
+        rec["merged"] = (rec["pull_request"] or {}).get("merged_at") is not None
 
 
 # run this daily
-def reconcile_unmerged_closed_prs(db, gh, since_dt=None):
-    """Retrieve and update all PRs that have been `closed`
-       and **not** `merged` in the database. PRs have a `state` attribute
-       that only shows `open`/`closed`. For external contributors, we
-       want to know if the PR was `closed` and `merged`.
+def reconcile_pr_merge_state(db, since_dt=None):
+    """Correct `PullRequest.merged` from what is already stored: the
+    `pull_request.merged_at` of the search payload and `merged`
+    timeline events. No API requests are made.
+
+    Merge state is set when PRs are ingested, so this is a safety net
+    over recently updated PRs. Run with `since_dt=None` once to migrate
+    rows stored before merge state was derived at ingestion.
 
     Args:
         db (sqlalchemy DB session): sqlalchemy DB session
-        gh (GitHubAPI): instance of API helper with token
-        since_dt (str, optional): [description]. Defaults to today-52 weeks.
+        since_dt (date, optional): only check PRs updated on or after this
+        date. Defaults to None (all PRs).
+
+    Returns:
+        int: number of PRs updated
     """
-    if not since_dt:
-        today = date.today()
-        since_dt = today - timedelta(weeks=52)
-
-    for repo in REPOS:
-        q = f"repo:aws-amplify/{repo} is:pr is:closed is:unmerged closed:>={since_dt}"
-        prs = get_issues(gh, query=q)
-        pr_ids = [pr["id"] for pr in prs]
-
-        # find prs that already exist in db that need
-        # `merged` value set to false
-        existing_recs = (
-            db.query(PullRequest)
-            .filter(PullRequest.id.in_(pr_ids), PullRequest.merged == True)
-            .all()
-        )
-        # update existing
-        for rec in existing_recs:
-            rec.merged = False
-            db.commit()
+    res = db.execute(RECONCILE_PR_MERGE_STATE_STMT, {"since_dt": since_dt})
+    db.commit()
     db.close()
+    print(f"{res.rowcount} pr merge states updated.")
+    return res.rowcount
 
 
 if __name__ == "__main__":
@@ -406,13 +924,15 @@ if __name__ == "__main__":
     gh = GitHubAPI(token=token)
     db = create_db_session(db_url)
 
-    # # prs
-    update_org_issues_daily(db, gh, PullRequest, prs=True)
-    update_org_issues_closed_daily(db, gh, PullRequest, prs=True)
+    with profile_block("github"):
+        # # prs
+        update_org_issues_daily(db, gh, PullRequest, prs=True)
+        update_org_issues_closed_daily(db, gh, PullRequest, prs=True)
 
-    # # issues
-    update_org_issues_daily(db, gh, Issue, prs=False)
-    update_org_issues_closed_daily(db, gh, Issue, prs=False)
+        # # issues
+        update_org_issues_daily(db, gh, Issue, prs=False)
+        update_org_issues_closed_daily(db, gh, Issue, prs=False)
 
-    update_org_members_daily(db, gh)
-    reconcile_unmerged_closed_prs(db, gh, "2019-01-01")
+        update_org_members_daily(db, gh)
+        # one-time migration of merge state for stored PRs
+        reconcile_pr_merge_state(db)
@@ -0,0 +1,219 @@
+"""
+    issue_metrics.py
+    ~~~~~~~~~~~~~~~~
+
+    Per-issue and per-PR response metrics, kept in `issue_metrics`.
+
+    Every write that can change the metrics of an item (issue and PR
+    upserts, new timeline events, webhook batches, backfills) calls
+    `refresh_issue_metrics` for the items it touched, in the same
+    transaction. Reading a metric is then an indexed lookup instead of
+    a join of `events` with `members`.
+
+    - first response: earliest commented/reviewed/closed/merged event by
+      someone other than the author who was an org member at the time
+      (`author_is_member` of the event)
+    - close and merge: seconds from creation to `closed_at`/merge
+    - comments: commented and reviewed events by members and by
+      everyone else
+
+    python -m chalicelib.issue_metrics --repo amplify-js
+
+"""
+from sqlalchemy.sql import text
+
+try:
+    from chalicelib import metrics
+    from chalicelib.constants import REPOS
+    from chalicelib.models import Issue, IssueMetric, PullRequest
+except ModuleNotFoundError:
+    import metrics
+    from constants import REPOS
+    from models import Issue, IssueMetric, PullRequest
+
+# events that count as a response when made by a member
+RESPONSE_EVENTS = ["commented", "reviewed", "closed", "merged"]
+
+COMMENT_EVENTS = ["commented", "reviewed"]
+
+# items per statement
+REFRESH_BATCH_SIZE = 1000
+
+REFRESH_ISSUE_METRICS_STMT = text(
+    """
+WITH items AS (
+	SELECT
+		id, 'issue' AS kind, org, repo, number, username, created_at, closed_at,
+		CAST(NULL AS timestamp) AS merged_at
+	FROM
+		public.issues
+	WHERE
+		id = ANY(CAST(:ids AS bigint[]))
+	UNION ALL
+	SELECT
+		id, 'pr', org, repo, number, username, created_at, closed_at,
+		CASE WHEN merged THEN coalesce(
+			CAST(pull_request ->> 'merged_at' AS timestamptz) AT TIME ZONE 'UTC',
+			closed_at) END
+	FROM
+		public.pull_requests
+	WHERE
+		id = ANY(CAST(:ids AS bigint[]))
+),
+activity AS (
+	SELECT
+		e.issue_id,
+		e.event,
+		e.username,
+		e.created_at,
+		e.username IS DISTINCT FROM i.username AS other,
+		-- events stored before stamps were kept
+		coalesce(e.author_is_member, EXISTS (
+			SELECT 1 FROM public.member_intervals mi
+			WHERE mi.login = e.username
+				AND mi.joined_at <= e.created_at
+				AND (mi.left_at IS NULL OR mi.left_at > e.created_at))) AS team
+	FROM
+		public.events e
+		JOIN items i ON i.id = e.issue_id
+	WHERE
+		e.event = ANY(CAST(:response_events AS varchar[]))
+),
+responses AS (
+	SELECT DISTINCT ON (issue_id)
+		issue_id, created_at, username
+	FROM
+		activity
+	WHERE
+		team AND other
+	ORDER BY
+		issue_id, created_at
+),
+comments AS (
+	SELECT
+		issue_id,
+		count(*) FILTER (WHERE team) AS team_comments,
+		count(*) FILTER (WHERE NOT team) AS community_comments
+	FROM
+		activity
+	WHERE
+		event = ANY(CAST(:comment_events AS varchar[]))
+	GROUP BY
+		issue_id
+)
+INSERT INTO public.issue_metrics (
+	issue_id, kind, org, repo, number, username, created_at,
+	first_response_at, first_responder, first_response_seconds,
+	closed_at, close_seconds, merged_at, merge_seconds,
+	team_comments, community_comments, updated_at)
+SELECT
+	i.id, i.kind, i.org, i.repo, i.number, i.username, i.created_at,
+	r.created_at, r.username,
+	CAST(extract(epoch FROM r.created_at - i.created_at) AS bigint),
+	i.closed_at,
+	CAST(extract(epoch FROM i.closed_at - i.created_at) AS bigint),
+	i.merged_at,
+	CAST(extract(epoch FROM i.merged_at - i.created_at) AS bigint),
+	coalesce(c.team_comments, 0),
+	coalesce(c.community_comments, 0),
+	now()
+FROM
+	items i
+	LEFT JOIN responses r ON r.issue_id = i.id
+	LEFT JOIN comments c ON c.issue_id = i.id
+ON CONFLICT (issue_id) DO UPDATE SET
+	kind = excluded.kind,
+	org = excluded.org,
+	repo = excluded.repo,
+	number = excluded.number,
+	username = excluded.username,
+	created_at = excluded.created_at,
+	first_response_at = excluded.first_response_at,
+	first_responder = excluded.first_responder,
+	first_response_seconds = excluded.first_response_seconds,
+	closed_at = excluded.closed_at,
+	close_seconds = excluded.close_seconds,
+	merged_at = excluded.merged_at,
+	merge_seconds = excluded.merge_seconds,
+	team_comments = excluded.team_comments,
+	community_comments = excluded.community_comments,
+	updated_at = excluded.updated_at;
+"""
+)
+
+
+def refresh_issue_metrics(db, issue_ids):
+    """Recompute the metrics of the given issues and PRs from the stored
+    items, events and membership intervals. Ids that are not stored
+    (yet) are ignored.
+
+    Flushes pending ORM changes but does not commit; the caller owns
+    the transaction.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        issue_ids ([int]): issue/PR ids
+
+    Returns:
+        int: number of metric rows written
+    """
+    issue_ids = sorted(set(issue_ids))
+    if not issue_ids:
+        return 0
+
+    db.flush()
+    written = 0
+    for i in range(0, len(issue_ids), REFRESH_BATCH_SIZE):
+        written += db.execute(
+            REFRESH_ISSUE_METRICS_STMT,
+            {
+                "ids": issue_ids[i : i + REFRESH_BATCH_SIZE],
+                "response_events": RESPONSE_EVENTS,
+                "comment_events": COMMENT_EVENTS,
+            },
+        ).rowcount
+    metrics.record_rows(IssueMetric.__tablename__, upserted=written)
+    return written
+
+
+def rebuild_issue_metrics(db, repos=REPOS):
+    """Recompute the metrics of every stored issue and PR, one commit
+    per batch. Needed once to fill the table, and after membership
+    history is edited by hand (e.g. importing former team members).
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        repos ([str], optional): Defaults to REPOS.
+
+    Returns:
+        int: number of metric rows written
+    """
+    written = 0
+    for db_model in (Issue, PullRequest):
+        for repo in repos:
+            ids = [
+                rec.id for rec in db.query(db_model.id).filter(db_model.repo == repo)
+            ]
+            for i in range(0, len(ids), REFRESH_BATCH_SIZE):
+                written += refresh_issue_metrics(db, ids[i : i + REFRESH_BATCH_SIZE])
+                db.commit()
+            print(f"{db_model.__tablename__} metrics rebuilt {repo}: {len(ids)}")
+    db.close()
+    return written
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    from dotenv import load_dotenv
+
+    from chalicelib.models import create_db_session
+
+    parser = argparse.ArgumentParser(description="Rebuild issue and PR metrics.")
+    parser.add_argument("--repo", action="append", help="defaults to all REPOS")
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    db = create_db_session(os.getenv("DB_URL"))
+    rebuild_issue_metrics(db, args.repo or REPOS)
@@ -0,0 +1,349 @@
+"""
+    jobs.py
+    ~~~~~~~
+
+    Run scheduled jobs as (step, repo) work items within the time
+    left in the Lambda invocation.
+
+    All items are recorded in `job_items` when a run starts, and each
+    item's result (status and seconds) is written to its record when it
+    finishes. `collect` then summarizes the results and removes the done
+    items. When time runs short, or the invocation is killed, the
+    remaining items stay recorded and the next run of the job starts
+    with them, so every step and repo keeps making progress.
+
+    In fan-out mode the coordinator only records the items and sends
+    one message per item to a queue; workers run them in parallel
+    (`PoolQueue` locally, SQS when deployed). With SQS, the worker that
+    finishes the last pending item collects the results of the job.
+
+    Each item runs under a lease (see `leases.py`), so overlapping
+    invocations skip items that are already running elsewhere.
+
+"""
+import time
+from collections import namedtuple
+
+from sqlalchemy import case, func
+
+try:
+    from chalicelib import metrics
+    from chalicelib.constants import REPOS
+    from chalicelib.leases import LEASE_TTL, lease, new_holder
+    from chalicelib.models import JobItem, upsert_records
+except ModuleNotFoundError:
+    import metrics
+    from constants import REPOS
+    from leases import LEASE_TTL, lease, new_holder
+    from models import JobItem, upsert_records
+
+
+# `repo` of steps that run once for all repos
+ALL_REPOS = "*"
+
+# stop starting new items with less than this left
+RESERVE_MS = 45000
+
+# failed items are carried to the front of the next runs up to this
+# many attempts
+MAX_ATTEMPTS = 3
+
+PENDING = "pending"
+
+# items out of attempts, no longer carried but still run in step order
+ABANDONED = "abandoned"
+
+# item results, recorded until collected
+RESULT_STATUSES = ["done", "failed", "skipped"]
+
+Step = namedtuple("Step", ["name", "fn", "per_repo", "lease"], defaults=[True, None])
+Step.__doc__ = """A step of a job. `fn(db, repo)` is called for each repo
+of a per-repo step, `fn(db)` once otherwise. Items take the lease
+"job:step:repo" unless `lease` names one shared with other jobs."""
+
+
+def summarize(results):
+    """Aggregate item results.
+
+    Args:
+        results ([dict]): results of `JobRunner.execute`
+
+    Returns:
+        dict: number of items, in total and per status, total and
+        per-step seconds
+    """
+    summary = {"items": len(results), "seconds": 0.0, "steps": {}}
+    summary.update(dict.fromkeys(RESULT_STATUSES, 0))
+    for res in results:
+        summary[res["status"]] = summary.get(res["status"], 0) + 1
+        summary["seconds"] += res["seconds"]
+        steps = summary["steps"]
+        steps[res["step"]] = round(steps.get(res["step"], 0) + res["seconds"], 3)
+    summary["seconds"] = round(summary["seconds"], 3)
+    return summary
+
+
+def job_status(db, job):
+    """Items of a job still recorded, i.e. not yet run, failed or
+    abandoned.
+
+    Returns:
+        dict: number of pending, failed and abandoned items
+    """
+    failed = JobItem.attempts > 0
+    rows = (
+        db.query(JobItem.status == ABANDONED, failed, func.count())
+        .filter(JobItem.job == job, JobItem.status != "done")
+        .group_by(JobItem.status == ABANDONED, failed)
+    )
+    status = {"pending": 0, "failed": 0, ABANDONED: 0}
+    for abandoned, failed, count in rows:
+        if abandoned:
+            status[ABANDONED] += count
+        else:
+            status["failed" if failed else "pending"] += count
+    return status
+
+
+class JobRunner:
+    def __init__(
+        self,
+        db,
+        job,
+        steps,
+        context=None,
+        repos=REPOS,
+        reserve_ms=RESERVE_MS,
+        time_budget_ms=None,
+        lease_ttl=LEASE_TTL,
+        max_attempts=MAX_ATTEMPTS,
+    ):
+        """
+        Args:
+            db (sqlalchemy DB session): sqlalchemy DB session
+            job (str): job name, e.g. the scheduled function name
+            steps ([Step]): steps in run order
+            context (LambdaContext, optional): Lambda context, used for the
+            remaining time. Defaults to None.
+            repos ([str], optional): Defaults to REPOS.
+            reserve_ms (int, optional): Defaults to RESERVE_MS.
+            time_budget_ms (int, optional): budget when there is no Lambda
+            context. Defaults to None (unlimited).
+            lease_ttl (timedelta, optional): Defaults to LEASE_TTL.
+            max_attempts (int, optional): Defaults to MAX_ATTEMPTS.
+        """
+        self.db = db
+        self.job = job
+        self.steps = {step.name: step for step in steps}
+        self.context = context
+        self.repos = repos
+        self.reserve_ms = reserve_ms
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        self.holder = getattr(context, "aws_request_id", None) or new_holder()
+        self.deadline = None
+        if time_budget_ms is not None:
+            self.deadline = time.monotonic() + time_budget_ms / 1000
+
+    def remaining_ms(self):
+        if self.context is not None:
+            return self.context.get_remaining_time_in_millis()
+        if self.deadline is not None:
+            return (self.deadline - time.monotonic()) * 1000
+        return float("inf")
+
+    def plan(self):
+        """Work items of this run: items left over from previous runs
+        first, then every other item in step order. Items out of
+        attempts are not carried, they run in their step order.
+
+        Returns:
+            [(str, str)]: (step, repo) items
+        """
+        items = []
+        for step in self.steps.values():
+            for repo in self.repos if step.per_repo else [ALL_REPOS]:
+                items.append((step.name, repo))
+
+        planned = set(items)
+        carried = [
+            (rec.step, rec.repo)
+            for rec in self.db.query(JobItem)
+            .filter(
+                JobItem.job == self.job,
+                JobItem.status != "done",
+                JobItem.attempts < self.max_attempts,
+            )
+            .order_by(JobItem.seq)
+            if (rec.step, rec.repo) in planned
+        ]
+        return carried + [item for item in items if item not in set(carried)]
+
+    def record(self, items):
+        """Record planned items as pending, keeping the attempts of
+        carried ones, so a killed invocation leaves its remaining items
+        behind.
+        """
+        upsert_records(
+            self.db,
+            JobItem,
+            [
+                {
+                    "job": self.job,
+                    "step": step,
+                    "repo": repo,
+                    "seq": seq,
+                    "status": PENDING,
+                    "seconds": None,
+                }
+                for seq, (step, repo) in enumerate(items)
+            ],
+            update_cols=["seq", "status", "seconds"],
+        )
+        self.db.commit()
+
+    def lease_name(self, step, repo):
+        return self.steps[step].lease or f"{self.job}:{step}:{repo}"
+
+    def execute(self, step, repo, retry_seq=None):
+        """Run one item under its lease and record its result (see
+        `collect`), with attempts and error when failed. Items whose
+        lease is held elsewhere are skipped.
+
+        Args:
+            step (str): step name
+            repo (str): repo or ALL_REPOS
+            retry_seq (int, optional): `seq` of a failed item, to retry it
+            after the items not tried yet. Defaults to None (unchanged).
+
+        Returns:
+            dict: item, status and seconds taken
+        """
+        key = (
+            JobItem.job == self.job,
+            JobItem.step == step,
+            JobItem.repo == repo,
+        )
+        started = time.monotonic()
+        lease_name = self.lease_name(step, repo)
+        with lease(self.db, lease_name, self.holder, self.lease_ttl) as held:
+            if not held:
+                status, result = "skipped", {}
+            else:
+                try:
+                    fn = self.steps[step].fn
+                    with metrics.stage(step, job=self.job, repo=repo):
+                        if repo == ALL_REPOS:
+                            fn(self.db)
+                        else:
+                            fn(self.db, repo)
+                    status, result = "done", dict(attempts=0, error=None)
+                except Exception as e:
+                    self.db.rollback()
+                    status = "failed"
+                    result = dict(attempts=JobItem.attempts + 1, error=str(e)[:1000])
+                    if retry_seq is not None:
+                        result["seq"] = retry_seq
+                    print(f"{self.job}: {step} {repo} failed. {e}")
+
+            seconds = round(time.monotonic() - started, 3)
+            self.db.query(JobItem).filter(*key).update(
+                dict(result, status=status, seconds=seconds), synchronize_session=False
+            )
+            self.db.commit()
+
+        return {
+            "job": self.job,
+            "step": step,
+            "repo": repo,
+            "status": status,
+            "seconds": seconds,
+        }
+
+    def pending(self):
+        """Number of recorded items not run yet."""
+        return (
+            self.db.query(JobItem)
+            .filter(JobItem.job == self.job, JobItem.status == PENDING)
+            .count()
+        )
+
+    def collect(self):
+        """Summarize the results recorded since the last collection. Done
+        items are removed, failed and skipped ones are pending again for
+        the next run, except failed items out of attempts, which are
+        abandoned until they succeed. Concurrent callers each get their
+        own items.
+
+        Returns:
+            dict: summary of the collected items, see `summarize`
+        """
+        table = JobItem.__table__
+        results = []
+        for status in RESULT_STATUSES:
+            if status == "done":
+                stmt = table.delete()
+            elif status == "failed":
+                stmt = table.update().values(
+                    status=case(
+                        (table.c.attempts >= self.max_attempts, ABANDONED),
+                        else_=PENDING,
+                    )
+                )
+            else:
+                stmt = table.update().values(status=PENDING)
+            rows = self.db.execute(
+                stmt.where(table.c.job == self.job, table.c.status == status).returning(
+                    table.c.step, table.c.seconds
+                )
+            )
+            results += [
+                {"step": step, "status": status, "seconds": seconds or 0.0}
+                for step, seconds in rows
+            ]
+        self.db.commit()
+        return summarize(results)
+
+    def run(self):
+        """Run items one by one until done or out of time.
+
+        Returns:
+            dict: summary of the items run, see `summarize`
+        """
+        items = self.plan()
+        self.record(items)
+
+        deferred = 0
+        for idx, (step, repo) in enumerate(items):
+            if self.remaining_ms() < self.reserve_ms:
+                deferred = len(items) - idx
+                print(f"{self.job}: out of time, {deferred} items deferred.")
+                break
+            self.execute(step, repo, retry_seq=len(items) + idx)
+
+        summary = self.collect()
+        self.db.close()
+        summary["deferred"] = deferred
+        print(f"{self.job}: {summary}")
+        return summary
+
+    def dispatch(self, queue):
+        """Fan out: record the items and send one message per item
+        to `queue`. Workers run them with `execute`.
+
+        Args:
+            queue (PoolQueue|SQSQueue): work queue
+
+        Returns:
+            list: results returned by `queue.flush()` (in-process queues)
+        """
+        print(f"{self.job}: left by previous runs {job_status(self.db, self.job)}")
+        items = self.plan()
+        self.record(items)
+        self.db.close()
+
+        for step, repo in items:
+            queue.send({"job": self.job, "step": step, "repo": repo})
+        results = queue.flush()
+        print(f"{self.job}: {len(items)} items dispatched.")
+        return results
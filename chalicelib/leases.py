@@ -0,0 +1,148 @@
+"""
+    leases.py
+    ~~~~~~~~~
+
+    DB-backed leases that keep overlapping invocations from running
+    the same work at the same time.
+
+    A lease is a row in `leases` with a holder and an expiry. It is
+    taken with one `INSERT ... ON CONFLICT DO UPDATE` that only succeeds
+    when the lease is free, expired (its holder died or overran) or
+    already held by the same holder. Failed attempts are counted on the
+    row and logged as contention. `lease` renews the expiry while its
+    block runs, so work outlasting the TTL (local runs, rebuilds from the
+    command line) keeps the lease.
+
+"""
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+try:
+    from chalicelib.models import Lease
+except ModuleNotFoundError:
+    from models import Lease
+
+
+# longer than the Lambda timeout (300s), so a lease
+# only expires once its holder is gone
+LEASE_TTL = timedelta(minutes=6)
+
+
+def new_holder():
+    return uuid.uuid4().hex
+
+
+def acquire_lease(db, name, holder, ttl=LEASE_TTL):
+    """Take the lease `name` unless someone else holds it.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        name (str): lease name, e.g. "every_30_min:prs_created:amplify-js"
+        holder (str): holder id, e.g. the Lambda request id
+        ttl (timedelta, optional): Defaults to LEASE_TTL.
+
+    Returns:
+        bool: True if the lease is held by `holder`
+    """
+    now = datetime.utcnow()
+    table = Lease.__table__
+    stmt = insert(table).values(
+        name=name, holder=holder, acquired_at=now, expires_at=now + ttl, contentions=0
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["name"],
+        set_={
+            "holder": stmt.excluded.holder,
+            "acquired_at": stmt.excluded.acquired_at,
+            "expires_at": stmt.excluded.expires_at,
+        },
+        where=(table.c.expires_at < now) | (table.c.holder == holder),
+    ).returning(table.c.name)
+    acquired = db.execute(stmt).first() is not None
+
+    if not acquired:
+        current = (
+            db.query(Lease.holder, Lease.expires_at).filter(Lease.name == name).first()
+        )
+        db.query(Lease).filter(Lease.name == name).update(
+            dict(contentions=Lease.contentions + 1)
+        )
+        if current:
+            print(
+                f"lease {name} contended, held by {current.holder} "
+                f"until {current.expires_at}."
+            )
+    db.commit()
+    return acquired
+
+
+def release_lease(db, name, holder):
+    """Release the lease `name` if `holder` still holds it."""
+    db.query(Lease).filter(Lease.name == name, Lease.holder == holder).update(
+        dict(holder=None, expires_at=datetime.utcnow())
+    )
+    db.commit()
+
+
+def renew_lease(db, name, holder, ttl=LEASE_TTL):
+    """Push the expiry of the lease `name` to `ttl` from now if `holder`
+    still holds it.
+
+    Returns:
+        bool: True if the lease is still held by `holder`
+    """
+    renewed = (
+        db.query(Lease)
+        .filter(Lease.name == name, Lease.holder == holder)
+        .update(dict(expires_at=datetime.utcnow() + ttl), synchronize_session=False)
+    )
+    db.commit()
+    return bool(renewed)
+
+
+def _keep_renewed(bind, name, holder, ttl, stop):
+    # own session, the holder's is busy with the leased work
+    db = Session(bind=bind)
+    try:
+        while not stop.wait(ttl.total_seconds() / 3):
+            if not renew_lease(db, name, holder, ttl):
+                return
+    finally:
+        db.close()
+
+
+@contextmanager
+def lease(db, name, holder=None, ttl=LEASE_TTL):
+    """Hold the lease `name` for the duration of the block, renewing it
+    every third of `ttl` from a background thread.
+
+    with lease(db, "transfers") as held:
+        if held:
+            ...
+
+    Yields:
+        bool: True if the lease is held
+    """
+    holder = holder or new_holder()
+    held = acquire_lease(db, name, holder, ttl)
+    stop = threading.Event()
+    if held:
+        threading.Thread(
+            target=_keep_renewed,
+            args=(db.get_bind(), name, holder, ttl, stop),
+            daemon=True,
+        ).start()
+    try:
+        yield held
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        stop.set()
+        if held:
+            release_lease(db, name, holder)
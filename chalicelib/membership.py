@@ -0,0 +1,235 @@
+"""
+    membership.py
+    ~~~~~~~~~~~~~
+
+    Team/community attribution, stamped on rows when they are written.
+
+    Issues, PRs and events carry `author_is_member`: whether the author
+    (the actor, for events) was an org member when the item was opened
+    or the event happened, per `member_intervals`. Attribution is then a
+    filter on an indexed column instead of a join with the membership
+    history.
+
+    Writers stamp their records with `stamp_records`, from a
+    `MembershipIndex` of every interval held in memory. The index is
+    loaded once per process and reloaded after `MEMBERSHIP_INDEX_TTL`.
+    When membership changes, the member sync re-stamps the rows of the
+    logins that joined or left (`restamp_authors`); the daily job
+    re-stamps the rows ingested the day before, written by processes
+    that still held the previous index. Re-stamped rows get a new
+    `ingested_dt`, so the rollup refresh picks their days up; rows whose
+    stamp was only filled in keep theirs.
+
+    Stamp every row (after adding the column):
+
+    python -m chalicelib.membership --restamp
+
+"""
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy.sql import text
+
+try:
+    from chalicelib.issue_metrics import REFRESH_BATCH_SIZE, refresh_issue_metrics
+    from chalicelib.models import MEMBER_COL, MemberInterval
+except ModuleNotFoundError:
+    from issue_metrics import REFRESH_BATCH_SIZE, refresh_issue_metrics
+    from models import MEMBER_COL, MemberInterval
+
+# seconds an index is used before the intervals are loaded again
+MEMBERSHIP_INDEX_TTL = 600
+
+# table -> column of the item id
+STAMPED_TABLES = {
+    "issues": "id",
+    "pull_requests": "id",
+    "events": "issue_id",
+}
+
+# membership of the author at the time of the row, same
+# definition as the joins on `member_intervals`
+IS_MEMBER_SQL = """EXISTS (
+		SELECT 1 FROM public.member_intervals mi
+		WHERE mi.login = t.username
+			AND mi.joined_at <= t.created_at
+			AND (mi.left_at IS NULL OR mi.left_at > t.created_at))"""
+
+# `logins` and `since` (`ingested_dt`) can be null; only rows whose stamp
+# changes are written. Filling a null stamp keeps `ingested_dt`: readers
+# fall back to the same value, so nothing downstream changes
+RESTAMP_SQL = f"""
+UPDATE
+	public.{{table}} t
+SET
+	{MEMBER_COL} = {IS_MEMBER_SQL},
+	ingested_dt = CASE WHEN t.{MEMBER_COL} IS NULL THEN t.ingested_dt ELSE now() END
+WHERE
+	(CAST(:logins AS varchar[]) IS NULL OR t.username = ANY(CAST(:logins AS varchar[])))
+	AND (CAST(:since AS timestamp) IS NULL OR t.ingested_dt >= CAST(:since AS timestamp))
+	AND t.{MEMBER_COL} IS DISTINCT FROM {IS_MEMBER_SQL}
+{{returning}};
+"""
+
+
+def parse_timestamp(value):
+    """Naive UTC datetime of a stored or GitHub API timestamp
+    (`2024-01-01T00:00:00Z`)."""
+    if value is None or isinstance(value, datetime):
+        return value
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+class MembershipIndex:
+    """Membership intervals by login."""
+
+    def __init__(self, intervals):
+        """
+        Args:
+            intervals ([(str, datetime, datetime)]): login, joined_at and
+            left_at (None while a member)
+        """
+        self.intervals = {}
+        for login, joined_at, left_at in intervals:
+            self.intervals.setdefault(login, []).append((joined_at, left_at))
+
+    @classmethod
+    def from_db(cls, db):
+        return cls(
+            db.query(
+                MemberInterval.login, MemberInterval.joined_at, MemberInterval.left_at
+            ).all()
+        )
+
+    def is_member(self, login, ts):
+        """Whether `login` was an org member at `ts`. Unknown authors and
+        times are community."""
+        if login is None or ts is None:
+            return False
+        return any(
+            joined_at <= ts and (left_at is None or left_at > ts)
+            for joined_at, left_at in self.intervals.get(login, ())
+        )
+
+
+# (index, loaded at)
+_index = None
+
+
+def get_membership_index(db):
+    """The process's index, loaded on first use and after
+    `MEMBERSHIP_INDEX_TTL`."""
+    global _index
+    if _index is None or time.monotonic() - _index[1] > MEMBERSHIP_INDEX_TTL:
+        _index = (MembershipIndex.from_db(db), time.monotonic())
+    return _index[0]
+
+
+def invalidate_membership_index():
+    global _index
+    _index = None
+
+
+def stamp_records(db, recs):
+    """Set `author_is_member` on records carrying both `username` and
+    `created_at`; partial records are left as they are.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        recs ([dict]): `Issue`, `PullRequest` or `Event` records
+
+    Returns:
+        [dict]: the records, stamped in place
+    """
+    index = get_membership_index(db)
+    for rec in recs:
+        if "username" in rec and "created_at" in rec:
+            rec[MEMBER_COL] = index.is_member(
+                rec["username"], parse_timestamp(rec["created_at"])
+            )
+    return recs
+
+
+def restamp_authors(db, logins=None, since=None):
+    """Recompute the stamps of the rows of `logins`, or of the rows
+    ingested since `since`, from `member_intervals`, and refresh the
+    metrics of the items of changed rows (except when re-stamping every
+    row, which only fills in stamps). Does not commit.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        logins ([str], optional): Defaults to None (all authors).
+        since (datetime, optional): Defaults to None (all rows).
+
+    Returns:
+        dict: number of rows re-stamped per table
+    """
+    params = {"logins": list(logins) if logins else None, "since": since}
+    targeted = bool(logins) or since is not None
+    counts = {}
+    item_ids = set()
+    for table, item_col in STAMPED_TABLES.items():
+        # item ids of changed rows, few unless re-stamping everything
+        returning = f"RETURNING t.{item_col}" if targeted else ""
+        result = db.execute(
+            text(RESTAMP_SQL.format(table=table, returning=returning)), params
+        )
+        if targeted:
+            ids = set(result.scalars())
+            counts[table] = len(ids)
+            item_ids |= ids
+        else:
+            counts[table] = result.rowcount
+
+    # response metrics of the items whose responders changed sides
+    if item_ids:
+        item_ids = sorted(item_ids)
+        for i in range(0, len(item_ids), REFRESH_BATCH_SIZE):
+            refresh_issue_metrics(db, item_ids[i : i + REFRESH_BATCH_SIZE])
+    return counts
+
+
+def restamp_recent_authors(db, since):
+    """Re-stamp the rows ingested since `since`, and commit.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        since (datetime): lower bound of `ingested_dt`
+
+    Returns:
+        dict: number of rows re-stamped per table
+    """
+    counts = restamp_authors(db, since=since)
+    db.commit()
+    db.close()
+    print(f"authors re-stamped since {since}: {counts}")
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    from dotenv import load_dotenv
+
+    from chalicelib.models import create_db_session
+
+    parser = argparse.ArgumentParser(description="Stamp team/community authors.")
+    parser.add_argument(
+        "--restamp", action="store_true", help="recompute the stamp of every row"
+    )
+    parser.add_argument("--login", action="append", help="repeatable")
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    db = create_db_session(os.getenv("DB_URL"))
+    if args.restamp or args.login:
+        counts = restamp_authors(db, logins=args.login)
+        db.commit()
+        print(f"authors re-stamped: {counts}")
+    else:
+        parser.print_help()
@@ -0,0 +1,246 @@
+"""
+    metrics.py
+    ~~~~~~~~~~
+
+    Per-stage instrumentation of API requests and DB writes.
+
+    Every GitHub API request goes through `request`, which counts it per
+    rate limit bucket (with `304 Not Modified` responses and errors) and
+    keeps the remaining budget reported by the response. ORM flushes,
+    `Query.update`/`Query.delete` and bulk upserts count the rows they
+    insert, update, delete or skip; other raw SQL writes are counted by
+    their callers with `record_rows`.
+
+    Counts go to the `invocation` and to every active `stage` of the
+    current context, which pool threads get from `copy_context`. Stages
+    and invocations emit one JSON log line when they end, in CloudWatch
+    Embedded Metric Format (EMF), so the same line is a structured log
+    and a set of metrics.
+
+    with invocation("every_30_min"):
+        with stage("prs_created", repo="amplify-js"):
+            ...
+
+"""
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+NAMESPACE = "ContributorMetrics"
+
+UNITS = {"Duration": "Seconds", "NotModifiedRatio": "None"}
+
+ROW_COUNTS = ["inserted", "updated", "deleted", "upserted", "skipped"]
+
+_lock = threading.Lock()
+
+
+class Stats:
+    """Counters of one stage or invocation."""
+
+    def __init__(self):
+        self.requests = {}
+        self.not_modified = 0
+        self.errors = 0
+        self.request_seconds = 0.0
+        self.rate_remaining = {}
+        self.rows = {}
+
+    def add_request(self, bucket, status_code, seconds, remaining=None):
+        self.requests[bucket] = self.requests.get(bucket, 0) + 1
+        self.request_seconds += seconds
+        if status_code == 304:
+            self.not_modified += 1
+        elif status_code >= 400:
+            self.errors += 1
+        if remaining is not None:
+            self.rate_remaining[bucket] = remaining
+
+    def add_rows(self, table, counts):
+        rows = self.rows.setdefault(table, dict.fromkeys(ROW_COUNTS, 0))
+        for name, count in counts.items():
+            rows[name] += count
+
+    def as_dict(self):
+        total = sum(self.requests.values())
+        rows = {
+            name: sum(counts[name] for counts in self.rows.values())
+            for name in ROW_COUNTS
+        }
+        return {
+            "requests": dict(self.requests),
+            "request_count": total,
+            "request_seconds": round(self.request_seconds, 3),
+            "not_modified": self.not_modified,
+            "not_modified_ratio": round(self.not_modified / total, 3) if total else 0,
+            "errors": self.errors,
+            "rate_remaining": dict(self.rate_remaining),
+            "rows": rows,
+            "tables": {table: dict(counts) for table, counts in self.rows.items()},
+        }
+
+
+_stages = contextvars.ContextVar("metrics_stages", default=())
+_invocation = Stats()
+
+
+def _active():
+    return (_invocation,) + _stages.get()
+
+
+def record_request(bucket, status_code, seconds, remaining=None):
+    """Count one API request in the active stages."""
+    with _lock:
+        for stats in _active():
+            stats.add_request(bucket, status_code, seconds, remaining)
+
+
+def record_rows(table, **counts):
+    """Count written rows of a table in the active stages, e.g.
+    `record_rows("events", upserted=10, skipped=2)`.
+    """
+    with _lock:
+        for stats in _active():
+            stats.add_rows(table, counts)
+
+
+def request(method, url, bucket="core", **kwargs):
+    """Make an HTTP request and count it under its rate limit bucket
+    (the `x-ratelimit-resource` response header when present).
+
+    Args:
+        method (str): HTTP method
+        url (str): full URL
+        bucket (str, optional): Defaults to "core".
+
+    Returns:
+        requests.Response: response
+    """
+    started = time.perf_counter()
+    req = requests.request(method, url, **kwargs)
+    remaining = req.headers.get("x-ratelimit-remaining")
+    record_request(
+        req.headers.get("x-ratelimit-resource", bucket),
+        req.status_code,
+        time.perf_counter() - started,
+        int(remaining) if remaining is not None else None,
+    )
+    return req
+
+
+@event.listens_for(Session, "after_flush")
+def _count_flush(session, flush_context):
+    counts = {}
+    for name, objs in (
+        ("inserted", session.new),
+        ("updated", [obj for obj in session.dirty if session.is_modified(obj)]),
+        ("deleted", session.deleted),
+    ):
+        for obj in objs:
+            table = getattr(obj, "__tablename__", type(obj).__name__)
+            counts.setdefault(table, {})
+            counts[table][name] = counts[table].get(name, 0) + 1
+    for table, table_counts in counts.items():
+        record_rows(table, **table_counts)
+
+
+@event.listens_for(Session, "after_bulk_update")
+def _count_bulk_update(update_context):
+    record_rows(
+        update_context.mapper.local_table.name,
+        updated=max(update_context.result.rowcount, 0),
+    )
+
+
+@event.listens_for(Session, "after_bulk_delete")
+def _count_bulk_delete(delete_context):
+    record_rows(
+        delete_context.mapper.local_table.name,
+        deleted=max(delete_context.result.rowcount, 0),
+    )
+
+
+def emit(kind, name, seconds, stats, **dims):
+    """Print one EMF record.
+
+    Args:
+        kind (str): "stage" or "invocation"
+        name (str): stage or job name
+        seconds (float): duration
+        stats (Stats): counters
+        dims (dict): extra dimensions, e.g. job and repo
+    """
+    data = stats.as_dict()
+    values = {
+        "Duration": round(seconds, 3),
+        "Requests": data["request_count"],
+        "NotModifiedRatio": data["not_modified_ratio"],
+        "RequestErrors": data["errors"],
+        "RowsWritten": sum(data["rows"].values()) - data["rows"]["skipped"],
+        "RowsSkipped": data["rows"]["skipped"],
+    }
+    for bucket, remaining in data["rate_remaining"].items():
+        values[f"RateRemaining_{bucket}"] = remaining
+
+    dims = {key: str(value) for key, value in dims.items()}
+    dims[kind] = name
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [sorted(dims)],
+                    "Metrics": [
+                        {"Name": key, "Unit": UNITS.get(key, "Count")} for key in values
+                    ],
+                }
+            ],
+        },
+        **dims,
+        **values,
+        **data,
+    }
+    print(json.dumps(record, default=str))
+
+
+@contextmanager
+def stage(name, **dims):
+    """Collect the requests and rows of a block and emit them when
+    it ends.
+
+    Yields:
+        Stats: the stage's counters
+    """
+    stats = Stats()
+    token = _stages.set(_stages.get() + (stats,))
+    started = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        _stages.reset(token)
+        emit("stage", name, time.perf_counter() - started, stats, **dims)
+
+
+@contextmanager
+def invocation(name, **dims):
+    """Reset the invocation counters and emit them as the summary of
+    the invocation when the block ends.
+
+    Yields:
+        Stats: the invocation's counters
+    """
+    global _invocation
+    with _lock:
+        _invocation = Stats()
+    started = time.perf_counter()
+    try:
+        yield _invocation
+    finally:
+        emit("invocation", name, time.perf_counter() - started, _invocation, **dims)
@@ -0,0 +1,446 @@
+"""
+    metrics_api.py
+    ~~~~~~~~~~~~~~
+
+    Read-only queries behind the `/metrics` routes, with a response
+    cache.
+
+    Responses are cached in-process, keyed by query and the data
+    version: a `sync_state` row that ingestion bumps at the end of each
+    run (`bump_data_version`, at most once a minute). The version is
+    re-read at most every `VERSION_TTL` seconds, so repeated dashboard
+    loads are answered from the cache, or with `304 Not Modified` when
+    the client's ETag (a hash of query and version) still matches,
+    without touching the database.
+
+    Lists are paginated by keyset: `next` is an opaque cursor of the last
+    row's sort key, passed back as `?cursor=`.
+
+"""
+import base64
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import Integer, and_, func, or_, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.expression import cast
+
+try:
+    from chalicelib.models import (
+        DailyRepoCount,
+        DailyUserCount,
+        IssueMetric,
+        SyncState,
+        Transfer,
+    )
+except ModuleNotFoundError:
+    from models import (
+        DailyRepoCount,
+        DailyUserCount,
+        IssueMetric,
+        SyncState,
+        Transfer,
+    )
+
+DATA_VERSION_KEY = "data_version"
+
+# seconds a data version read is trusted
+VERSION_TTL = 60
+
+# cached responses per process
+CACHE_SIZE = 256
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+KINDS = ["issue", "pr"]
+
+
+class BadQuery(ValueError):
+    pass
+
+
+def bump_data_version(db, min_age=VERSION_TTL):
+    """Mark the data as changed; cached responses of every process are
+    stale once they re-read the version. Bumps are coalesced: a version
+    newer than `min_age` seconds is kept, since readers may not have
+    re-read it yet anyway. Commits.
+
+    Returns:
+        bool: True if the version was bumped
+    """
+    now = datetime.utcnow()
+    table = SyncState.__table__
+    stmt = insert(table).values(
+        key=DATA_VERSION_KEY, value=now.isoformat(), updated_at=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["key"],
+        set_={"value": stmt.excluded.value, "updated_at": stmt.excluded.updated_at},
+        where=table.c.updated_at < now - timedelta(seconds=min_age),
+    ).returning(table.c.key)
+    bumped = db.execute(stmt).first() is not None
+    db.commit()
+    if bumped:
+        _cache.clear()
+    return bumped
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+
+def decode_cursor(cursor, types):
+    """Values of a cursor, checked against the types of the sort key
+    (e.g. `[str, int]`), so that bad cursors never reach the DB."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise BadQuery("invalid cursor")
+    if not isinstance(values, list) or len(values) != len(types):
+        raise BadQuery("invalid cursor")
+    for value, value_type in zip(values, types):
+        # a bool is an int; ints are at most bigint
+        if not isinstance(value, value_type) or (
+            isinstance(value, bool) and value_type is not bool
+        ):
+            raise BadQuery("invalid cursor")
+        if value_type is int and not -(2**63) <= value < 2**63:
+            raise BadQuery("invalid cursor")
+    return values
+
+
+def _page(rows, limit, key):
+    """Trim the extra row fetched to detect a next page.
+
+    Returns:
+        (list, str): rows, next cursor or None
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(key(rows[-1]))
+
+
+def _as_dict(row):
+    return {
+        key: value.isoformat() if isinstance(value, (date, datetime)) else value
+        for key, value in row._asdict().items()
+    }
+
+
+def _date_range(query, column, params):
+    # `end` is inclusive, timestamps included
+    if params.get("start"):
+        query = query.filter(column >= params["start"])
+    if params.get("end"):
+        query = query.filter(column < params["end"] + timedelta(days=1))
+    return query
+
+
+def repo_daily(db, params):
+    """Daily counts of a repo (`daily_repo_counts`), oldest first."""
+    cols = DailyRepoCount.__table__.columns
+    query = db.query(*cols).filter(DailyRepoCount.repo == params["repo"])
+    query = _date_range(query, DailyRepoCount.day, params)
+    if params.get("team") is not None:
+        query = query.filter(DailyRepoCount.team == params["team"])
+    rows = query.order_by(DailyRepoCount.day, DailyRepoCount.team).all()
+    return {"items": [_as_dict(row) for row in rows]}
+
+
+def contributors(db, params):
+    """Contributors by activity (issues and PRs opened, comments and
+    reviews) over a date range, most active first."""
+    activity = func.sum(
+        DailyUserCount.issues_opened
+        + DailyUserCount.prs_opened
+        + DailyUserCount.comments
+        + DailyUserCount.reviews
+    )
+    activity = cast(activity, Integer).label("activity")
+    query = db.query(
+        DailyUserCount.username,
+        DailyUserCount.team,
+        activity,
+        cast(func.sum(DailyUserCount.issues_opened), Integer).label("issues_opened"),
+        cast(func.sum(DailyUserCount.prs_opened), Integer).label("prs_opened"),
+        cast(func.sum(DailyUserCount.comments), Integer).label("comments"),
+        cast(func.sum(DailyUserCount.reviews), Integer).label("reviews"),
+        func.count(func.distinct(DailyUserCount.day)).label("active_days"),
+    )
+    if params.get("repo"):
+        query = query.filter(DailyUserCount.repo == params["repo"])
+    query = _date_range(query, DailyUserCount.day, params)
+    if params.get("team") is not None:
+        query = query.filter(DailyUserCount.team == params["team"])
+    query = query.group_by(DailyUserCount.username, DailyUserCount.team)
+
+    if params.get("cursor"):
+        last_activity, last_username, last_team = decode_cursor(
+            params["cursor"], [int, str, bool]
+        )
+        query = query.having(
+            or_(
+                activity < last_activity,
+                and_(
+                    activity == last_activity,
+                    tuple_(DailyUserCount.username, DailyUserCount.team)
+                    > tuple_(last_username, last_team),
+                ),
+            )
+        )
+
+    rows = (
+        query.order_by(activity.desc(), DailyUserCount.username, DailyUserCount.team)
+        .limit(params["limit"] + 1)
+        .all()
+    )
+    rows, cursor = _page(
+        rows, params["limit"], lambda row: [row.activity, row.username, row.team]
+    )
+    return {"items": [_as_dict(row) for row in rows], "next": cursor}
+
+
+def issues(db, params):
+    """Per-item metrics (`issue_metrics`), newest first. Items without
+    `created_at` are left out, they have no place in the keyset order."""
+    cols = IssueMetric.__table__.columns
+    query = db.query(*cols).filter(IssueMetric.created_at.isnot(None))
+    if params.get("repo"):
+        query = query.filter(IssueMetric.repo == params["repo"])
+    if params.get("kind"):
+        query = query.filter(IssueMetric.kind == params["kind"])
+    query = _date_range(query, IssueMetric.created_at, params)
+
+    if params.get("cursor"):
+        last_created_at, last_id = decode_cursor(params["cursor"], [str, int])
+        try:
+            last_created_at = datetime.fromisoformat(last_created_at)
+        except ValueError:
+            raise BadQuery("invalid cursor")
+        query = query.filter(
+            tuple_(IssueMetric.created_at, IssueMetric.issue_id)
+            < tuple_(last_created_at, last_id)
+        )
+
+    rows = (
+        query.order_by(IssueMetric.created_at.desc(), IssueMetric.issue_id.desc())
+        .limit(params["limit"] + 1)
+        .all()
+    )
+    rows, cursor = _page(
+        rows, params["limit"], lambda row: [row.created_at.isoformat(), row.issue_id]
+    )
+    return {"items": [_as_dict(row) for row in rows], "next": cursor}
+
+
+def response_times(db, params):
+    """Median and 90th percentile of first response, close and merge
+    times (seconds) of the items created in a date range."""
+
+    def percentile(fraction, column):
+        return func.percentile_cont(fraction).within_group(column)
+
+    query = db.query(
+        IssueMetric.kind,
+        func.count().label("items"),
+        func.count(IssueMetric.first_response_at).label("responded"),
+        percentile(0.5, IssueMetric.first_response_seconds).label("first_response_p50"),
+        percentile(0.9, IssueMetric.first_response_seconds).label("first_response_p90"),
+        percentile(0.5, IssueMetric.close_seconds).label("close_p50"),
+        percentile(0.9, IssueMetric.close_seconds).label("close_p90"),
+        percentile(0.5, IssueMetric.merge_seconds).label("merge_p50"),
+        percentile(0.9, IssueMetric.merge_seconds).label("merge_p90"),
+    ).filter(IssueMetric.repo == params["repo"])
+    if params.get("kind"):
+        query = query.filter(IssueMetric.kind == params["kind"])
+    query = _date_range(query, IssueMetric.created_at, params)
+    rows = query.group_by(IssueMetric.kind).order_by(IssueMetric.kind).all()
+    return {"items": [_as_dict(row) for row in rows]}
+
+
+def transfers(db, params):
+    """Issues transferred from (or to, with `?to=true`) a repo."""
+    query = db.query(
+        Transfer.issue_id,
+        Transfer.new_issue_id,
+        Transfer.repo,
+        Transfer.number,
+        Transfer.new_repo,
+        Transfer.new_number,
+        Transfer.title,
+        Transfer.username,
+        Transfer.created_at,
+        Transfer.closed_at,
+        Transfer.state,
+    )
+    if params.get("repo"):
+        repo_col = Transfer.new_repo if params.get("to") else Transfer.repo
+        query = query.filter(repo_col == params["repo"])
+    query = _date_range(query, Transfer.created_at, params)
+
+    if params.get("cursor"):
+        last_issue_id, last_new_issue_id = decode_cursor(params["cursor"], [int, int])
+        query = query.filter(
+            tuple_(Transfer.issue_id, Transfer.new_issue_id)
+            > tuple_(last_issue_id, last_new_issue_id)
+        )
+
+    rows = (
+        query.order_by(Transfer.issue_id, Transfer.new_issue_id)
+        .limit(params["limit"] + 1)
+        .all()
+    )
+    rows, cursor = _page(
+        rows, params["limit"], lambda row: [row.issue_id, row.new_issue_id]
+    )
+    return {"items": [_as_dict(row) for row in rows], "next": cursor}
+
+
+# name -> (query, query string parameters)
+QUERIES = {
+    "repo_daily": (repo_daily, ["start", "end", "team"]),
+    "contributors": (contributors, ["repo", "start", "end", "team", "cursor", "limit"]),
+    "issues": (issues, ["repo", "kind", "start", "end", "cursor", "limit"]),
+    "response_times": (response_times, ["kind", "start", "end"]),
+    "transfers": (transfers, ["repo", "to", "start", "end", "cursor", "limit"]),
+}
+
+
+def _parse_bool(value):
+    if value.lower() in ("true", "1"):
+        return True
+    if value.lower() in ("false", "0"):
+        return False
+    raise BadQuery(f"invalid boolean: {value}")
+
+
+def parse_params(name, path_params, query_params):
+    """Validate and convert the parameters of a query.
+
+    Raises:
+        BadQuery: unknown or invalid parameter
+
+    Returns:
+        dict: parameters
+    """
+    allowed = QUERIES[name][1]
+    unknown = set(query_params) - set(allowed)
+    if unknown:
+        raise BadQuery(f"unknown parameters: {', '.join(sorted(unknown))}")
+
+    params = dict(path_params)
+    try:
+        for key, value in query_params.items():
+            if key in ("start", "end"):
+                params[key] = date.fromisoformat(value)
+            elif key in ("team", "to"):
+                params[key] = _parse_bool(value)
+            elif key == "limit":
+                params[key] = int(value)
+            elif key == "kind" and value not in KINDS:
+                raise BadQuery(f"kind must be one of {', '.join(KINDS)}")
+            else:
+                params[key] = value
+    except ValueError as e:
+        raise BadQuery(str(e))
+
+    if "limit" in allowed:
+        params["limit"] = min(max(params.get("limit", DEFAULT_LIMIT), 1), MAX_LIMIT)
+    return params
+
+
+class ResponseCache:
+    """LRU of serialized responses, and the last data version read."""
+
+    def __init__(self, size=CACHE_SIZE, version_ttl=VERSION_TTL):
+        self.size = size
+        self.version_ttl = version_ttl
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def version(self, get_db):
+        with self._lock:
+            cached = self._version
+        if cached and time.monotonic() - cached[1] < self.version_ttl:
+            return cached[0]
+
+        db = get_db()
+        state = db.query(SyncState.value).filter(SyncState.key == DATA_VERSION_KEY)
+        try:
+            row = state.first()
+        finally:
+            db.rollback()
+        version = row.value if row else ""
+        with self._lock:
+            if version != (cached or ("",))[0]:
+                self._entries.clear()
+            self._version = (version, time.monotonic())
+        return version
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+
+_cache = ResponseCache()
+
+
+def serve(get_db, name, path_params, query_params, if_none_match=None):
+    """Answer a metrics query from the cache, or query and cache it.
+
+    Args:
+        get_db (function): returns the DB session, only called when the
+        version is re-read or the response is not cached
+        name (str): query name, see `QUERIES`
+        path_params (dict): URL path parameters
+        query_params (dict): query string parameters
+        if_none_match (str, optional): `If-None-Match` request header
+
+    Raises:
+        BadQuery: unknown or invalid parameter
+
+    Returns:
+        (int, str, dict): status code, JSON body, headers
+    """
+    params = parse_params(name, path_params, query_params or {})
+    key = json.dumps([name, params], sort_keys=True, default=str)
+    version = _cache.version(get_db)
+    etag = '"' + hashlib.sha1(f"{key}|{version}".encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return 304, "", headers
+
+    body = _cache.get(key)
+    if body is None:
+        try:
+            body = json.dumps(QUERIES[name][0](get_db(), params), default=str)
+        finally:
+            # the session is shared by the container's requests, and
+            # a failed query leaves its transaction aborted
+            get_db().rollback()
+        _cache.set(key, body)
+    headers["Content-Type"] = "application/json"
+    return 200, body, headers
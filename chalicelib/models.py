@@ -2,19 +2,34 @@ from sqlalchemy import (
     BigInteger,
     Boolean,
     Column,
+    Date,
     DateTime,
     Float,
+    Index,
     Integer,
     String,
     create_engine,
 )
-from sqlalchemy.dialects.postgresql import ARRAY, JSON, JSONB
+from sqlalchemy.dialects.postgresql import ARRAY, JSON, JSONB, insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import func
 
+try:
+    from chalicelib import metrics
+except ModuleNotFoundError:
+    import metrics
+
 Base = declarative_base()
 
+# set on every insert and update of ingested rows, the
+# watermark of incremental refreshes (see `rollups`)
+INGESTED_COL = "ingested_dt"
+
+# org membership of the author when the item/event was created, see
+# `chalicelib.membership`
+MEMBER_COL = "author_is_member"
+
 
 class Member(Base):
     __tablename__ = "members"
@@ -41,6 +56,26 @@ class Member(Base):
     url = Column(String)
 
 
+class MemberInterval(Base):
+    __tablename__ = "member_intervals"
+    member_id = Column(Integer, primary_key=True)
+    joined_at = Column(DateTime, primary_key=True)
+    left_at = Column(DateTime)
+    login = Column(String)
+
+    __table_args__ = (
+        Index("ix_member_intervals_login_joined_at", "login", "joined_at"),
+    )
+
+
+class SyncState(Base):
+    __tablename__ = "sync_state"
+    key = Column(String, primary_key=True)
+    etag = Column(String)
+    value = Column(String)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
 class Issue(Base):
     __tablename__ = "issues"
     id = Column(BigInteger, primary_key=True)
@@ -75,6 +110,14 @@ class Issue(Base):
     url = Column(String)
     user = Column(JSONB)
     username = Column(String)
+    author_is_member = Column(Boolean)
+    ingested_dt = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_issues_repo_number", "repo", "number"),
+        Index("ix_issues_ingested_dt", "ingested_dt"),
+        Index("ix_issues_repo_author_is_member", "repo", "author_is_member"),
+    )
 
 
 class PullRequest(Base):
@@ -96,7 +139,7 @@ class PullRequest(Base):
     labels = Column(ARRAY(JSON))
     state = Column(String)
     state_reason = Column(String)
-    merged = Column(Boolean, default=True)
+    merged = Column(Boolean, default=False)
     locked = Column(Boolean)
     assignee = Column(JSONB)
     assignees = Column(ARRAY(JSON))
@@ -114,6 +157,14 @@ class PullRequest(Base):
     timeline_url = Column(String)
     performed_via_github_app = Column(String)
     score = Column(Integer)
+    author_is_member = Column(Boolean)
+    ingested_dt = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_pull_requests_repo_number", "repo", "number"),
+        Index("ix_pull_requests_ingested_dt", "ingested_dt"),
+        Index("ix_pull_requests_repo_author_is_member", "repo", "author_is_member"),
+    )
 
 
 class Event(Base):
@@ -133,6 +184,20 @@ class Event(Base):
     user = Column(JSONB)
     author_association = Column(String)
     username = Column(String)
+    author_is_member = Column(Boolean)
+    ingested_dt = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index("ix_events_issue_id_created_at", "issue_id", "created_at"),
+        Index("ix_events_repo_created_at", "repo", "created_at"),
+        Index("ix_events_ingested_dt", "ingested_dt"),
+        Index(
+            "ix_events_repo_author_is_member_created_at",
+            "repo",
+            "author_is_member",
+            "created_at",
+        ),
+    )
 
 
 class EventPoll(Base):
@@ -176,6 +241,213 @@ def create_db_session(db_url):
     return db
 
 
+class BackfillUnit(Base):
+    __tablename__ = "backfill_units"
+    key = Column(String, primary_key=True)
+    kind = Column(String)
+    repo = Column(String)
+    start_dt = Column(Date)
+    end_dt = Column(Date)
+    status = Column(String, default="pending")
+    attempts = Column(Integer, default=0)
+    row_count = Column(Integer)
+    error = Column(String)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class EventBackfill(Base):
+    __tablename__ = "event_backfills"
+    issue_id = Column(BigInteger, primary_key=True)
+    kind = Column(String)
+    repo = Column(String)
+    status = Column(String)
+    attempts = Column(Integer, default=0)
+    event_count = Column(Integer)
+    error = Column(String)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class JobItem(Base):
+    __tablename__ = "job_items"
+    job = Column(String, primary_key=True)
+    step = Column(String, primary_key=True)
+    repo = Column(String, primary_key=True)
+    seq = Column(Integer)
+    # "pending" until run, then the result until collected
+    status = Column(String, default="pending")
+    seconds = Column(Float)
+    attempts = Column(Integer, default=0)
+    error = Column(String)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class Lease(Base):
+    __tablename__ = "leases"
+    name = Column(String, primary_key=True)
+    holder = Column(String)
+    acquired_at = Column(DateTime)
+    expires_at = Column(DateTime)
+    contentions = Column(Integer, default=0)
+
+
+class TransferProbe(Base):
+    __tablename__ = "transfer_probes"
+    issue_id = Column(BigInteger, primary_key=True)
+    status_code = Column(Integer)
+    location = Column(String)
+    transferred = Column(Boolean)
+    probed_at = Column(DateTime, default=func.now())
+
+
+class IssueMetric(Base):
+    __tablename__ = "issue_metrics"
+    issue_id = Column(BigInteger, primary_key=True)
+    kind = Column(String)
+    org = Column(String)
+    repo = Column(String)
+    number = Column(Integer)
+    username = Column(String)
+    created_at = Column(DateTime)
+    first_response_at = Column(DateTime)
+    first_responder = Column(String)
+    first_response_seconds = Column(BigInteger)
+    closed_at = Column(DateTime)
+    close_seconds = Column(BigInteger)
+    merged_at = Column(DateTime)
+    merge_seconds = Column(BigInteger)
+    team_comments = Column(Integer)
+    community_comments = Column(Integer)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    __table_args__ = (Index("ix_issue_metrics_repo_created_at", "repo", "created_at"),)
+
+
+class DailyRepoCount(Base):
+    __tablename__ = "daily_repo_counts"
+    day = Column(Date, primary_key=True)
+    repo = Column(String, primary_key=True)
+    team = Column(Boolean, primary_key=True)
+    issues_opened = Column(Integer, default=0)
+    issues_closed = Column(Integer, default=0)
+    prs_opened = Column(Integer, default=0)
+    prs_closed = Column(Integer, default=0)
+    prs_merged = Column(Integer, default=0)
+    comments = Column(Integer, default=0)
+    reviews = Column(Integer, default=0)
+    contributors = Column(Integer, default=0)
+
+
+class DailyUserCount(Base):
+    __tablename__ = "daily_user_counts"
+    day = Column(Date, primary_key=True)
+    repo = Column(String, primary_key=True)
+    username = Column(String, primary_key=True)
+    team = Column(Boolean, primary_key=True)
+    issues_opened = Column(Integer, default=0)
+    prs_opened = Column(Integer, default=0)
+    comments = Column(Integer, default=0)
+    reviews = Column(Integer, default=0)
+    events = Column(Integer, default=0)
+
+    __table_args__ = (Index("ix_daily_user_counts_username_day", "username", "day"),)
+
+
+class DailyEventCount(Base):
+    __tablename__ = "daily_event_counts"
+    day = Column(Date, primary_key=True)
+    repo = Column(String, primary_key=True)
+    event = Column(String, primary_key=True)
+    team = Column(Boolean, primary_key=True)
+    count = Column(Integer, default=0)
+
+
+def model_columns(db_model):
+    """Column names of a DB table model.
+
+    Args:
+        db_model (sqlalchemy model): DB table model
+
+    Returns:
+        set: column names
+    """
+    return {col.name for col in db_model.__table__.columns}
+
+
+def to_record(db_model, rec):
+    """Drop keys that do not map to a column of `db_model`. GitHub payloads
+    (webhooks, archives) carry many more fields than are stored.
+
+    Args:
+        db_model (sqlalchemy model): DB table model
+        rec (dict): raw record
+
+    Returns:
+        dict: record restricted to the model columns
+    """
+    cols = model_columns(db_model)
+    return {k: v for k, v in rec.items() if k in cols}
+
+
+def upsert_records(db, db_model, recs, update_cols=None, newer_only=False):
+    """Insert records, updating rows that already exist (postgres
+    `ON CONFLICT DO UPDATE`). Records are grouped by key set so that
+    partial records only update the columns they carry. Duplicate
+    primary keys within `recs` are collapsed, the last one wins.
+
+    Does not commit; the caller owns the transaction.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        db_model (sqlalchemy model): DB table model
+        recs ([dict]): records keyed by column name
+        update_cols ([str], optional): Columns to update on conflict, an
+        empty list leaves existing rows untouched. Defaults to every
+        non-key column present in the record.
+        newer_only (bool, optional): Only update rows whose stored
+        `updated_at` is older than the incoming one. Defaults to False.
+
+    Returns:
+        int: number of records written
+    """
+    table = db_model.__table__
+    pk_cols = [col.name for col in table.primary_key.columns]
+
+    deduped = {}
+    for rec in recs:
+        deduped[tuple(rec[col] for col in pk_cols)] = rec
+
+    groups = {}
+    for rec in deduped.values():
+        groups.setdefault(tuple(sorted(rec.keys())), []).append(rec)
+
+    for keys, group in groups.items():
+        stmt = insert(table).values(group)
+        if update_cols is None:
+            cols = [k for k in keys if k not in pk_cols]
+        else:
+            cols = update_cols
+        cols = [col for col in cols if col in keys]
+        if not cols:
+            stmt = stmt.on_conflict_do_nothing(index_elements=pk_cols)
+        else:
+            where = None
+            if newer_only and "updated_at" in keys:
+                where = table.c.updated_at < stmt.excluded.updated_at
+            set_ = {col: stmt.excluded[col] for col in cols}
+            # `onupdate` is not applied to ON CONFLICT updates
+            if INGESTED_COL in table.c:
+                set_[INGESTED_COL] = func.now()
+            stmt = stmt.on_conflict_do_update(
+                index_elements=pk_cols, set_=set_, where=where
+            )
+        written = db.execute(stmt).rowcount
+        metrics.record_rows(
+            table.name, upserted=written, skipped=max(len(group) - written, 0)
+        )
+
+    return len(deduped)
+
+
 def create_all(db_url):
     engine = create_engine(db_url)
     Base.metadata.create_all(
@@ -183,9 +455,20 @@ def create_all(db_url):
         tables=[
             PullRequest.__table__,
             Member.__table__,
+            MemberInterval.__table__,
+            SyncState.__table__,
             Issue.__table__,
             Transfer.__table__,
+            TransferProbe.__table__,
+            BackfillUnit.__table__,
+            EventBackfill.__table__,
+            JobItem.__table__,
+            Lease.__table__,
             Event.__table__,
             EventPoll.__table__,
+            IssueMetric.__table__,
+            DailyRepoCount.__table__,
+            DailyUserCount.__table__,
+            DailyEventCount.__table__,
         ],
     )
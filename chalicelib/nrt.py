@@ -6,31 +6,36 @@
 
 """
 
-import time
 from datetime import date, timedelta
 
-import requests  # type: ignore
-
 
 try:
+    from chalicelib import metrics
     from chalicelib.github import (
         GitHubAPI,
         GitHubAPIException,
         create_or_update_issue,
         get_issues,
     )
-    from chalicelib.models import Event, EventPoll
+    from chalicelib.issue_metrics import refresh_issue_metrics
+    from chalicelib.membership import stamp_records
+    from chalicelib.models import Event, EventPoll, PullRequest
+    from chalicelib.profiling import profile_block
     from chalicelib.utils import send_plain_email
     from chalicelib.constants import REPOS, TRACKED_ISSUE_EVENTS
 
 except ModuleNotFoundError:
+    import metrics
     from github import (
         GitHubAPI,
         GitHubAPIException,
         create_or_update_issue,
         get_issues,
     )
-    from models import Event, EventPoll
+    from issue_metrics import refresh_issue_metrics
+    from membership import stamp_records
+    from models import Event, EventPoll, PullRequest
+    from profiling import profile_block
     from utils import send_plain_email
     from constants import REPOS, TRACKED_ISSUE_EVENTS
 
@@ -45,18 +50,15 @@ class TimelineAPI(GitHubAPI):
         if etag:
             headers["If-None-Match"] = etag
 
-        req = requests.get(url, headers=headers, params=params)
+        self.governor.acquire("core")
+        req = metrics.request("get", url, headers=headers, params=params)
 
         if req.status_code == 304:
             # no hit on rate limit
             return None
         if req.status_code == 200:
             # check rate from headers
-            if req.headers["x-ratelimit-remaining"] == 0:
-                pause = (req.headers["x-ratelimit-reset"] - time.time()) + 3
-                print(f"...waiting for {pause} seconds.")
-                time.sleep(pause)
-                print("...resuming.")
+            self.governor.update(req.headers)
             return req
         else:
             print(url)
@@ -106,13 +108,57 @@ def create_or_update_etag(db, etag, cached_etag, issue_id, page_no, issue_update
         db.commit()
 
 
+def format_event(event, issue_id, org, repo):
+    """Format a Timeline API event as an `Event` record.
+
+    Args:
+        event (dict): Timeline API event
+        issue_id (int): Issue Id related to event
+        org (str): GitHub organization
+        repo (str): GitHub repo
+
+    Returns:
+        dict: `Event` record
+    """
+    username = None
+
+    # document this
+    if event["event"] == "reviewed":
+        username = event["user"]["login"]
+        event["actor"] = event["user"]
+        event["created_at"] = event["submitted_at"]
+
+    else:
+        if event.get("actor", None):
+            username = event["actor"]["login"]
+
+    return {
+        "id": event["id"],
+        "issue_id": issue_id,
+        "org": org,
+        "repo": repo,
+        "event": event["event"],
+        "body": event.get("body", None),
+        "label": event.get("label", None),
+        "reactions": event.get("reactions", None),
+        "state": event.get("state", None),
+        "created_at": event["created_at"],
+        "updated_at": event.get("updated_at", None),
+        "author_association": event.get("author_association", None),
+        "node_id": event.get("node_id", None),
+        "user": event["actor"],
+        "username": username,
+    }
+
+
 def create_or_update_events(db, events, issue_id, org, repo):
     """Find all related events in the DB and update
     accordingly based on reactions and updated_at values.
     This logic is only applied to these fields as other
     event types trigger net new records.
 
-    If not in the DB, then create new records.
+    If not in the DB, then create new records and refresh the
+    issue's metrics.
 
     Note: `cross-referenced` - need to skip for now since
     no `event_id`.
@@ -157,37 +203,7 @@ def create_or_update_events(db, events, issue_id, org, repo):
 
             # determine new by comparing agaisnt existing
             if event_id not in existing_evts_recs.keys():
-                username = None
-
-                # document this
-                if event["event"] == "reviewed":
-                    username = event["user"]["login"]
-                    event["actor"] = event["user"]
-                    event["created_at"] = event["submitted_at"]
-
-                else:
-                    if event.get("actor", None):
-                        username = event["actor"]["login"]
-
-                evts_to_add.append(
-                    {
-                        "id": event_id,
-                        "issue_id": issue_id,
-                        "org": org,
-                        "repo": repo,
-                        "event": event["event"],
-                        "body": event.get("body", None),
-                        "label": event.get("label", None),
-                        "reactions": event.get("reactions", None),
-                        "state": event.get("state", None),
-                        "created_at": event["created_at"],
-                        "updated_at": event.get("updated_at", None),
-                        "author_association": event.get("author_association", None),
-                        "node_id": event.get("node_id", None),
-                        "user": event["actor"],
-                        "username": username,
-                    }
-                )
+                evts_to_add.append(format_event(event, issue_id, org, repo))
             # does it need updated in db
             # comparing updated_at and reactions here
             # want to make sure that all reaction updates
@@ -213,8 +229,17 @@ def create_or_update_events(db, events, issue_id, org, repo):
             return
         else:
             print("UPDATE ", issue_id)
+            stamp_records(db, evts_to_add)
             recs = [Event(**rec) for rec in evts_to_add]
             db.add_all(recs)
+
+            # merge state from the timeline, in case the
+            # search payload was stale
+            if any(rec["event"] == "merged" for rec in evts_to_add):
+                db.query(PullRequest).filter(PullRequest.id == issue_id).update(
+                    dict(merged=True)
+                )
+            refresh_issue_metrics(db, [issue_id])
             db.commit()
 
 
@@ -282,7 +307,9 @@ def get_timeline_events(
     return events
 
 
-def update_issue_activity(db, gh, db_model, since_dt=None, prs=True):
+def update_issue_activity(
+    db, gh, db_model, since_dt=None, prs=True, cache=None, repos=REPOS
+):
     """Updates Timeline event activity for recently updated GitHub
     issues
 
@@ -292,13 +319,15 @@ def update_issue_activity(db, gh, db_model, since_dt=None, prs=True):
         db_model (sqlalchemy model): DB table model that corresponds with datatype
         prs (bool, optional): Flag to indicate whether to search
         PRs or issues. Defaults to True (i.e. search PRs).
+        cache (SearchCache, optional): shared search results. Defaults to None.
+        repos ([str], optional): Defaults to REPOS.
     """
     org = "aws-amplify"
 
     if not since_dt:
         raise Exception("since_dt is required.")
 
-    for repo in REPOS:
+    for repo in repos:
 
         q = f"repo:{org}/{repo} updated:>={since_dt}"
 
@@ -307,7 +336,7 @@ def update_issue_activity(db, gh, db_model, since_dt=None, prs=True):
         else:
             q += " is:issue "
 
-        issues = get_issues(gh, query=q)
+        issues = get_issues(gh, query=q, cache=cache)
         issue_ids = [issue["id"] for issue in issues]
 
         # find existing issue timeline/page etags
@@ -324,18 +353,24 @@ def update_issue_activity(db, gh, db_model, since_dt=None, prs=True):
         existing_recs = db.query(db_model).filter(db_model.id.in_(issue_ids)).all()
         existing_rec_ids = {rec.id: rec for rec in existing_recs}
 
+        written_ids = []
         for issue in issues:
             issue_id = issue["id"]
             issue_updated_at = issue["updated_at"]
             timeline_url = issue["timeline_url"]
 
-            create_or_update_issue(db, db_model, issue, existing_rec_ids)
+            if create_or_update_issue(db, db_model, issue, existing_rec_ids):
+                written_ids.append(issue_id)
 
             events = get_timeline_events(
                 db, gh, issue_id, existing_cache_ids, timeline_url, issue_updated_at
             )
             create_or_update_events(db, events, issue_id, org, repo)
 
+        # metrics of the items written above, once per repo
+        refresh_issue_metrics(db, written_ids)
+        db.commit()
+
     db.close()
 
 
@@ -355,10 +390,10 @@ if __name__ == "__main__":
     db = create_db_session(db_url)
 
     today = date.today()
-    # backfill
-    # since_dt = today - timedelta(weeks=300)
+    # full history: python -m chalicelib.backfill --events
 
     since_dt = today - timedelta(days=4)
 
-    update_issue_activity(db, gh, Issue, since_dt, prs=False)
-    # update_issue_activity(db, gh, PullRequest, since_dt, prs=True)
+    with profile_block("nrt"):
+        update_issue_activity(db, gh, Issue, since_dt, prs=False)
+        # update_issue_activity(db, gh, PullRequest, since_dt, prs=True)
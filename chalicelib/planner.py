@@ -0,0 +1,401 @@
+"""
+    planner.py
+    ~~~~~~~~~~
+
+    Dry-run API cost planner for the scheduled jobs and backfills.
+
+    Estimates the requests a run will make per rate limit bucket without
+    running it or writing anything. Search volumes come from
+    `total_count` probes (`per_page=1`, one search request each), timeline
+    pages, member list pages, probe results and backfill progress from
+    the stored state (`event_polls`, `sync_state`, `transfer_probes`,
+    `backfill_units`, `event_backfills`). Totals are compared with the
+    current rate limits to estimate the wall time.
+
+    Estimates are upper bounds for conditional requests (timeline pages,
+    member pages): those answered `304 Not Modified` do not count against
+    the rate limit.
+
+    python -m chalicelib.planner --job nrt_events
+    python -m chalicelib.planner --job backfill --repo amplify-js --start 2020-01-01
+
+"""
+import math
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, select
+
+from chalicelib.backfill import KINDS, OPEN_STATUSES, ORG, plan_slices, unit_key
+from chalicelib.constants import REPOS
+from chalicelib.github import MEMBERS_SYNC_KEY, SEARCH_RESULT_LIMIT
+from chalicelib.models import (
+    BackfillUnit,
+    EventBackfill,
+    EventPoll,
+    Issue,
+    Member,
+    PullRequest,
+    SyncState,
+    TransferProbe,
+)
+from chalicelib.transfers import FIND_TRANSFERRED_ISSUES_STMT, PROBE_TTL
+
+
+PAGE_SIZE = 100
+
+# average seconds per request, used for the wall time
+REQUEST_SECONDS = 0.5
+
+# rate limit windows (seconds)
+WINDOWS = {"core": 3600, "search": 60, "graphql": 3600}
+
+
+def search_pages(total_count):
+    """Pages a search of `total_count` results takes (at least one,
+    at most the 1000 results the search API returns)."""
+    return max(1, math.ceil(min(total_count, SEARCH_RESULT_LIMIT) / PAGE_SIZE))
+
+
+class Plan:
+    """Line items of estimated requests."""
+
+    def __init__(self):
+        self.items = []
+        self.probes = 0
+
+    def add(self, step, repo, bucket, requests, note=""):
+        self.items.append(
+            {
+                "step": step,
+                "repo": repo,
+                "bucket": bucket,
+                "requests": requests,
+                "note": note,
+            }
+        )
+
+    def count(self, gh, query):
+        """`total_count` of a search, with one `per_page=1` request."""
+        self.probes += 1
+        return gh.get("/search/issues", q=query, per_page=1)["total_count"]
+
+    def totals(self):
+        totals = {}
+        for item in self.items:
+            totals[item["bucket"]] = totals.get(item["bucket"], 0) + item["requests"]
+        return totals
+
+
+def stored_pages(db, db_model, repo, since_dt=None, pending_only=False):
+    """Timeline pages stored for issues of a repo, counting issues
+    without stored pages as one page.
+
+    Returns:
+        tuple: (number of issues, number of pages)
+    """
+    pages = (
+        select(EventPoll.id, func.count().label("pages"))
+        .group_by(EventPoll.id)
+        .subquery()
+    )
+    q = (
+        db.query(func.count(db_model.id), func.sum(func.coalesce(pages.c.pages, 1)))
+        .outerjoin(pages, pages.c.id == db_model.id)
+        .filter(db_model.repo == repo)
+    )
+    if since_dt:
+        q = q.filter(db_model.updated_at >= since_dt)
+    if pending_only:
+        done = select(EventBackfill.issue_id).where(EventBackfill.status == "done")
+        q = q.filter(~db_model.id.in_(done))
+    issues, total = q.one()
+    return issues or 0, int(total or 0)
+
+
+def plan_search(plan, gh, step, repo, query):
+    tc = plan.count(gh, query)
+    note = f"{tc} results"
+    if tc > SEARCH_RESULT_LIMIT:
+        note += f", capped at {SEARCH_RESULT_LIMIT}"
+    plan.add(step, repo, "search", search_pages(tc), note)
+    return tc
+
+
+def plan_sweeps(plan, gh, step, repos, since_dt, queries):
+    """Search requests of a job: one cached `updated:>=` sweep per repo,
+    or the job's own searches when the sweep is too large to cache.
+
+    Returns:
+        dict: {repo: sweep total_count}
+    """
+    counts = {}
+    for repo in repos:
+        q = f"repo:{ORG}/{repo} updated:>={since_dt}"
+        tc = plan.count(gh, q)
+        counts[repo] = tc
+        if tc <= SEARCH_RESULT_LIMIT:
+            plan.add(step, repo, "search", search_pages(tc), f"sweep, {tc} results")
+            continue
+        for name, query in queries(repo):
+            plan_search(plan, gh, name, repo, query)
+    return counts
+
+
+def plan_transfers(plan, db):
+    candidates = db.execute(FIND_TRANSFERRED_ISSUES_STMT).fetchall()
+    ids = [rec.id for rec in candidates]
+    expires = datetime.utcnow() - PROBE_TTL
+    cached = (
+        db.query(func.count(TransferProbe.issue_id))
+        .filter(
+            TransferProbe.issue_id.in_(ids),
+            TransferProbe.transferred | (TransferProbe.probed_at > expires),
+        )
+        .scalar()
+        if ids
+        else 0
+    )
+    plan.add(
+        "transfers",
+        "*",
+        "core",
+        len(ids) - cached,
+        f"{len(ids)} candidates, {cached} cached probes",
+    )
+
+
+def plan_every_30_min(db, gh, repos=REPOS):
+    plan = Plan()
+    today = date.today()
+    created_dt = today - timedelta(days=5)
+    closed_dt = today - timedelta(weeks=1)
+
+    def queries(repo):
+        for kind in ("pr", "issue"):
+            yield f"{kind}s_created", (
+                f"repo:{ORG}/{repo} created:>={created_dt} is:{kind}"
+            )
+            yield f"{kind}s_closed", f"repo:{ORG}/{repo} closed:>={closed_dt} is:{kind}"
+
+    plan_sweeps(plan, gh, "search_cache", repos, closed_dt, queries)
+
+    state = db.query(SyncState).get(MEMBERS_SYNC_KEY)
+    pages = len(state.etag.split("|")) if state and state.etag else None
+    if pages is None:
+        members = (
+            db.query(func.count(Member.id)).filter(Member.inactive.isnot(True)).scalar()
+        )
+        pages = members // PAGE_SIZE + 1
+        plan.add("members", "*", "core", pages, "no stored ETags")
+    else:
+        # unchanged pages are 304s, changed lists are fetched again
+        plan.add("members", "*", "core", pages * 2, f"{pages} conditional pages")
+
+    plan_transfers(plan, db)
+    return plan
+
+
+def plan_nrt_events(db, gh, repos=REPOS):
+    plan = Plan()
+    since_dt = date.today() - timedelta(days=1)
+
+    def queries(repo):
+        for kind in ("pr", "issue"):
+            yield f"{kind}_activity", (
+                f"repo:{ORG}/{repo} updated:>={since_dt} is:{kind}"
+            )
+
+    counts = plan_sweeps(plan, gh, "search_cache", repos, since_dt, queries)
+
+    for repo in repos:
+        known, pages = 0, 0
+        for db_model in (Issue, PullRequest):
+            issues, issue_pages = stored_pages(db, db_model, repo, since_dt)
+            known += issues
+            pages += issue_pages
+        new = max(counts[repo] - known, 0)
+        plan.add(
+            "activity",
+            repo,
+            "core",
+            pages + new,
+            f"{known} stored issues ({pages} pages), {new} new",
+        )
+
+    plan_transfers(plan, db)
+    return plan
+
+
+def plan_backfill_cost(
+    db, gh, repos=REPOS, kinds=KINDS, start_dt=None, end_dt=None, months=3
+):
+    """Searches of the units a backfill would run: units not done yet,
+    and units that would be planned."""
+    plan = Plan()
+    start_dt = start_dt or date(2017, 1, 1)
+    end_dt = end_dt or date.today()
+
+    stored = {
+        rec.key: rec.status
+        for rec in db.query(BackfillUnit.key, BackfillUnit.status).filter(
+            BackfillUnit.repo.in_(list(repos))
+        )
+    }
+    for repo in repos:
+        for kind in kinds:
+            for first, last in plan_slices(start_dt, end_dt, months):
+                key = unit_key(kind, repo, first, last)
+                if stored.get(key, "pending") not in OPEN_STATUSES:
+                    continue
+                q = f"repo:{ORG}/{repo} is:{kind} created:{first}..{last}"
+                tc = plan.count(gh, q)
+                # units over the limit are split until they fit
+                splits = max(0, math.ceil(tc / SEARCH_RESULT_LIMIT) - 1) * 2
+                plan.add(
+                    "backfill",
+                    repo,
+                    "search",
+                    math.ceil(tc / PAGE_SIZE) + splits or 1,
+                    f"{kind} {first}..{last}, {tc} results",
+                )
+    return plan
+
+
+def plan_event_backfill(db, repos=REPOS, kinds=KINDS):
+    plan = Plan()
+    for repo in repos:
+        for kind in kinds:
+            issues, pages = stored_pages(db, KINDS[kind], repo, pending_only=True)
+            plan.add(
+                "event_backfill",
+                repo,
+                "core",
+                pages,
+                f"{issues} {kind}s not backfilled",
+            )
+    return plan
+
+
+def estimate(plan, rate, request_seconds=REQUEST_SECONDS):
+    """Compare a plan with the current rate limits.
+
+    Args:
+        plan (Plan): estimated requests
+        rate (dict): `resources` of the `/rate_limit` response
+        request_seconds (float, optional): Defaults to REQUEST_SECONDS.
+
+    Returns:
+        dict: per bucket requests, remaining budget, whether it fits and
+        the wait for resets, plus the estimated wall time
+    """
+    now = time.time()
+    # probes are already spent, `rate` is read after them
+    totals = plan.totals()
+    buckets = {}
+    wait = 0
+    for bucket in sorted(set(totals) | {"core", "search", "graphql"}):
+        requests = totals.get(bucket, 0)
+        limit = rate.get(bucket, {})
+        remaining = limit.get("remaining", 0)
+        bucket_wait = 0
+        if requests > remaining:
+            # wait for the reset, then a full window per limit
+            bucket_wait = max(limit.get("reset", now) - now, 0)
+            extra = requests - remaining
+            bucket_wait += (
+                (extra - 1) // max(limit.get("limit", 1), 1) * WINDOWS.get(bucket, 3600)
+            )
+        wait = max(wait, bucket_wait)
+        buckets[bucket] = {
+            "requests": requests,
+            "remaining": remaining,
+            "limit": limit.get("limit"),
+            "fits": requests <= remaining,
+            "wait_seconds": round(bucket_wait),
+        }
+
+    requests = sum(totals.values())
+    return {
+        "buckets": buckets,
+        "probe_requests": plan.probes,
+        "wall_seconds": round(wait + requests * request_seconds),
+    }
+
+
+def print_plan(plan, summary):
+    for item in plan.items:
+        print(
+            f"{item['step']:<16} {item['repo']:<28} {item['bucket']:<7} "
+            f"{item['requests']:>7}  {item['note']}"
+        )
+    print()
+    for bucket, rec in summary["buckets"].items():
+        fits = "fits" if rec["fits"] else f"waits {rec['wait_seconds']}s"
+        print(
+            f"{bucket:<8} {rec['requests']:>7} requests, "
+            f"{rec['remaining']}/{rec['limit']} remaining, {fits}"
+        )
+    print(f"{summary['probe_requests']} search requests spent on probes")
+    print("graphql: no requests, the jobs only use the REST API")
+    print(f"estimated wall time: {timedelta(seconds=summary['wall_seconds'])}")
+
+
+PLANNERS = {
+    "every_30_min": lambda db, gh, args: plan_every_30_min(db, gh, args.repos),
+    "nrt_events": lambda db, gh, args: plan_nrt_events(db, gh, args.repos),
+    "backfill": lambda db, gh, args: plan_backfill_cost(
+        db, gh, args.repos, args.kinds, args.start, args.end, args.months
+    ),
+    "events": lambda db, gh, args: plan_event_backfill(db, args.repos, args.kinds),
+}
+
+
+def dry_run(db, gh, job, args):
+    """Plan a job, compare it with the rate limits and print both.
+    Nothing is written; the session is rolled back.
+
+    Returns:
+        dict: see `estimate`
+    """
+    try:
+        plan = PLANNERS[job](db, gh, args)
+    finally:
+        db.rollback()
+        db.close()
+    rate = gh.get("/rate_limit")["resources"]
+    summary = estimate(plan, rate)
+    print_plan(plan, summary)
+    return summary
+
+
+def add_arguments(parser):
+    parser.add_argument("--repo", action="append", help="defaults to all REPOS")
+    parser.add_argument("--kind", action="append", choices=list(KINDS))
+    parser.add_argument("--start", type=date.fromisoformat, default=date(2017, 1, 1))
+    parser.add_argument("--end", type=date.fromisoformat, default=date.today())
+    parser.add_argument("--months", type=int, default=3, help="slice size")
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    from dotenv import load_dotenv
+
+    from chalicelib.github import GitHubAPI
+    from chalicelib.models import create_db_session
+
+    parser = argparse.ArgumentParser(description="Estimate the API cost of a run.")
+    parser.add_argument("--job", choices=list(PLANNERS), default="every_30_min")
+    add_arguments(parser)
+    args = parser.parse_args()
+    args.repos = args.repo or REPOS
+    args.kinds = args.kind or list(KINDS)
+
+    load_dotenv()
+
+    db = create_db_session(os.getenv("DB_URL"))
+    gh = GitHubAPI(token=os.getenv("GH_TOKEN"))
+
+    dry_run(db, gh, args.job, args)
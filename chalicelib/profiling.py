@@ -0,0 +1,114 @@
+"""
+    profiling.py
+    ~~~~~~~~~~~~
+
+    Opt-in profiling of scheduled functions and scripts.
+
+    Set `CM_PROFILE=1` to profile everything, or a comma-separated list
+    of names (e.g. `CM_PROFILE=nrt_events,transfers`). Each profiled run
+    writes two files to `CM_PROFILE_DIR` (default `/tmp`):
+
+    - `<name>-<timestamp>.prof`: cProfile stats, for `pstats`/snakeviz
+    - `<name>-<timestamp>.txt`: wall and CPU time, peak traced memory,
+      and the hottest functions by own and cumulative time
+
+    When the variable is unset, the wrappers only read it and call
+    through.
+
+"""
+import cProfile
+import io
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+PROFILE_ENV = "CM_PROFILE"
+PROFILE_DIR_ENV = "CM_PROFILE_DIR"
+
+# functions listed per sort order in the report
+TOP_FUNCTIONS = 30
+
+
+def enabled(name):
+    value = os.getenv(PROFILE_ENV)
+    if not value:
+        return False
+    names = {part.strip() for part in value.split(",")}
+    return bool(names & {"1", "true", "all", name})
+
+
+def write_report(name, profiler, wall, cpu, peak):
+    """Write the cProfile stats and a text summary.
+
+    Returns:
+        str: path of the text summary
+    """
+    out_dir = os.getenv(PROFILE_DIR_ENV, "/tmp")
+    os.makedirs(out_dir, exist_ok=True)
+    base = os.path.join(out_dir, f"{name}-{time.strftime('%Y%m%dT%H%M%S')}")
+    profiler.dump_stats(f"{base}.prof")
+
+    buf = io.StringIO()
+    buf.write(f"{name}\n")
+    buf.write(f"wall: {wall:.3f} s\n")
+    buf.write(f"cpu: {cpu:.3f} s\n")
+    buf.write(f"peak memory (traced): {peak / 1024 / 1024:.1f} MiB\n\n")
+    stats = pstats.Stats(profiler, stream=buf)
+    for sort in ("tottime", "cumulative"):
+        buf.write(f"--- top {TOP_FUNCTIONS} by {sort} ---\n")
+        stats.sort_stats(sort).print_stats(TOP_FUNCTIONS)
+
+    with open(f"{base}.txt", "w") as f:
+        f.write(buf.getvalue())
+    print(f"profile of {name} written to {base}.txt / .prof")
+    return f"{base}.txt"
+
+
+@contextmanager
+def profile_block(name):
+    """Profile a block when `name` is enabled by `CM_PROFILE`."""
+    if not enabled(name):
+        yield
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    wall, cpu = time.perf_counter(), time.process_time()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        _, peak = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+        write_report(name, profiler, wall, cpu, peak)
+
+
+def profiled(name):
+    """Decorator version of `profile_block`.
+
+    @app.schedule("rate(10 minutes)")
+    @profiled("nrt_events")
+    def nrt_events(event):
+        ...
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled(name):
+                return fn(*args, **kwargs)
+            with profile_block(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,123 @@
+"""
+    queues.py
+    ~~~~~~~~~
+
+    Message queues used to hand work from the API routes to writers
+    and from job coordinators to workers. `SQSQueue` is used when
+    deployed, `LocalQueue` and `PoolQueue` are in-process stand-ins.
+
+"""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from chalicelib.utils import get_client
+except ModuleNotFoundError:
+    from utils import get_client
+
+
+class LocalQueue:
+    """In-process stand-in for an SQS queue. Messages are buffered and
+    handed to `handler` in batches of `batch_size`.
+    """
+
+    def __init__(self, handler, batch_size=10):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+        if len(self.messages) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        while self.messages:
+            batch = self.messages[: self.batch_size]
+            self.messages = self.messages[self.batch_size :]
+            self.handler(batch)
+
+
+class PoolQueue:
+    """In-process stand-in for an SQS queue with parallel consumers.
+    Each message is handed to `handler` on a thread pool of
+    `max_workers`; `flush` waits for all of them and returns
+    their results in send order.
+    """
+
+    def __init__(self, handler, max_workers=4):
+        self.handler = handler
+        self.max_workers = max_workers
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+    def flush(self):
+        messages, self.messages = self.messages, []
+        if not messages:
+            return []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(self.handler, messages))
+
+
+class SQSQueue:
+    """Send JSON messages to an SQS queue, ten at a time
+    (the `send_message_batch` limit). Entries the batch call reports as
+    failed (e.g. throttled) are resent, up to `send_attempts` calls;
+    entries still failing raise, so the sender fails instead of losing
+    them.
+    """
+
+    batch_size = 10
+    send_attempts = 3
+
+    def __init__(self, queue_name, client=None, delay_seconds=0):
+        self.queue_name = queue_name
+        self.client = client
+        self.delay_seconds = delay_seconds
+        self.queue_url = None
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+        if len(self.messages) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.messages and not self.queue_url:
+            # resolved on first use so that the app can be imported
+            # without AWS credentials (e.g. `chalice deploy`)
+            self.client = self.client or get_client("sqs")
+            self.queue_url = self.client.get_queue_url(QueueName=self.queue_name)[
+                "QueueUrl"
+            ]
+        while self.messages:
+            batch = self.messages[: self.batch_size]
+            self.messages = self.messages[self.batch_size :]
+            self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        entries = [
+            {
+                "Id": str(i),
+                "MessageBody": json.dumps(msg),
+                "DelaySeconds": self.delay_seconds,
+            }
+            for i, msg in enumerate(batch)
+        ]
+        for attempt in range(self.send_attempts):
+            if attempt:
+                time.sleep(2**attempt / 10)
+            res = self.client.send_message_batch(
+                QueueUrl=self.queue_url, Entries=entries
+            )
+            failed = {entry["Id"]: entry for entry in res.get("Failed", [])}
+            entries = [entry for entry in entries if entry["Id"] in failed]
+            if not entries:
+                return
+        codes = sorted({entry["Code"] for entry in failed.values()})
+        raise RuntimeError(
+            f"{len(entries)} messages not sent to {self.queue_name}: {codes}"
+        )
@@ -0,0 +1,311 @@
+"""
+    rollups.py
+    ~~~~~~~~~~
+
+    Daily rollups of issues, PRs and timeline events, split between team
+    (org members at the time, per `author_is_member`) and community:
+
+    - `daily_repo_counts`: items opened/closed/merged, comments, reviews
+      and distinct contributors per day, repo and team
+    - `daily_user_counts`: the same per user
+    - `daily_event_counts`: timeline events per day, repo and event type
+
+    Issues, PRs and events carry `ingested_dt`, set whenever a row is
+    inserted or updated. `refresh_rollups` recomputes only the
+    (day, repo) pairs of rows ingested since the watermark of the
+    previous refresh (kept in `sync_state`), in one transaction.
+    `rebuild_rollups` recomputes every day, or the days from a date on;
+    the daily job rebuilds the last week to pick up what the watermark
+    cannot see (transferred issues that were deleted, and days left
+    without any row). Both hold the `rollups` lease. Membership changes
+    re-stamp rows, which moves their `ingested_dt`.
+
+    python -m chalicelib.rollups --rebuild
+    python -m chalicelib.rollups --rebuild --start 2024-01-01
+
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy.sql import text
+
+try:
+    from chalicelib import metrics
+    from chalicelib.leases import lease
+    from chalicelib.models import SyncState, upsert_records
+except ModuleNotFoundError:
+    import metrics
+    from leases import lease
+    from models import SyncState, upsert_records
+
+ROLLUPS_SYNC_KEY = "daily_rollups"
+
+# held by the refresh step of `nrt_events` and by rebuilds, which
+# delete and insert the same rows
+ROLLUPS_LEASE = "rollups"
+
+# overlap with the previous refresh: rows written by transactions still
+# open when it ran carry an earlier `ingested_dt` (longer than the Lambda
+# timeout)
+WATERMARK_LAG = timedelta(minutes=15)
+
+# (day, repo) pairs to recompute, of rows ingested since `:since` and on or
+# after `:start_dt`; either bound can be null
+ROLLUP_DAYS_STMT = text(
+    """
+DROP TABLE IF EXISTS rollup_days;
+CREATE TEMP TABLE rollup_days ON COMMIT DROP AS
+SELECT DISTINCT
+	day, repo
+FROM (
+	SELECT CAST(created_at AS date) AS day, repo, ingested_dt FROM public.issues
+	UNION ALL
+	SELECT CAST(closed_at AS date), repo, ingested_dt FROM public.issues
+	UNION ALL
+	SELECT CAST(created_at AS date), repo, ingested_dt FROM public.pull_requests
+	UNION ALL
+	SELECT CAST(closed_at AS date), repo, ingested_dt FROM public.pull_requests
+	UNION ALL
+	SELECT CAST(created_at AS date), repo, ingested_dt FROM public.events) d
+WHERE
+	day IS NOT NULL
+	AND (CAST(:since AS timestamp) IS NULL OR ingested_dt >= CAST(:since AS timestamp))
+	AND (CAST(:start_dt AS date) IS NULL OR day >= CAST(:start_dt AS date));
+"""
+)
+
+# rows written before stamps were kept fall back to `member_intervals`
+IS_MEMBER_SQL = """coalesce(a.stamp, EXISTS (
+			SELECT 1 FROM public.member_intervals mi
+			WHERE mi.login = a.username
+				AND mi.joined_at <= a.ts
+				AND (mi.left_at IS NULL OR mi.left_at > a.ts)))"""
+
+# activity on the recomputed days; items count for their author's
+# membership when they were opened, events for the actor's at the time
+# (`author_is_member`, stamped at ingestion)
+ROLLUP_ACTIVITY_STMT = text(
+    f"""
+DROP TABLE IF EXISTS rollup_activity;
+CREATE TEMP TABLE rollup_activity ON COMMIT DROP AS
+WITH activity AS (
+	SELECT d.day, d.repo, i.username, i.created_at AS ts, i.author_is_member AS stamp,
+		'issue_opened' AS kind, 'item' AS source
+	FROM rollup_days d JOIN public.issues i
+		ON i.repo = d.repo AND i.created_at >= d.day AND i.created_at < d.day + 1
+	UNION ALL
+	SELECT d.day, d.repo, i.username, i.created_at, i.author_is_member, 'issue_closed', 'item'
+	FROM rollup_days d JOIN public.issues i
+		ON i.repo = d.repo AND i.closed_at >= d.day AND i.closed_at < d.day + 1
+	UNION ALL
+	SELECT d.day, d.repo, pr.username, pr.created_at, pr.author_is_member, 'pr_opened', 'item'
+	FROM rollup_days d JOIN public.pull_requests pr
+		ON pr.repo = d.repo AND pr.created_at >= d.day AND pr.created_at < d.day + 1
+	UNION ALL
+	SELECT d.day, d.repo, pr.username, pr.created_at, pr.author_is_member,
+		CASE WHEN pr.merged THEN 'pr_merged' ELSE 'pr_closed' END, 'item'
+	FROM rollup_days d JOIN public.pull_requests pr
+		ON pr.repo = d.repo AND pr.closed_at >= d.day AND pr.closed_at < d.day + 1
+	UNION ALL
+	SELECT d.day, d.repo, e.username, e.created_at, e.author_is_member, e.event, 'event'
+	FROM rollup_days d JOIN public.events e
+		ON e.repo = d.repo AND e.created_at >= d.day AND e.created_at < d.day + 1
+)
+SELECT
+	a.day, a.repo, a.username, a.kind, a.source,
+	{IS_MEMBER_SQL} AS team
+FROM
+	activity a;
+"""
+)
+
+DELETE_ROLLUP_SQL = """
+DELETE FROM public.{table} t
+USING rollup_days d
+WHERE t.day = d.day AND t.repo = d.repo;
+"""
+
+# on a rebuild, (day, repo) pairs on or after `:start_dt` (all, when null)
+# left without any row, e.g. once their only issues were transferred away
+DELETE_ORPHAN_ROLLUP_SQL = """
+DELETE FROM public.{table} t
+WHERE
+	(CAST(:start_dt AS date) IS NULL OR t.day >= CAST(:start_dt AS date))
+	AND NOT EXISTS (
+		SELECT 1 FROM rollup_days d WHERE d.day = t.day AND d.repo = t.repo);
+"""
+
+INSERT_ROLLUP_STMTS = {
+    "daily_repo_counts": text(
+        """
+INSERT INTO public.daily_repo_counts (
+	day, repo, team, issues_opened, issues_closed, prs_opened, prs_closed,
+	prs_merged, comments, reviews, contributors)
+SELECT
+	day, repo, team,
+	count(*) FILTER (WHERE kind = 'issue_opened'),
+	count(*) FILTER (WHERE kind = 'issue_closed'),
+	count(*) FILTER (WHERE kind = 'pr_opened'),
+	count(*) FILTER (WHERE kind IN ('pr_closed', 'pr_merged')),
+	count(*) FILTER (WHERE kind = 'pr_merged'),
+	count(*) FILTER (WHERE kind = 'commented'),
+	count(*) FILTER (WHERE kind = 'reviewed'),
+	count(DISTINCT username) FILTER (
+		WHERE kind IN ('issue_opened', 'pr_opened', 'commented', 'reviewed'))
+FROM
+	rollup_activity
+GROUP BY
+	day, repo, team;
+"""
+    ),
+    "daily_user_counts": text(
+        """
+INSERT INTO public.daily_user_counts (
+	day, repo, username, team, issues_opened, prs_opened, comments, reviews, events)
+SELECT
+	day, repo, username, team,
+	count(*) FILTER (WHERE kind = 'issue_opened'),
+	count(*) FILTER (WHERE kind = 'pr_opened'),
+	count(*) FILTER (WHERE kind = 'commented'),
+	count(*) FILTER (WHERE kind = 'reviewed'),
+	count(*) FILTER (WHERE source = 'event')
+FROM
+	rollup_activity
+WHERE
+	username IS NOT NULL
+	AND kind NOT IN ('issue_closed', 'pr_closed', 'pr_merged')
+GROUP BY
+	day, repo, username, team;
+"""
+    ),
+    "daily_event_counts": text(
+        """
+INSERT INTO public.daily_event_counts (day, repo, event, team, count)
+SELECT
+	day, repo, kind, team, count(*)
+FROM
+	rollup_activity
+WHERE
+	source = 'event'
+GROUP BY
+	day, repo, kind, team;
+"""
+    ),
+}
+
+
+def _recompute(db, since=None, start_dt=None):
+    """Recompute the rollups of the (day, repo) pairs selected by
+    `since`/`start_dt` (see `ROLLUP_DAYS_STMT`). Without `since` (a
+    rebuild), rollups of pairs that no longer have any row are deleted.
+    Does not commit.
+
+    Returns:
+        int: number of (day, repo) pairs recomputed
+    """
+    db.execute(ROLLUP_DAYS_STMT, {"since": since, "start_dt": start_dt})
+    days = db.execute(text("SELECT count(*) FROM rollup_days")).scalar()
+
+    if since is None:
+        for table in INSERT_ROLLUP_STMTS:
+            deleted = db.execute(
+                text(DELETE_ORPHAN_ROLLUP_SQL.format(table=table)),
+                {"start_dt": start_dt},
+            ).rowcount
+            metrics.record_rows(table, deleted=deleted)
+    if not days:
+        return 0
+
+    db.execute(ROLLUP_ACTIVITY_STMT)
+    for table, stmt in INSERT_ROLLUP_STMTS.items():
+        deleted = db.execute(text(DELETE_ROLLUP_SQL.format(table=table))).rowcount
+        inserted = db.execute(stmt).rowcount
+        metrics.record_rows(table, deleted=deleted, inserted=inserted)
+    return days
+
+
+def _set_watermark(db, watermark):
+    upsert_records(
+        db,
+        SyncState,
+        [{"key": ROLLUPS_SYNC_KEY, "value": watermark.isoformat()}],
+    )
+
+
+def refresh_rollups(db):
+    """Recompute the rollups of the days touched by rows ingested since
+    the previous refresh, and move the watermark. The first refresh
+    rebuilds everything.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+
+    Returns:
+        int: number of (day, repo) pairs recomputed
+    """
+    state = db.query(SyncState).get(ROLLUPS_SYNC_KEY)
+    since = None
+    if state and state.value:
+        since = datetime.fromisoformat(state.value) - WATERMARK_LAG
+
+    # transaction start, the `ingested_dt` of anything written after it
+    # is later
+    watermark = db.execute(text("SELECT CAST(now() AS timestamp)")).scalar()
+    days = _recompute(db, since=since)
+    _set_watermark(db, watermark)
+    db.commit()
+    db.close()
+    print(f"rollups refreshed since {since}: {days} days.")
+    return days
+
+
+def rebuild_rollups(db, start_dt=None):
+    """Recompute the rollups of every day, or of the days on or after
+    `start_dt`, under the rollups lease. Skipped while a refresh holds
+    it; the next rebuild covers the same days.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        start_dt (date, optional): Defaults to None (all days).
+
+    Returns:
+        int: number of (day, repo) pairs recomputed, None if skipped
+    """
+    with lease(db, ROLLUPS_LEASE) as held:
+        if not held:
+            print("rollups lease held, rebuild skipped.")
+            return None
+        watermark = db.execute(text("SELECT CAST(now() AS timestamp)")).scalar()
+        days = _recompute(db, start_dt=start_dt)
+        if start_dt is None:
+            _set_watermark(db, watermark)
+        db.commit()
+    db.close()
+    print(f"rollups rebuilt from {start_dt}: {days} days.")
+    return days
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    from datetime import date
+
+    from dotenv import load_dotenv
+
+    from chalicelib.models import create_db_session
+
+    parser = argparse.ArgumentParser(description="Refresh the daily rollups.")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="recompute instead of refreshing"
+    )
+    parser.add_argument(
+        "--start", type=date.fromisoformat, help="with --rebuild, the first day"
+    )
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    db = create_db_session(os.getenv("DB_URL"))
+    if args.rebuild:
+        rebuild_rollups(db, args.start)
+    else:
+        refresh_rollups(db)
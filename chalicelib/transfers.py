@@ -6,32 +6,60 @@
     
 
 """
+import contextvars
 import os
-import time
-import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.sql import text
-from sqlalchemy.exc import IntegrityError
 
 
 try:
+    from chalicelib import metrics
     from chalicelib.github import GitHubAPI
+    from chalicelib.profiling import profile_block
     from chalicelib.models import (
         create_db_session,
         Issue,
+        IssueMetric,
         Transfer,
+        TransferProbe,
         Event,
         EventPoll,
+        upsert_records,
     )
 except ModuleNotFoundError:
+    import metrics
     from github import GitHubAPI
+    from profiling import profile_block
     from models import (
         create_db_session,
         Issue,
+        IssueMetric,
         Transfer,
+        TransferProbe,
         Event,
         EventPoll,
+        upsert_records,
     )
 
+# concurrent probe requests
+PROBE_WORKERS = 8
+
+# how long a "not transferred" probe result is trusted
+PROBE_TTL = timedelta(days=30)
+
+# answers that settle whether an issue was transferred; anything else
+# (403, 429, 5xx, a 301 without `Location`) is probed again next run
+CONCLUSIVE_PROBE_STATUSES = (200, 404)
+
+
+def is_conclusive(probe):
+    return probe["transferred"] or probe["status_code"] in CONCLUSIVE_PROBE_STATUSES
+
+
 FIND_TRANSFERRED_ISSUES_STMT = text(
     """
 SELECT
@@ -55,38 +83,173 @@ ORDER BY
 
 
 class TransferAPI(GitHubAPI):
-    def get_issue(self, url, allow_redirects=False, **params):
+    def probe_issue(self, url):
+        """HEAD request for an issue, without following redirects.
+        A transferred issue answers 301 with the new issue in `Location`.
+
+        Args:
+            url (str): GitHub REST API issue url
+
+        Returns:
+            tuple: (status code, `Location` header or None)
+        """
         headers = {
             "Accept": "application/vnd.github.v3+json",
             "Authorization": "token " + self.token,
             "X-GitHub-Api-Version": self.gh_api_version,
         }
 
-        req = requests.get(
-            url, headers=headers, params=params, allow_redirects=allow_redirects
-        )
+        self.governor.acquire("core")
+        req = metrics.request("head", url, headers=headers, allow_redirects=False)
+        self.check_rate_headers(req)
+        return req.status_code, req.headers.get("Location", None)
 
-        if req.status_code == 301:
-            self.check_rate_headers(req)
-            return req
+    def check_rate_headers(self, req):
+        self.governor.update(req.headers)
 
-        else:
-            self.check_rate_headers(req)
-            return None
 
-    def check_rate_headers(self, req):
-        if req.headers["x-ratelimit-remaining"] == 0:
-            pause = (req.headers["x-ratelimit-reset"] - time.time()) + 3
-            print(f"...waiting for {pause} seconds.")
-            time.sleep(pause)
-            print("...resuming.")
+def probe_transfers(gh, issues, max_workers=PROBE_WORKERS):
+    """Probe candidate issues concurrently. Requests share the
+    rate governor of `gh`.
+
+    Args:
+        gh (TransferAPI): instance of TransferAPI helper with token
+        issues ([row]): candidate issue rows with `id` and `url`
+        max_workers (int, optional): Defaults to PROBE_WORKERS.
+
+    Returns:
+        [dict]: `TransferProbe` records
+    """
+
+    def probe(issue):
+        status_code, location = gh.probe_issue(issue.url)
+        return {
+            "issue_id": issue.id,
+            "status_code": status_code,
+            "location": location,
+            "transferred": status_code == 301 and location is not None,
+            "probed_at": datetime.utcnow(),
+        }
+
+    # each probe runs in a copy of this context, which carries the
+    # active metrics stages
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda issue: context.copy().run(probe, issue), issues))
+
+
+def get_transfer_probes(db, gh, issues, ttl=PROBE_TTL):
+    """Probe results for candidate issues. Transfers are permanent, so a
+    stored transfer is always reused; other conclusive results (see
+    `CONCLUSIVE_PROBE_STATUSES`) are reused until they are older than
+    `ttl`. New conclusive results are stored; inconclusive ones are
+    returned but not stored, so the issue is probed again next run.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        gh (TransferAPI): instance of TransferAPI helper with token
+        issues ([row]): candidate issue rows
+        ttl (timedelta, optional): Defaults to PROBE_TTL.
+
+    Returns:
+        dict: {issue_id: probe record}
+    """
+    issue_ids = [issue.id for issue in issues]
+    stored = db.query(TransferProbe).filter(TransferProbe.issue_id.in_(issue_ids))
+    expires = datetime.utcnow() - ttl
+    probes = {
+        rec.issue_id: {
+            "issue_id": rec.issue_id,
+            "status_code": rec.status_code,
+            "location": rec.location,
+            "transferred": rec.transferred,
+            "probed_at": rec.probed_at,
+        }
+        for rec in stored
+        if rec.transferred
+        or (rec.status_code in CONCLUSIVE_PROBE_STATUSES and rec.probed_at > expires)
+    }
+
+    to_probe = [issue for issue in issues if issue.id not in probes]
+    print(f"{len(probes)} cached probes, probing {len(to_probe)} issues...")
+    if to_probe:
+        new_probes = probe_transfers(gh, to_probe)
+        conclusive = [probe for probe in new_probes if is_conclusive(probe)]
+        if len(conclusive) < len(new_probes):
+            print(f"{len(new_probes) - len(conclusive)} inconclusive probes.")
+        upsert_records(db, TransferProbe, conclusive)
+        db.commit()
+        probes.update({probe["issue_id"]: probe for probe in new_probes})
+
+    return probes
+
+
+def apply_transfers(db, transfers):
+    """Record transfers and remove the stale issues along with their
+    events, timeline polls and metrics. All statements run in one transaction;
+    transfers that are already recorded are left as-is.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        transfers ([dict]): `Transfer` records
+
+    Returns:
+        dict: number of rows inserted/deleted per table
+    """
+    counts = {
+        "transfers": 0,
+        "events": 0,
+        "event_polls": 0,
+        "issue_metrics": 0,
+        "issues": 0,
+    }
+    if not transfers:
+        print(f"transfers applied. {counts}")
+        return counts
+
+    issue_ids = [rec["issue_id"] for rec in transfers]
+    try:
+        counts["transfers"] = db.execute(
+            insert(Transfer.__table__).values(transfers).on_conflict_do_nothing()
+        ).rowcount
+        counts["events"] = (
+            db.query(Event)
+            .filter(Event.issue_id.in_(issue_ids))
+            .delete(synchronize_session=False)
+        )
+        counts["event_polls"] = (
+            db.query(EventPoll)
+            .filter(EventPoll.id.in_(issue_ids))
+            .delete(synchronize_session=False)
+        )
+        db.query(TransferProbe).filter(TransferProbe.issue_id.in_(issue_ids)).delete(
+            synchronize_session=False
+        )
+        counts["issue_metrics"] = (
+            db.query(IssueMetric)
+            .filter(IssueMetric.issue_id.in_(issue_ids))
+            .delete(synchronize_session=False)
+        )
+        counts["issues"] = (
+            db.query(Issue)
+            .filter(Issue.id.in_(issue_ids))
+            .delete(synchronize_session=False)
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    print(f"transfers applied. {counts}")
+    return counts
 
 
 def reconcile_transferred_issues(db, gh):
     """Identify potential transferred issues.
 
-    Steps through each and pings to determine if there
-    is a redirect in place (i.e. it is transferred).
+    Probes each (HEAD, concurrently) to determine if there
+    is a redirect in place (i.e. it is transferred). Probe
+    results are stored, see `get_transfer_probes`.
 
     The entire issue history (events) are transferred along
     with issue - so, the latest issue contains all of the
@@ -107,118 +270,86 @@ def reconcile_transferred_issues(db, gh):
         gh (TransferAPI): instance of TransferAPI helper with token
     """
     with db as con:
-        transferred_issues = con.execute(FIND_TRANSFERRED_ISSUES_STMT)
+        transferred_issues = con.execute(FIND_TRANSFERRED_ISSUES_STMT).fetchall()
 
         gh.check_rate("core")
 
         print(f"checking duplicate issues for transfers...")
 
-        for issue in transferred_issues:
-            # if `Location` header present then this record is stale
-            # send a network request , check for 301 + new location
+        # if `Location` header present then this record is stale
+        # probe for 301 + new location
+        probes = get_transfer_probes(db, gh, transferred_issues)
 
-            req = gh.get_issue(issue.url, allow_redirects=False)
-            # if req, then the issue has moved.
+        # issue id -> (new repo, new number)
+        moved = {}
+        for issue in transferred_issues:
+            probe = probes[issue.id]
+            # if 301, then the issue has moved.
             # this issue will get picked up along with
             # new issues since the updated date will change
 
-            if req:
+            if probe["status_code"] == 301:
                 # issue has moved
-                new_url = req.headers.get("Location", None)
+                new_url = probe["location"]
 
-                if req.status_code == 301 and new_url:
-                    print("--- issue transfer ---")
-                    issue_id = issue.id
+                if new_url:
                     new_number = int(new_url.split("/")[-1])
                     new_repo = new_url.split("/")[-3]
-
-                    new_issue = (
-                        db.query(Issue)
-                        .filter(Issue.number == new_number, Issue.repo == new_repo)
-                        .first()
-                    )
-
-                    # the transferred issue exists in the db
-                    if new_issue:
-                        print(f"transferred issue found {new_issue.id}.")
-                        transfer = {
-                            "issue_id": issue_id,
-                            "url": issue.url,
-                            "number": issue.number,
-                            "repo": issue.repo,
-                            "title": issue.title,
-                            "body": issue.body,
-                            "created_at": issue.created_at,
-                            "state": issue.state,
-                            "closed_at": issue.closed_at,
-                            "org": issue.org,
-                            "assignee": issue.assignee,
-                            "assignees": issue.assignees,
-                            "labels": issue.labels,
-                            "new_issue_id": new_issue.id,
-                            "new_repo": new_issue.repo,
-                            "new_url": new_issue.url,
-                            "new_html_url": new_issue.html_url,
-                            "new_number": new_issue.number,
-                            "user": issue.user,
-                            "username": issue.username,
-                        }
-
-                        new_rec = Transfer(**transfer)
-                        db.add(new_rec)
-
-                        try:
-                            db.commit()
-                        except IntegrityError:
-                            db.rollback()
-                            print(f"transferred issue already exists {new_issue.id}.")
-                            continue
-
-                        # delete rec and all associations
-                        print(f"removing {issue_id}...")
-
-                        # delete issue events
-                        related_events = (
-                            db.query(Event).filter(Event.issue_id == issue_id).delete()
-                        )
-                        db.commit()
-                        print(
-                            f"{related_events} related events deleted for rec id {issue_id}."
-                        )
-
-                        # delete issue event polls
-                        related_event_polls = (
-                            db.query(EventPoll)
-                            .filter(EventPoll.id == issue_id)
-                            .delete()
-                        )
-                        db.commit()
-                        print(
-                            f"{related_event_polls} related polls deleted for rec id {issue_id}."
-                        )
-
-                        # delete issue
-                        db.query(Issue).filter(Issue.id == issue_id).delete()
-                        db.commit()
-                        print(f"stale issue deleted {issue_id}.\n---\n")
-
-                    else:
-                        # for now, we'll wait until the issue
-                        # shows in the next pull
-                        print(
-                            f"transferred issue not found {new_repo}/issues/{new_number} for {issue_id}.\n---\n"
-                        )
-
+                    moved[issue.id] = (new_repo, new_number)
                 else:
                     print(
-                        f"issue returned 301 but no redirect location present {issue.id}.\n---\n"
+                        f"issue returned 301 but no redirect location present {issue.id}."
                     )
 
-            else:
-                # issue is not transferred
-                # most likely, the issue that the original was
-                # transferred to
-                print(f"issue was not transferred {issue.id}\n---\n")
+        # single lookup of all new issues (repo/number index)
+        new_issues = {}
+        if moved:
+            recs = db.query(Issue).filter(
+                tuple_(Issue.repo, Issue.number).in_(set(moved.values()))
+            )
+            new_issues = {(rec.repo, rec.number): rec for rec in recs}
+
+        transfers = []
+        for issue in transferred_issues:
+            if issue.id not in moved:
+                continue
+
+            new_issue = new_issues.get(moved[issue.id])
+            if not new_issue:
+                # for now, we'll wait until the issue
+                # shows in the next pull
+                new_repo, new_number = moved[issue.id]
+                print(
+                    f"transferred issue not found {new_repo}/issues/{new_number} for {issue.id}."
+                )
+                continue
+
+            transfers.append(
+                {
+                    "issue_id": issue.id,
+                    "url": issue.url,
+                    "number": issue.number,
+                    "repo": issue.repo,
+                    "title": issue.title,
+                    "body": issue.body,
+                    "created_at": issue.created_at,
+                    "state": issue.state,
+                    "closed_at": issue.closed_at,
+                    "org": issue.org,
+                    "assignee": issue.assignee,
+                    "assignees": issue.assignees,
+                    "labels": issue.labels,
+                    "new_issue_id": new_issue.id,
+                    "new_repo": new_issue.repo,
+                    "new_url": new_issue.url,
+                    "new_html_url": new_issue.html_url,
+                    "new_number": new_issue.number,
+                    "user": issue.user,
+                    "username": issue.username,
+                }
+            )
+
+        apply_transfers(db, transfers)
     print("done")
 
 
@@ -235,4 +366,5 @@ if __name__ == "__main__":
     gh = TransferAPI(token=token)
     db = create_db_session(db_url)
 
-    reconcile_transferred_issues(db, gh)
+    with profile_block("transfers"):
+        reconcile_transferred_issues(db, gh)
@@ -1,11 +1,30 @@
 import logging
 import os
-import boto3
-from botocore.exceptions import ClientError
+import time
+from functools import lru_cache
+
+# seconds SSM parameters are reused before being fetched again
+PARAMETER_TTL = 300
+
+# the GetParameters limit
+PARAMETER_BATCH_SIZE = 10
+
+_parameter_cache = {}
+
+
+@lru_cache(maxsize=None)
+def get_client(service_name, region_name=None):
+    """boto3 client, created once per service and region. boto3 is
+    imported on first use to keep it out of the import time of
+    functions that never call AWS.
+    """
+    import boto3
+
+    return boto3.client(service_name, region_name=region_name)
 
 
 def send_plain_email(msg):
-    ses_client = boto3.client("ses", region_name="us-east-1")
+    ses_client = get_client("ses", region_name="us-east-1")
     CHARSET = "UTF-8"
 
     send_to = os.getenv("SEND_TO_EMAIL")
@@ -35,7 +54,9 @@ def send_plain_email(msg):
 
 
 def put_parameter(parameter_name, parameter_value, parameter_type):
-    ssm_client = boto3.client("ssm")
+    from botocore.exceptions import ClientError
+
+    ssm_client = get_client("ssm")
     try:
         result = ssm_client.put_parameter(
             Name=parameter_name, Value=parameter_value, Type=parameter_type
@@ -46,16 +67,51 @@ def put_parameter(parameter_name, parameter_value, parameter_type):
     return result["Version"]
 
 
+def get_parameters(parameter_names, with_decryption, ttl=PARAMETER_TTL):
+    """Fetch SSM parameters, `PARAMETER_BATCH_SIZE` per request. Values
+    are cached for `ttl` seconds; only missing or expired names are
+    requested.
+
+    Args:
+        parameter_names ([str]): parameter names
+        with_decryption (bool): decrypt SecureString values
+        ttl (int, optional): Defaults to PARAMETER_TTL.
+
+    Returns:
+        dict: {name: value}, None for names that could not be fetched
+    """
+    from botocore.exceptions import ClientError
+
+    now = time.monotonic()
+    stale = [
+        name
+        for name in parameter_names
+        if name not in _parameter_cache or now - _parameter_cache[name][1] > ttl
+    ]
+
+    ssm_client = get_client("ssm")
+    for i in range(0, len(stale), PARAMETER_BATCH_SIZE):
+        names = stale[i : i + PARAMETER_BATCH_SIZE]
+        try:
+            result = ssm_client.get_parameters(
+                Names=names, WithDecryption=with_decryption
+            )
+        except ClientError as e:
+            logging.error(e)
+            continue
+        for param in result["Parameters"]:
+            _parameter_cache[param["Name"]] = (param["Value"], now)
+        for name in result["InvalidParameters"]:
+            logging.error(f"parameter not found: {name}")
+
+    return {
+        name: _parameter_cache[name][0] if name in _parameter_cache else None
+        for name in parameter_names
+    }
+
+
 def get_parameter(parameter_name, with_decryption):
-    ssm_client = boto3.client("ssm")
-    try:
-        result = ssm_client.get_parameter(
-            Name=parameter_name, WithDecryption=with_decryption
-        )
-    except ClientError as e:
-        logging.error(e)
-        return None
-    return result["Parameter"]["Value"]
+    return get_parameters([parameter_name], with_decryption)[parameter_name]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,336 @@
+"""
+    webhooks.py
+    ~~~~~~~~~~~
+
+    Verify and normalize GitHub webhook deliveries into `Issue`,
+    `PullRequest` and `Event` records, and write them in batches.
+
+    Supported events: `issues`, `issue_comment`, `pull_request`
+    and `pull_request_review`.
+
+"""
+import hashlib
+import hmac
+
+from sqlalchemy import tuple_
+
+try:
+    from chalicelib.constants import REPOS
+    from chalicelib.github import set_merge_state
+    from chalicelib.issue_metrics import refresh_issue_metrics
+    from chalicelib.membership import stamp_records
+    from chalicelib.models import Event, Issue, PullRequest, to_record, upsert_records
+except ModuleNotFoundError:
+    from constants import REPOS
+    from github import set_merge_state
+    from issue_metrics import refresh_issue_metrics
+    from membership import stamp_records
+    from models import Event, Issue, PullRequest, to_record, upsert_records
+
+
+MODELS = {
+    "issues": Issue,
+    "pull_requests": PullRequest,
+    "events": Event,
+}
+
+# columns refreshed when a webhook delivers an event that is already stored
+EVENT_UPDATE_COLS = ["body", "reactions", "state", "updated_at"]
+
+# messages of PRs not stored yet are retried this many times, every
+# PR_RETRY_DELAY seconds (the SQS maximum), which spans more than one
+# search sweep (`every_30_min`)
+PR_RETRIES = 6
+PR_RETRY_DELAY = 900
+
+
+def verify_signature(secret, body, signature):
+    """Verify the `X-Hub-Signature-256` header of a webhook delivery.
+
+    Args:
+        secret (str): webhook secret configured on GitHub
+        body (bytes): raw request body
+        signature (str): value of the `X-Hub-Signature-256` header
+
+    Returns:
+        bool: True if the signature matches the body
+    """
+    if not secret or not signature:
+        return False
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(f"sha256={digest}", signature)
+
+
+def _with_repo(rec, payload):
+    repo = payload["repository"]
+    rec["username"] = rec["user"]["login"]
+    rec["repo"] = repo["name"]
+    rec["org"] = repo["owner"]["login"]
+    return rec
+
+
+def normalize_issue(payload):
+    """Issue (or PR, when commented on) from the `issue` key of a payload.
+    Same shape as a search API item.
+
+    Returns:
+        dict: message for `write_batch`
+    """
+    issue = _with_repo(dict(payload["issue"]), payload)
+    if "pull_request" in issue:
+        set_merge_state(issue)
+        return {"model": "pull_requests", "record": to_record(PullRequest, issue)}
+    return {"model": "issues", "record": to_record(Issue, issue)}
+
+
+def normalize_pull_request(payload):
+    """PR from the `pull_request` key of a payload.
+
+    The PR object carries the pull id, not the issue id that
+    `PullRequest.id` is keyed on, so the id is resolved from
+    `repo`/`number` when the batch is written.
+
+    Returns:
+        dict: message for `write_batch`
+    """
+    pr = payload["pull_request"]
+    rec = _with_repo(
+        {
+            "url": pr["issue_url"],
+            "html_url": pr["html_url"],
+            "repository_url": payload["repository"]["url"],
+            "comments_url": pr["comments_url"],
+            "number": pr["number"],
+            "title": pr["title"],
+            "user": pr["user"],
+            "labels": pr["labels"],
+            "state": pr["state"],
+            "merged": pr.get("merged") or pr.get("merged_at") is not None,
+            "locked": pr["locked"],
+            "assignee": pr["assignee"],
+            "assignees": pr["assignees"],
+            "milestone": pr["milestone"],
+            "created_at": pr["created_at"],
+            "updated_at": pr["updated_at"],
+            "closed_at": pr["closed_at"],
+            "author_association": pr["author_association"],
+            "active_lock_reason": pr.get("active_lock_reason"),
+            "draft": pr.get("draft"),
+            "body": pr["body"],
+            "pull_request": {
+                "url": pr["url"],
+                "html_url": pr["html_url"],
+                "diff_url": pr["diff_url"],
+                "patch_url": pr["patch_url"],
+                "merged_at": pr.get("merged_at"),
+            },
+        },
+        payload,
+    )
+    return {
+        "model": "pull_requests",
+        "record": rec,
+        "repo": rec["repo"],
+        "number": pr["number"],
+    }
+
+
+def normalize_comment(payload):
+    """`commented` timeline event from an `issue_comment` payload.
+
+    Returns:
+        dict: message for `write_batch`
+    """
+    comment = payload["comment"]
+    rec = {
+        "id": comment["id"],
+        "issue_id": payload["issue"]["id"],
+        "org": payload["repository"]["owner"]["login"],
+        "repo": payload["repository"]["name"],
+        "event": "commented",
+        "body": comment["body"],
+        "reactions": comment.get("reactions"),
+        "created_at": comment["created_at"],
+        "updated_at": comment["updated_at"],
+        "node_id": comment["node_id"],
+        "user": comment["user"],
+        "author_association": comment["author_association"],
+        "username": comment["user"]["login"],
+    }
+    return {"model": "events", "record": rec}
+
+
+def normalize_review(payload):
+    """`reviewed` timeline event from a `pull_request_review` payload.
+    As with timeline reviews, `submitted_at` maps to `created_at`.
+
+    Returns:
+        dict: message for `write_batch`
+    """
+    review = payload["review"]
+    repo = payload["repository"]["name"]
+    rec = {
+        "id": review["id"],
+        "org": payload["repository"]["owner"]["login"],
+        "repo": repo,
+        "event": "reviewed",
+        "body": review["body"],
+        "state": review["state"],
+        "created_at": review["submitted_at"],
+        "node_id": review["node_id"],
+        "user": review["user"],
+        "author_association": review["author_association"],
+        "username": review["user"]["login"],
+    }
+    return {
+        "model": "events",
+        "record": rec,
+        "repo": repo,
+        "number": payload["pull_request"]["number"],
+    }
+
+
+def normalize_event(event_type, payload):
+    """Normalize a webhook delivery into messages for `write_batch`.
+
+    Deliveries for untracked repos, unsupported event types and
+    deletions are dropped; the scheduled gap-fill jobs reconcile those.
+
+    Args:
+        event_type (str): value of the `X-GitHub-Event` header
+        payload (dict): webhook payload
+
+    Returns:
+        [dict]: messages, possibly empty
+    """
+    repo = (payload.get("repository") or {}).get("name")
+    if repo not in REPOS or payload.get("action") == "deleted":
+        return []
+
+    if event_type == "issues":
+        return [normalize_issue(payload)]
+    if event_type == "issue_comment":
+        return [normalize_issue(payload), normalize_comment(payload)]
+    if event_type == "pull_request":
+        return [normalize_pull_request(payload)]
+    if event_type == "pull_request_review":
+        if not payload["review"].get("submitted_at"):
+            return []
+        return [normalize_review(payload)]
+    return []
+
+
+def resolve_pr_ids(db, messages):
+    """Map `(repo, number)` to the stored `PullRequest.id` (the issue id)
+    for messages normalized from PR payloads.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        messages ([dict]): normalized messages
+
+    Returns:
+        dict: {(repo, number): id}
+    """
+    keys = {(msg["repo"], msg["number"]) for msg in messages if msg.get("number")}
+    if not keys:
+        return {}
+    rows = (
+        db.query(PullRequest.id, PullRequest.repo, PullRequest.number)
+        .filter(tuple_(PullRequest.repo, PullRequest.number).in_(keys))
+        .all()
+    )
+    return {(row.repo, row.number): row.id for row in rows}
+
+
+def requeue(queue):
+    """`defer` callback of `write_batch` that sends messages back to
+    `queue` (delayed), up to PR_RETRIES times each."""
+
+    def defer(msg):
+        retries = msg.get("retries", 0)
+        if retries >= PR_RETRIES:
+            print(f"pr not found {msg['repo']}#{msg['number']}, dropped.")
+            return
+        queue.send(dict(msg, retries=retries + 1))
+
+    return defer
+
+
+def _load(db, recs, loader):
+    """Stamp and upsert records per table.
+
+    Returns:
+        dict: number of records written per table
+    """
+    counts = {}
+    for name, db_model in MODELS.items():
+        stamp_records(db, recs[name])
+
+        # partial records (e.g. from PR payloads) only
+        # update the columns they carry
+        groups = {}
+        for rec in recs[name]:
+            groups.setdefault(frozenset(rec), []).append(rec)
+
+        counts[name] = 0
+        for group in groups.values():
+            if db_model is Event:
+                counts[name] += loader(db, Event, group, update_cols=EVENT_UPDATE_COLS)
+            else:
+                counts[name] += loader(db, db_model, group, newer_only=True)
+    return counts
+
+
+def write_batch(db, messages, loader=upsert_records, defer=None):
+    """Write a batch of normalized webhook messages in one transaction,
+    along with the metrics of the items they touch.
+
+    Messages that reference a PR not yet in the DB (e.g. a PR opened
+    since the last search) are handed to `defer`, to retry them once the
+    scheduled search has stored the PR, or skipped without it.
+
+    Args:
+        db (sqlalchemy DB session): sqlalchemy DB session
+        messages ([dict]): messages from `normalize_event`
+        loader (function, optional): upsert function called per table and
+        key set, e.g. `bulk.bulk_upsert`. Defaults to upsert_records.
+        defer (function, optional): called with each message of a PR not
+        stored yet, e.g. `requeue(queue)`. Defaults to None.
+
+    Returns:
+        dict: number of records written per table
+    """
+    # messages carrying their ids are written first, so that PRs stored
+    # by this batch resolve for the messages keyed on (repo, number)
+    keyed = [msg for msg in messages if msg.get("number")]
+    recs = {name: [] for name in MODELS}
+    for msg in messages:
+        if not msg.get("number"):
+            recs[msg["model"]].append(dict(msg["record"]))
+    counts = _load(db, recs, loader)
+
+    pr_ids = resolve_pr_ids(db, keyed)
+    keyed_recs = {name: [] for name in MODELS}
+    for msg in keyed:
+        rec_id = pr_ids.get((msg["repo"], msg["number"]))
+        if not rec_id:
+            if defer:
+                defer(msg)
+            else:
+                print(f"pr not found {msg['repo']}#{msg['number']}, skipping.")
+            continue
+        rec = dict(msg["record"])
+        rec["issue_id" if msg["model"] == "events" else "id"] = rec_id
+        keyed_recs[msg["model"]].append(rec)
+    for name, count in _load(db, keyed_recs, loader).items():
+        counts[name] += count
+        recs[name] += keyed_recs[name]
+
+    refresh_issue_metrics(
+        db,
+        [rec["id"] for rec in recs["issues"] + recs["pull_requests"]]
+        + [rec["issue_id"] for rec in recs["events"]],
+    )
+    db.commit()
+    print(f"batch written. {counts}")
+    return counts